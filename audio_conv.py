@@ -8,7 +8,7 @@
 # filenames of output files (low priority).
 # rearrange layout to be more readable.
 #
-# Version 0.4.5.3
+# Version 0.5.23
 #
 # Changes:
 # 0.1 Uses a system tempfile instead of a file named "tempfile", so multiple 
@@ -62,6 +62,90 @@
 # 0.4.5.3 Now replacing double quotes with single quotes for parsing of flac, mp3,
 # and ogg meta tags.
 #
+# 0.5 Files are converted in parallel, one job per file in a pool of worker processes (--jobs, defaults to the
+# number of CPUs).  Each job has its own tempfile, errors only fail the file they happened in, and console output
+# is labelled with the file it belongs to.
+#
+# 0.5.1 Decoders are piped straight into the encoder (mplayer through a fifo) instead of writing an intermediate
+# wav first.  The tempfile is only used when normalizing, or with the new --no-stream option.
+#
+# 0.5.2 Added the --sync option.  A manifest in the destination directory remembers what was converted, so
+# re-runs only convert new or changed files, and --prune removes outputs whose source file is gone.
+#
+# 0.5.3 Tags and bitrates are read by a single probeFile() function, with an optional cache (--probe-cache) so
+# repeated runs don't start mp3info, ogginfo, metaflac or mplayer again for files that haven't changed.
+#
+# 0.5.4 Native readers for the tags and stream info of flac, ogg vorbis, mp3 (id3v1/id3v2 and xing/vbri) and wav
+# files.  They read the tags exactly as stored, the tag programs are only used for files the readers can't handle.
+#
+# 0.5.5 Built in normalization with numpy (rms or peak, --normalize-mode) that applies the gain while feeding the
+# encoder instead of rewriting the wav with normalize-audio, and an --album mode with one gain per directory.
+#
+# 0.5.6 Files are searched for without changing directory or using glob, and handed to the jobs as they are found,
+# so converting starts before a large library has been searched.  Added --include, --exclude and --ext to pick
+# files by more than one pattern or extension in a single run.
+#
+# 0.5.7 The run is compiled into a plan first, with the output path and encoder command of every file, and each
+# output directory is created once.  --dry-run lists the plan, --save-plan writes it to a json file and --run-plan
+# converts the files of a saved plan (or of part of it).
+#
+# 0.5.8 Intermediate wav files can be kept in memory (/dev/shm) up to a budget shared by all the jobs (--tmp-budget),
+# the rest go to the disk (--tmp-dir).  Each one has a unique name and they are removed when a job ends, including
+# when the run is interrupted with control-c.
+#
+# 0.5.9 Staged output (--stage-dir) for slow usb sticks: the jobs encode to local storage and a single writer copies
+# the finished files to the destination in directory order, renaming each into place once it is synced.
+#
+# 0.5.10 --max-size estimates the size of every output before converting and only converts the files that fit,
+# picked in directory order, smallest first or by --priority patterns (--fit-order).
+#
+# 0.5.11 Timing of every stage of every file and of the backend programs (--timing), written as json lines
+# (--timing-log) and as a chrome trace (--trace), with the median and 95th percentile per stage and input format.
+#
+# 0.5.12 The backend programs are run from argument lists instead of shell command lines, so there is no shell
+# process per command and nothing to quote (names with $, ` or backslashes no longer break).  The tag programs' output
+# is parsed line by line as it is written, and --command-timeout stops a program that hangs.
+#
+# 0.5.13 An encode cache (--encode-cache) shared by all destinations and runs: outputs are kept under a hash of the
+# source content and the encoder settings, and linked or copied instead of encoded again.
+#
+# 0.5.14 --tag selects files by their user.xdg.tags extended attribute (a tagged directory selects everything under
+# it), with an index of the tags read so later runs only read the directories that changed.
+#
+# 0.5.15 .rpm and .ram playlists become one job per stream, each with its own intermediate file and a numbered
+# output, so the streams are fetched and decoded in parallel (--stream-jobs limits how many at once).
+#
+# 0.5.16 A routing table picks how each file is converted: directly where the encoder reads the input format itself
+# (flac to ogg, mp3 to mp3, flac to flac, wav to anything), piped from the decoder, or through a wav tempfile.  The
+# route of each file is shown, --no-direct turns the direct routes off.
+#
+# 0.5.17 Every file is probed first (tags, bitrate and its own encoder settings) and only decoded once it has passed
+# the skip checks and missed the encode cache.  Playlist streams are probed too instead of being decoded for their
+# tags, and intermediate files are only made for files that get decoded.
+#
+# 0.5.18 Outputs are written under a temporary name next to them and renamed into place when the encoder succeeds, so
+# an interrupted run never leaves a truncated file under the real name.  A journal in the destination directory
+# records every finished file, --resume carries on from it without probing those again.  A file converted to itself
+# no longer needs an intermediate copy.
+#
+# 0.5.19 Progress of long runs: --metrics keeps a Prometheus textfile (files, throughput, realtime factor per codec,
+# queue and ETA) up to date as files finish, --status shows the same on one line.
+#
+# 0.5.20 --files-from takes the files to convert from a list (a file or standard input, NUL or newline delimited) as
+# it is written, their outputs go under --dest-dir the way they are under --source-root.
+#
+# 0.5.21 --rate, --channels and --bits convert the audio for players that want a fixed format (eg. 44.1 kHz, 16 bit
+# stereo for a car): resampled with a polyphase filter, down-mixed and reduced with TPDF dither by numpy in blocks
+# between the decoder and the encoder.
+#
+# 0.5.22 --dedupe finds the same recording more than once (as flac and mp3, or on a compilation and its album) and
+# only encodes the best copy.  The others are skipped, or with --dedupe link get a hard link to its output, and a
+# report of them is written to --dedupe-report.
+#
+# 0.5.23 --target adds outputs in other formats or directories (eg. an mp3 tree for the car and an ogg one for a
+# phone) to the run.  Every file is probed and decoded (and normalized) once and the wav goes to all of its encoders
+# at the same time.
+#
 # Chris LeBlanc, 2006
 #
 #
@@ -86,12 +170,60 @@ import sys
 import os
 from subprocess import *
 import shutil
-import glob
+import signal
+import errno
+import sqlite3
+import math
+import struct
+import time
+import traceback
 import StringIO
+import Queue
+import threading
+import json
+import hashlib
+import shlex
+from fnmatch import fnmatch
+from fractions import gcd
 from random import randint
+from collections import namedtuple
+from itertools import chain
 from string import join
 from optparse import OptionParser
-from tempfile import NamedTemporaryFile
+from tempfile import TemporaryFile, gettempdir
+from multiprocessing import Pool, Lock, Value, BoundedSemaphore, cpu_count
+
+# numpy is only needed for the built in normalization (without it normalize-audio is used) and --rate, --channels
+# and --bits.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# scandir saves a stat call per directory entry when searching for files.  It is in os from python 3.5, older
+# pythons have it with the scandir module, and without either os.listdir is used.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+# Extended attributes (for --tag) are in os from python 3.3, older pythons have them with the xattr module, and on
+# linux they are read from the c library without either.
+try:
+	from os import getxattr
+except ImportError:
+	try:
+		from xattr import getxattr
+	except ImportError:
+		getxattr = None
+libc = None
+if not getxattr and sys.platform.startswith("linux"):
+	import ctypes
+	import ctypes.util
+	libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
 
 # If the binaries are in the path (linux or windows).
 MPLAYER = "mplayer"
@@ -117,6 +249,30 @@ NORMALIZE = "normalize-audio"
 ##NORMALIZE = "C:\\chris\\audio_conv\\normalize.exe"
 
 
+# The genres that Lame and other encoders accept, in id3v1 order so the native mp3 reader can also use it to look up
+# numbered genres.
+# Genre list generated by id3v2 program with -L option ('Bebob' looks like a typo but 'Bebop' wont work with Lame).
+genreList = ('Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop', \
+	'Jazz', 'Metal', 'New Age', 'Oldies', 'Other', 'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', \
+	'Industrial', 'Alternative', 'Ska', 'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', \
+	'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion', 'Trance', 'Classical', 'Instrumental', \
+	'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise', 'Alt. Rock', 'Bass', 'Soul', 'Punk', \
+	'Space', 'Meditative', 'Instrum. Pop', 'Instrum. Rock', 'Ethnic', 'Gothic', 'Darkwave', \
+	'Techno-Indust.', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream', 'Southern Rock', 'Comedy', \
+	'Cult', 'Gangsta', 'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', \
+	'Cabaret', 'New Wave', 'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi', 'Tribal', \
+	'Acid Punk', 'Acid Jazz', 'Polka', 'Retro', 'Musical', 'Rock & Roll', 'Hard Rock', 'Folk', \
+	'Folk/Rock', 'National Folk', 'Swing', 'Fusion', 'Bebob', 'Latin', 'Revival', 'Celtic', \
+	'Bluegrass', 'Avantgarde', 'Gothic Rock', 'Progress. Rock', 'Psychadel. Rock', 'Symphonic Rock', \
+	'Slow Rock', 'Big Band', 'Chorus', 'Easy Listening', 'Acoustic', 'Humour', 'Speech', 'Chanson', \
+	'Opera', 'Chamber Music', 'Sonata', 'Symphony', 'Booty Bass', 'Primus', 'Porn Groove', 'Satire', \
+	'Slow Jam', 'Club', 'Tango', 'Samba', 'Folklore', 'Ballad', 'Power Ballad', 'Rhythmic Soul', \
+	'Freestyle', 'Duet', 'Punk Rock', 'Drum Solo', 'A Capella', 'Euro-House', 'Dance Hall', 'Goa', \
+	'Drum & Bass', 'Club-House', 'Hardcore', 'Terror', 'Indie', 'BritPop', 'Negerpunk', 'Polsk Punk', \
+	'Beat', 'Christian Gangsta Rap', 'Heavy Metal', 'Black Metal', 'Crossover', 'Contemporary Christian', \
+	'Christian Rock', 'Merengue', 'Salsa', 'Thrash Metal', 'Anime', 'Jpop', 'Synthpop')
+
+
 def getCmdLineArgs():
 	parser = OptionParser()
 
@@ -215,9 +371,103 @@ def getCmdLineArgs():
 		 "the input filename in current directory and all " + \
 		 "subdirectories.  If using wildcards, they must be in " + \
 		 "quotes.")
+	parser.add_option("--files-from", dest="filesFrom", \
+		help="Convert the files listed in FILE (- for standard input) " + \
+		"instead of looking for them, one per line or separated by NUL " + \
+		"characters (eg. from find -print0).  The files are converted as " + \
+		"the list is read.", type="string", metavar="FILE", default=None)
+	parser.add_option("--source-root", dest="sourceRoot", \
+		help="With --files-from and --dest-dir, the directory the " + \
+		"listed files are under.  Each output goes to the same place " + \
+		"under the destination directory.  The default is the current " + \
+		"directory.", type="string", metavar="DIR", default=None)
+	parser.add_option("--include", action="append", dest="include", \
+		help="Also convert files matching this pattern, in the input " + \
+		"directory (and its subdirectories with --recursive).  May be " + \
+		"given more than once.", type="string", metavar="PATTERN", default=[])
+	parser.add_option("--exclude", action="append", dest="exclude", \
+		help="Leave out files and directories matching this pattern. " + \
+		"An excluded directory is not searched.  May be given more " + \
+		"than once.", type="string", metavar="PATTERN", default=[])
+	parser.add_option("--ext", dest="extensions", \
+		help="Only convert files with one of these extensions, comma " + \
+		"separated (eg 'flac,ogg,wma').", type="string", metavar="LIST", \
+		default=None)
+	parser.add_option("--tag", action="append", dest="tags", \
+		help="Only convert files that have this tag (the user.xdg.tags " + \
+		"extended attribute), or that are in a directory that has it. " + \
+		"May be a pattern ('*' is any tag) and may be given more than " + \
+		"once.", type="string", metavar="NAME", default=[])
+	parser.add_option("--tag-index", dest="tagIndex", \
+		help="Where the tags read are kept between runs, so only " + \
+		"changed directories are read again [default: %default].", \
+		type="string", metavar="FILE", default=TAG_INDEX)
+	parser.add_option("--tag-rescan", action="store_true", \
+		dest="tagRescan", help="Read the tags of every file again " + \
+		"instead of using the index (eg. after tagging single files).")
 	parser.add_option("--dry-run", action="store_true", \
 		 dest="dryRun", help="List the path of each input file " + \
 		 "and output file but do not convert anything.")
+	parser.add_option("--save-plan", dest="savePlan", \
+		help="Write the plan of the run (input, output and encoder " + \
+		"command of each file) to FILE as json, one file per line, " + \
+		"instead of converting.  '-' writes it to standard output.", \
+		type="string", metavar="FILE", default=None)
+	parser.add_option("--run-plan", dest="runPlan", \
+		help="Convert the files of a plan written with --save-plan (or " + \
+		"of some of its lines) instead of looking for files.  The input " + \
+		"and output format options are not needed, the other options " + \
+		"(eg --normalize, --delete) are taken from this command line.", \
+		type="string", metavar="FILE", default=None)
+	parser.add_option("--max-size", dest="maxSize", \
+		help="Only convert as many files as fit in SIZE (eg 16G), going " + \
+		"by an estimate of each output from the length of the input and " + \
+		"the bitrate.  The rest are skipped, use with --dry-run to see " + \
+		"what fits without converting.", \
+		type="string", metavar="SIZE", default=None)
+	parser.add_option("--fit-order", dest="fitOrder", \
+		help="The order files are picked in with --max-size: " + \
+		"'directory', 'smallest' (as many files as possible) or " + \
+		"'priority' (see --priority) [default: %default].", \
+		type="choice", choices=FIT_ORDERS, metavar="ORDER", default="directory")
+	parser.add_option("--priority", action="append", dest="priority", \
+		help="With --fit-order priority, files matching this pattern " + \
+		"(the name or the whole path) are picked before the others.  May " + \
+		"be given more than once, earlier patterns come first.", \
+		type="string", metavar="PATTERN", default=[])
+	parser.add_option("--dedupe", dest="dedupe", \
+		help="Only encode the best copy (lossless first, then the " + \
+		"highest bitrate) of a recording found more than once, going by " + \
+		"its artist, title and length and, where the copies can be " + \
+		"compared, the decoded audio.  'skip' leaves the other copies " + \
+		"out, 'link' hard links their outputs to the one encoded.", \
+		type="choice", choices=DEDUPE_MODES, metavar="MODE", default=None)
+	parser.add_option("--dedupe-report", dest="dedupeReport", \
+		help="Where --dedupe writes the list of duplicates [default: " + \
+		DUPLICATES_NAME + " in the destination directory].", \
+		type="string", metavar="FILE", default=None)
+	parser.add_option("--timing", action="store_true", dest="timing", \
+		help="Time every stage of every file (probing, decoding, " + \
+		"normalizing, encoding, tagging) and print the median and 95th " + \
+		"percentile of each stage and input format at the end.", \
+		default=False)
+	parser.add_option("--timing-log", dest="timingLog", \
+		help="Write the timings (with the exit status and bytes in and " + \
+		"out of each stage and backend program) to FILE as json lines. " + \
+		"Implies --timing.", type="string", metavar="FILE", default=None)
+	parser.add_option("--trace", dest="trace", \
+		help="Write the timings to FILE in the chrome trace_event format, " + \
+		"for chrome://tracing or ui.perfetto.dev.  Implies --timing.", \
+		type="string", metavar="FILE", default=None)
+	parser.add_option("--metrics", dest="metrics", \
+		help="Keep the progress of the run (files done, skipped and " + \
+		"failed, bytes per second, realtime factor per codec, ETA) in " + \
+		"FILE in the Prometheus text format, rewritten as each file " + \
+		"finishes.  Put it in node-exporter's textfile directory as " + \
+		"NAME.prom.", type="string", metavar="FILE", default=None)
+	parser.add_option("--status", action="store_true", \
+		 dest="status", help="Show the progress of the run on a status " + \
+		 "line (on standard error).")
 	parser.add_option("--to-ogg", action="store_true", \
 		 dest="oggOutput", help="Ogg vorbis output format.")
 	parser.add_option("--to-mp3", action="store_true", \
@@ -229,6 +479,15 @@ def getCmdLineArgs():
 	parser.add_option("-n", "--normalize", action="store_true", \
 		 dest="normalize", help="Normalize the volume of " + \
 		 "output files.")
+	parser.add_option("--normalize-mode", dest="normalizeMode", \
+		help="How to normalize: 'rms' brings the average level of each " + \
+		"file to the same volume (without clipping), 'peak' brings the " + \
+		"loudest sample to full scale and 'external' uses normalize-audio. " + \
+		"rms and peak need numpy [default %default].", type="choice", \
+		choices=["rms", "peak", "external"], metavar="MODE", default="rms")
+	parser.add_option("--album", action="store_true", \
+		 dest="album", help="Normalize each directory as an album, with " + \
+		 "the same gain for all of its files (implies --normalize).")
 	parser.add_option("-d", "--delete", action="store_true", \
 		 dest="delSource", help="Delete the input file after " + \
 		 "conversion (use with caution!).")
@@ -239,10 +498,32 @@ def getCmdLineArgs():
 		"If the destination directory does not exist, it will be created. " + \
 		"Works especially well with the recursive option.", \
 		type="string", metavar="DESTINATION", default=None)
+	parser.add_option("--target", action="append", dest="targets", \
+		help="Also write each file in another format and/or directory, " + \
+		"from the same decode: 'FORMAT[ ENCODER OPTIONS][:DIR]' with " + \
+		"FORMAT ogg, mp3, wav or flac (eg 'ogg -q 5:/media/phone').  The " + \
+		"encoder options replace the bitrate like --encoder-option does, " + \
+		"without a DIR the output goes next to the input.  The DIR is " + \
+		"after the last ':', end with ':' when the encoder options have " + \
+		"one and there is no DIR.  May be given more than once.", type="string", metavar="TARGET", default=[])
+	parser.add_option("--stage-dir", dest="stageDir", \
+		help="Encode into this directory on fast local storage and copy " + \
+		"the finished files to the destination one at a time, in " + \
+		"directory order.  For slow targets such as usb flash drives.", \
+		type="string", metavar="DIR", default=None)
 	parser.add_option("-t", "--tempfile", dest="tempFile", \
 		help="Specify the path for a user defined tempfile. The default " + \
                 "tempfile uses a system tempfile.", \
 		type="string", metavar="PATH", default=None)
+	parser.add_option("--tmp-budget", dest="tmpBudget", \
+		help="Memory to use for intermediate wav files (eg 512M or 2G), " + \
+		"they are kept in /dev/shm while they fit and written to the " + \
+		"disk otherwise.  The default is to always use the disk.", \
+		type="string", metavar="SIZE", default=None)
+	parser.add_option("--tmp-dir", dest="tmpDir", \
+		help="Directory for intermediate wav files that are not kept in " + \
+		"memory [default: the system temp directory].", \
+		type="string", metavar="DIR", default=None)
 	parser.add_option("-e", "--encoder-option", dest="encodeOption", \
 		help="Specify options to be passed to the encoder. May " + \
 		"include any option supported by the encoder such as " + \
@@ -252,6 +533,74 @@ def getCmdLineArgs():
 		"to specify tags that may conflict with tags taken from input file. " + \
 		"String must be encapsulated by quotes.", \
 		type="string", metavar="STRING", default="")
+	parser.add_option("--no-stream", action="store_false", \
+		 dest="stream", default=True, help="Decode to an intermediate " + \
+		 "wav tempfile before encoding.  By default the decoder is piped " + \
+		 "straight into the encoder and the tempfile is only written when " + \
+		 "normalizing.")
+	parser.add_option("--no-direct", action="store_false", \
+		 dest="direct", default=True, help="Always decode the input, " + \
+		 "even where the encoder can read it itself (eg. flac to ogg with " + \
+		 "an oggenc built without flac support).")
+	parser.add_option("--rate", dest="rate", \
+		help="Resample the audio to this many Hz (eg. 44100), for " + \
+		"players that only take one rate.  Needs numpy.", type="int", \
+		metavar="HZ", default=None)
+	parser.add_option("--channels", dest="channels", \
+		help="Down-mix (or up-mix) the audio to 1 or 2 channels.  Needs " + \
+		"numpy.", type="choice", choices=["1", "2"], metavar="N", \
+		default=None)
+	parser.add_option("--bits", dest="bits", \
+		help="Bits per sample of the audio fed to the encoder, 16 or 24. " + \
+		"Fewer bits than the input get TPDF dither.  Needs numpy.", \
+		type="choice", choices=["16", "24"], metavar="BITS", default=None)
+	parser.add_option("-s", "--sync", action="store_true", \
+		 dest="sync", help="Only convert files that are new or have " + \
+		 "changed since the last run.  A manifest of converted files is " + \
+		 "kept in the destination directory (or the input directory).")
+	parser.add_option("--resume", action="store_true", \
+		 dest="resume", help="Carry on with an interrupted run: the " + \
+		 "files the journal in the destination directory has as " + \
+		 "finished are left out without reading them.  Without " + \
+		 "--dest-dir the journal (in the input directory) is only kept " + \
+		 "by runs with --resume.")
+	parser.add_option("--prune", action="store_true", \
+		 dest="prune", help="Delete output files whose source file " + \
+		 "no longer exists (implies --sync).")
+	parser.add_option("--probe-cache", dest="probeCache", \
+		help="Keep the tags and bitrate read from each input file in " + \
+		"this cache file, so later runs (and dry runs) don't have to read " + \
+		"them again.", type="string", metavar="FILE", default=None)
+	parser.add_option("--probe-cache-size", dest="probeCacheSize", \
+		help="Number of files kept in the probe cache, the least " + \
+		"recently used are removed first [default %default].", \
+		type="int", metavar="N", default=100000)
+	parser.add_option("--encode-cache", dest="encodeCache", \
+		help="Keep a copy of every output in this directory, keyed by the " + \
+		"content of the source file and the encoder settings and tags. " + \
+		"Files already in it are linked or copied instead of encoded, " + \
+		"eg. when the same library is converted for another drive.", \
+		type="string", metavar="DIR", default=None)
+	parser.add_option("--encode-cache-size", dest="encodeCacheSize", \
+		help="Size the encode cache is kept under, the least recently " + \
+		"used files are removed first [default %default].", \
+		type="string", metavar="SIZE", default="10G")
+	parser.add_option("--cache-stats", action="store_true", \
+		 dest="cacheStats", help="Show how many probes were answered " + \
+		 "by the probe cache at the end of the run.")
+	parser.add_option("-j", "--jobs", dest="jobs", \
+		help="Number of files to convert at the same time, each in its " + \
+		"own process with its own tempfile.  The default is the number " + \
+		"of CPUs.", type="int", metavar="N", default=None)
+	parser.add_option("--stream-jobs", dest="streamJobs", \
+		help="Fetch at most N streams of .rpm/.ram playlists at the " + \
+		"same time.  Every stream is a job of its own, the default is " + \
+		"as many as --jobs.", type="int", metavar="N", default=None)
+	parser.add_option("--command-timeout", dest="commandTimeout", \
+		help="Stop a backend program (decoder, encoder, tag program) " + \
+		"that runs for more than this many seconds, failing its file. " + \
+		"The default is no limit.", type="int", metavar="SECONDS", \
+		default=None)
 	parser.add_option("-v", "--verbose", action="store_true", \
 		 dest="verbose", help="Show all standard output and error " + \
 		"messages from backend programs.  Default is to hide these messages.")
@@ -319,490 +668,3497 @@ def ogginfoTags(tagInfo):
 	return tagName, tagAuthor, tagGenre, tagDate, tagAlbum, inBitrate
 
 # skipping files that have the same or less input bitrate as the desired output (and the same in/output format).
+# Returns why the file is skipped, or None.
+def bitrateSkipReason(inBitrate, options, inFileExtension, outFileExtension):
+	# if in/out file extensions are different, don't skip transcoding.  Without a bitrate option the output gets
+	# the input's bitrate, so there is nothing to compare.
+	if outFileExtension != inFileExtension or options.force or not options.bitrate:
+		return None
+	elif int(float(inBitrate)) == options.bitrate:
+		return "input and output bitrate are identical. Use -f to force conversion."
+	elif int(float(inBitrate)) < options.bitrate:
+		return "input bitrate less than output. Use -f to force conversion."
+	return None
+
 def badBitrate(file, inBitrate, options, inFileExtension, outFileExtension):
-	if outFileExtension == inFileExtension:
-		if options.force:
-			# forcing by making it look like the bitrates are not identical
-			return False
-		elif int(float(inBitrate)) == options.bitrate:
-			print("skipping %s, input and output bitrate are identical. Use -f to force conversion." % file)
-			return True
-		elif int(float(inBitrate)) < options.bitrate:
-			print("skipping %s, input bitrate less than output. Use -f to force conversion." % file)
-			return True
-		else:
-			return False
-	# if in/out file extensions are different, don't skip transcoding.
-	else:
-		return False
+	reason = bitrateSkipReason(inBitrate, options, inFileExtension, outFileExtension)
+	if reason:
+		print("skipping %s, %s" % (file, reason))
+	return bool(reason)
 
-# duplicating old recursive directory structure in new destination directory.  Tricky!  TODO: test in windows
-# the use of absolute paths may mess up the windows version of mplayer...
-def destinationDir(file, destDir, dryRun):
-	# some variable needed for creating the destination directory structure.
-	
-	fileBasename = os.path.basename(file) # basename of file, no leading directories.
-	fileAbs = os.path.abspath(file) # absolute, not relative
-	topDirAbs = os.path.abspath(topDir) # the 'top' directory, the subdris from here will be duplicated in the new dir.
-	destDirAbs = os.path.abspath(destDir) # absolute path of the destination directory
-	strippedPath = fileAbs.replace(topDirAbs, "")[1:] # stripping the 'top' directory from the path of the file to process.
-	newFileDir = os.path.dirname(strippedPath) # the directory of the stripped file, relative to the top directory (NOT absolute).  Needs to be created if it doesn't exist!
-	newFileDirAbs = os.path.join(destDirAbs, newFileDir) # absolute path of the new directory including new subdirs.
-	newFilePath = os.path.join(newFileDirAbs, fileBasename) # joining the new path and basename
-	
-	# making a copy of the directory structure, because it will be modified.
-	newFileDirCopy = newFileDir
-	dirList = []
-	while newFileDirCopy:
-		deepDir = newFileDirCopy
-		dirList.append(deepDir)
-		# modifying newFileDirCopy by stripping off the deepest subdir.
-		newFileDirCopy = os.path.split(newFileDirCopy)[0]
-
-	# no need to make new directories for a dry run.
-	if not dryRun:
-		# creating the dest-dir if it doesn't exist (not really necessary, but what the heck).  May remove this later (?).
-		if not os.path.isdir(destDirAbs):
-			os.mkdir(destDirAbs)
-		
-		# reversing the list so I make parent directories (if needed) before subdirectories
-		dirList.reverse()
-		for directory in dirList:
-			fullDirPath = os.path.join(destDirAbs, directory)
-			if not os.path.isdir(fullDirPath):
-				print "The following output driectory doesn't exist, creating:", fullDirPath
-				os.mkdir(fullDirPath)
-	
-	return newFilePath
+# the file extension for the chosen output format.
+def outputExtension(options):
+	if options.oggOutput:
+		return ".ogg"
+	elif options.mp3Output:
+		return ".mp3"
+	elif options.wavOutput:
+		return ".wav"
+	elif options.flacOutput:
+		return ".flac"
+
+# inside a pool worker the backend programs get control-c back (see initWorker).
+def popenPreexec():
+	if outputLock and os.name != 'nt':
+		return restoreSigint
+	return None
 
-def runPopen(popenString, verbose):
-	popenOuput = None
-	if verbose:
+# the backend programs this process is running, stopped when it exits half way (see gracefulExit).
+runningCommands = set()
+
+# The backend programs are started from argument lists, without a shell in between, so file names and tags go to them
+# exactly as they are and there is nothing to quote.  With --command-timeout a program that runs for too long is
+# stopped, which fails the file.
+def startCommand(command, **popenArgs):
+	process = Popen(command, preexec_fn=popenPreexec(), **popenArgs)
+	runningCommands.add(process)
+	process.started = time.time()
+	process.watchdog = None
+	if options.commandTimeout:
+		process.watchdog = threading.Timer(options.commandTimeout, stopCommand, (process, command))
+		process.watchdog.daemon = True
+		process.watchdog.start()
+	return process
+
+def stopCommand(process, command):
+	if process.poll() is None:
+		say("%s ran for more than %d seconds, stopping it." % (os.path.basename(command[0]), options.commandTimeout))
+		try:
+			process.kill()
+		except OSError:
+			pass
+
+# waiting for a command started with startCommand(), returns its exit status.
+def finishCommand(process, command):
+	process.wait()
+	runningCommands.discard(process)
+	if process.watchdog:
+		process.watchdog.cancel()
+	recordCommand(command, process.started, process.returncode)
+	return process.returncode
+
+def runPopen(command, verbose):
+	return runPopenStatus(command, verbose)[0]
+
+# like runPopen, but also giving the exit status of the command.  The output goes to the stdout file instead when
+# one is given.
+def runPopenStatus(command, verbose, stdin=None, stdout=None):
+	popenOutput = ""
+	if stdout:
+		process = startCommand(command, stdin=stdin, stdout=stdout, stderr=(not verbose or jobLabel) and PIPE or None)
+		popenOutput = process.communicate()[1] or ""
+		if verbose:
+			for line in popenOutput.splitlines():
+				say(line)
+	elif verbose and not jobLabel:
 		# letting standard output go to terminal for verbosity
-		popenOutput = Popen(popenString, shell=True).communicate()[0]
+		process = startCommand(command, stdin=stdin)
+		process.communicate()
+	elif verbose:
+		# several jobs share the terminal, so the messages are captured and labelled with the file instead.
+		process = startCommand(command, stdin=stdin, stdout=PIPE, stderr=STDOUT)
+		popenOutput = process.communicate()[0]
+		for line in popenOutput.splitlines():
+			say(line)
 	else:
 		# capturing standard output from command instead
-		popenOutput = Popen(popenString, shell=True, stdout=PIPE, stderr=PIPE).communicate()[0]
-	
-	popenInfo = StringIO.StringIO(popenOutput)
-# 	print popenOutput
-# 	for i in popenInfo:
-# 		print i
-	
-	return popenInfo
-	
+		process = startCommand(command, stdin=stdin, stdout=PIPE, stderr=PIPE)
+		popenOutput = process.communicate()[0]
 
-def gracefulExit():
-	# exiting program gracefully instead of messing up try statements and continuing on to process other files.
-	# may want to delete the tempfile here.
-	sys.exit()
-	
+	return StringIO.StringIO(popenOutput), finishCommand(process, command)
 
-if __name__ == "__main__":
-	# getting the command line options from the parser
-	(options,args)= getCmdLineArgs()
-	
-	if not options.inFile:
-		print("Error: you must supply an input file (--input).  \nType 'audio_conv.py -h' for help")
-		sys.exit()
-	
-	topDir, wildCard = os.path.split(options.inFile)
-	absTopDir = os.path.abspath(topDir)
-	baseName = os.path.splitext(wildCard)[0]
-	wildCardExt = os.path.splitext(wildCard)[1]
-	if len(topDir) == 0:
-		topDir = "."
-	
+# The standard output of a command, a line at a time as the command writes it, for the tag parsers.  The lines are
+# shown too with verbose.
+def commandLines(command, verbose=False):
+	process = startCommand(command, stdout=PIPE, stderr=open(os.devnull, "w"))
+	try:
+		for line in iter(process.stdout.readline, ""):
+			if verbose:
+				say(line.rstrip("\n"))
+			yield line
+	finally:
+		process.stdout.close()
+		finishCommand(process, command)
 
-	# The file(s) to process if not doing the recursive thing.  Glob handles wildcards
-	# but you have to use quotes in *nix.
-	filesToProcess = []
-	for possibleFile in glob.glob(options.inFile):
-		if os.path.isfile(possibleFile):
-			filesToProcess.append(possibleFile)
-		elif not os.path.isdir(possibleFile):
-			print possibleFile, "not a regular file, skipping."
-	
-	# handling the recursive case, still using glob for wildcards.  Glob handles some paths poorly, so 
-	# chaning to those dirs and using glob to expand contents of each dir.
-	workingDir = os.getcwd()
-	os.chdir(absTopDir)
-	if options.recursive:
-		# walking the present working dir, since we've changed to that dir.
-		for directories, subdirs, files in os.walk("."):
-			for subdir in subdirs:
-				subDirPath = os.path.join(directories, subdir)
-				
-				# changing directory to the dirPath, because glob will fail on
-				# directories with square brackets in the path.
-				os.chdir(subDirPath)
-				
-				for file in glob.glob(wildCard):
-					#only want real files and links	
-					if os.path.isfile(file):
-						# 'file' is just the filename, joining with the path and appending to list
-						# of files to process.
-						absFilePath = os.path.join(topDir, directories, subdir, file)
-						
-						# cleansing the path with normpath to make it easier for mplayer and such.
-						absFilePath = os.path.normpath(absFilePath)
-						
-						filesToProcess.append(absFilePath)
-				
-				# changing back to the parent directory of recursion for looping in other dirs.
-				os.chdir(absTopDir)
-				
-	# returning to the original directory
-	os.chdir(workingDir)
-
-
-	# Using os.system line calls for all the heavy lifting
-	for file in filesToProcess:
-		# unix specific way of being able to read files with double quotes.
-		# Fine since double quotes are not allowed in windows.
-		file = file.replace('"', '\\"')
-		
-		# user defined tempfile location for the pcm file.
-		# mplayer decoding uses a special tempfile for windows.
-		if options.tempFile:
-			tempFile = options.tempFile
+# running an encoder that reads its wav from standard input, writing the pieces of pcmFeed to it.
+def runPopenFeed(command, verbose, pcmFeed):
+	if verbose and not jobLabel:
+		captured = None
+		process = startCommand(command, stdin=PIPE)
+	else:
+		# the messages go to a file rather than a pipe, so the encoder can't block on them while it is being fed.
+		captured = TemporaryFile()
+		process = startCommand(command, stdin=PIPE, stdout=captured, stderr=STDOUT)
+
+	try:
+		for data in pcmFeed:
+			process.stdin.write(data)
+	except IOError:
+		# the encoder stopped reading, its exit status tells what happened.
+		pass
+	finally:
+		pcmFeed.close()
+		process.stdin.close()
+	finishCommand(process, command)
+
+	if captured and verbose:
+		captured.seek(0)
+		for line in captured:
+			say(line.rstrip("\n"))
+	return process.returncode
+
+# Feeding the same wav to several outputs at once (with --target): encoders reading it from standard input, given as
+# commands, and wav outputs given as the path to write.  An output that stops reading is left out of the rest of the
+# feed.  Returns the exit status of each output.
+def runTeeFeed(commands, verbose, pcmFeed):
+	sinks = []
+	for command in commands:
+		if isinstance(command, basestring):
+			sinks.append((command, None, open(command, "wb"), None))
 		else:
-			tempFile = NamedTemporaryFile().name
-	
-		# leave the taginfo file as a system tempfile
-		tagInfo = NamedTemporaryFile().name
-	
-	
+			# the messages go to a file rather than a pipe, so an encoder can't block on them while it is being fed.
+			captured = TemporaryFile()
+			process = startCommand(command, stdin=PIPE, stdout=captured, stderr=STDOUT)
+			sinks.append((command, process, process.stdin, captured))
 
-		# metadata tags and input bitrate value
-		tagName = ""
-		tagAuthor = ""
-		tagGenre = ""
-		tagDate = ""
-		tagAlbum = ""
-		inBitrate = ""
-		
-		# need to know output extension to see if conversion can be skipped with badBitrate().
-		if options.oggOutput:
-			outFileExtension = ".ogg"
-		elif options.mp3Output:
-			outFileExtension = ".mp3"
-		elif options.wavOutput:
-			outFileExtension = ".wav"
-		elif options.flacOutput:
-			outFileExtension = ".flac"
+	statuses = [0] * len(sinks)
+	feeding = range(len(sinks))
+	try:
+		for data in pcmFeed:
+			for index in feeding[:]:
+				try:
+					sinks[index][2].write(data)
+				except IOError:
+					# the encoder stopped reading (its exit status tells what happened), or the wav can't be written.
+					feeding.remove(index)
+					if not sinks[index][1]:
+						statuses[index] = 1
+			if not feeding:
+				break
+	finally:
+		pcmFeed.close()
+		for command, process, sink, captured in sinks:
+			try:
+				sink.close()
+			except IOError:
+				pass
+
+	for index, (command, process, sink, captured) in enumerate(sinks):
+		if process:
+			statuses[index] = finishCommand(process, command)
+			if verbose:
+				captured.seek(0)
+				for line in captured:
+					say(line.rstrip("\n"))
+	return statuses
+
+# the pieces the wav is fed to several outputs in, from a decoder's standard output or from a file.
+TEE_BLOCK = 256 * 1024
+
+def decodedPieces(command):
+	decoder = startCommand(command, stdout=PIPE, stderr=open(os.devnull, "w"))
+	try:
+		for data in iter(lambda: decoder.stdout.read(TEE_BLOCK), ""):
+			yield data
+	finally:
+		decoder.stdout.close()
+		finishCommand(decoder, command)
+	if decoder.returncode:
+		raise RuntimeError("decoder failed (exit status %d)" % decoder.returncode)
+
+def filePieces(path):
+	pcmFile = open(path, "rb")
+	try:
+		for data in iter(lambda: pcmFile.read(TEE_BLOCK), ""):
+			yield data
+	finally:
+		pcmFile.close()
+
+# Runs an encoder and returns its exit status.  With a decoder, the encoder reads the decoder's standard output
+# (or the fifo the decoder writes, for mplayer).  The decoder is a process of its own so a failing decoder fails the
+# encode too, and so it can be stopped if the encoder gives up before reading everything.
+def runEncoder(command, verbose, pcmFeed=None, decoder=None, fifo=False):
+	if pcmFeed:
+		return runPopenFeed(command, verbose, pcmFeed)
+	if not decoder:
+		return runPopenStatus(command, verbose)[1]
+
+	decoderMessages = None
+	if not verbose or jobLabel:
+		decoderMessages = open(os.devnull, "w")
+	if fifo:
+		decoderProcess = startCommand(decoder, stdout=decoderMessages, stderr=STDOUT)
+	else:
+		decoderProcess = startCommand(decoder, stdout=PIPE, stderr=decoderMessages)
+
+	status = None
+	try:
+		status = runPopenStatus(command, verbose, decoderProcess.stdout)[1]
+	finally:
+		if decoderProcess.stdout:
+			decoderProcess.stdout.close()
+		# A decoder still running when the encoder is done won't finish by itself: mplayer keeps waiting for a fifo
+		# the encoder never opened.  After a moment (for a decoder that is just exiting) it is stopped, which fails
+		# the file.
+		if status == 0:
+			waitUntil = time.time() + 2
+			while decoderProcess.poll() is None and time.time() < waitUntil:
+				time.sleep(0.05)
+		if decoderProcess.poll() is None:
+			decoderProcess.terminate()
+		finishCommand(decoderProcess, decoder)
+		if decoderMessages:
+			decoderMessages.close()
+
+	if status:
+		return status
+	return decoderProcess.returncode
+
+# a file name for a command line.  A name starting with - would be taken for an option (or "-" for standard input).
+def commandPath(path):
+	if path.startswith("-"):
+		return os.path.join(os.curdir, path)
+	return path
+
+# a decoder writing wav to standard output, for the formats that have one.
+def pcmStreamCommand(file, inFileExtension):
+	if inFileExtension == ".mp3":
+		return [LAME, "--decode", file, "-"]
+	elif inFileExtension == ".ogg":
+		return [OGGDEC, "-Q", file, "-o", "-"]
+	elif inFileExtension == ".flac":
+		return [FLAC, "-s", "--decode", "--stdout", file]
+	return None
+
+# mplayer's pcm file suboption.  The %length% form takes the name as it is, colons and commas included.
+def mplayerPcmOption(tempFile):
+	return "pcm:file=%%%d%%%s" % (len(tempFile), tempFile)
+
+# asking mplayer for the stream info without decoding anything.
+def mplayerInfoCommand(file):
+	return [MPLAYER, "-quiet", "-nolirc", "-nojoystick", "-frames", "0", "-ao", "null", "-vo", "null", "-vc", "dummy", file]
+
+def mplayerDecodeCommand(file, tempFile, *extra):
+	# newer syntax for newer version of mplayer (1.0pre7-3.4.2) and dos/win compatible:
+	return [MPLAYER] + list(extra) + ["-quiet", "-nolirc", "-nojoystick", "-ao", mplayerPcmOption(tempFile), \
+		"-vo", "null", "-vc", "dummy", file]
+
+# Routing: how a file gets from its input format to the output.  "direct" has the encoder read the input file itself
+# (or copies a wav as it is), "piped" streams the decoder's wav into the encoder and "wav" decodes to a tempfile
+# first.  pickRoute() takes the first of them that works for the file and the options.  A new input format needs a
+# decoder below, and any pair its encoder reads without one goes in DIRECT_ROUTES.
+ROUTES = ("direct", "piped", "wav")
+
+# the decoders of an input format: the command writing the wav to the tempfile, the one writing it to standard
+# output (or to a fifo, for mplayer) and whether that is a fifo.
+def lameDecoders(file, tempFile):
+	return [LAME, "--decode", file, tempFile], pcmStreamCommand(file, ".mp3"), False
+
+def oggdecDecoders(file, tempFile):
+	return [OGGDEC, file, "-o", tempFile], pcmStreamCommand(file, ".ogg"), False
+
+def flacDecoders(file, tempFile):
+	return [FLAC, "-f", "--decode", file, "-o", tempFile], pcmStreamCommand(file, ".flac"), False
+
+def mplayerDecoders(file, tempFile):
+	# mplayer can't write wav to standard output (it prints its messages there), so it streams through a fifo.
+	streamCommand = None
+	if os.name != 'nt':
+		streamCommand = [MPLAYER, "-really-quiet", "-nolirc", "-nojoystick", "-ao", mplayerPcmOption(tempFile), \
+			"-vo", "null", "-vc", "dummy", file]
+	return mplayerDecodeCommand(file, tempFile), streamCommand, True
+
+DECODERS = {".mp3": lameDecoders, ".ogg": oggdecDecoders, ".flac": flacDecoders, ".wma": mplayerDecoders, \
+	".rm": mplayerDecoders, ".ra": mplayerDecoders}
+
+# the (input, output) pairs that need no decoder, with the options the encoder needs for the input.
+DIRECT_ROUTES = {
+	(".flac", ".ogg"): (),
+	(".flac", ".flac"): (),
+	(".mp3", ".mp3"): ("--mp3input",),
+	(".wav", ".ogg"): (),
+	(".wav", ".mp3"): (),
+	(".wav", ".flac"): (),
+	(".wav", ".wav"): ()}
+
+def pickRoute(inFileExtension, outFileExtension, streamCommand, streamFifo, options, fanout=False):
+	# anything normalized, converted (--rate, --channels, --bits) or going to several outputs (--target) needs the
+	# decoded audio.  (A file converted to itself is fine, the output replaces it only once it is complete.)
+	if options.direct and not options.normalize and not options.pcmTarget and not fanout and \
+		(inFileExtension, outFileExtension) in DIRECT_ROUTES:
+		return "direct"
+	if not streamCommand or not options.stream:
+		return "wav"
+	# normalize-audio rewrites the wav in place, so it needs a real (seekable) file, and so does measuring a single
+	# file for the built in normalization.  In album mode the gain is already known and the decoder output is fed
+	# through it to the encoder, which a fifo can't do.  A wav output is written by the decoder itself.
+	if options.normalize:
+		if options.normalizeMode != "external" and options.album and not streamFifo:
+			return "piped"
+		return "wav"
+	# the decoder output is converted (or teed) on its way to the encoders, from a pipe only.
+	if streamFifo and (outFileExtension == ".wav" or options.pcmTarget or fanout):
+		return "wav"
+	return "piped"
+
+# the route a planned job will take, for the dry run.  A playlist stream is always decoded to a tempfile.
+def plannedRoute(job, options):
+	inFileExtension = os.path.splitext(job.source.lower())[1]
+	outFileExtension = os.path.splitext(job.output)[1].lower()
+	if job.stream:
+		return "wav"
+	streamCommand, streamFifo = None, False
+	if inFileExtension in DECODERS:
+		streamCommand, streamFifo = DECODERS[inFileExtension](job.source, "-")[1:]
+	return pickRoute(inFileExtension, outFileExtension, streamCommand, streamFifo, options, bool(job.fanout))
+
+# the command line for a planned encoder, with the placeholders filled in from values.
+def encoderCommand(encoder, values):
+	return [values.get(arg, arg) for arg in encoder]
+
+# Native tag and stream info readers.  These read the headers of flac, ogg vorbis, mp3 and wav files directly, which
+# is a lot quicker than starting a tag program for every file and gives the tag values exactly as they are stored.
+# readAudioInfo() returns a dictionary with the tags (title, artist, genre, date, album, as utf-8 strings), the
+# bitrate (as the tag programs would report it) and whatever stream info the format has (duration in seconds,
+# sampleRate, channels, bitsPerSample, and md5 for flac).  It returns None for anything it can't read, in which
+# case the tag programs are used instead.
+
+# mpeg audio bitrates in kbps, by [mpeg 1 or 2][layer] and the bitrate index of the frame header.
+MPEG_BITRATES = {
+	(1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+	(1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+	(1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+	(2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+	(2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+	(2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# sample rates by the version bits of the frame header (mpeg 2.5, reserved, mpeg 2, mpeg 1).
+MPEG_SAMPLE_RATES = {0: (11025, 12000, 8000), 2: (22050, 24000, 16000), 3: (44100, 48000, 32000)}
+
+# names of the tags in vorbis comments, id3v2 frames (2.3/2.4 and 2.2) and wav INFO chunks.
+VORBIS_TAGS = {"TITLE": "title", "ARTIST": "artist", "GENRE": "genre", "DATE": "date", "ALBUM": "album"}
+ID3_TAGS = {"TIT2": "title", "TPE1": "artist", "TCON": "genre", "TYER": "date", "TDRC": "date", "TALB": "album", \
+	"TT2": "title", "TP1": "artist", "TCO": "genre", "TYE": "date", "TAL": "album"}
+WAV_TAGS = {"INAM": "title", "IART": "artist", "IGNR": "genre", "ICRD": "date", "IPRD": "album"}
+
+def readAudioInfo(file):
+	readers = {".flac": readFlacInfo, ".ogg": readOggInfo, ".mp3": readMp3Info, ".wav": readWavInfo}
+	reader = readers.get(os.path.splitext(file)[1].lower())
+	if not reader:
+		return None
+
+	info = {"title": "", "artist": "", "genre": "", "date": "", "album": "", "bitrate": ""}
+	try:
+		audioFile = open(file, "rb")
+		try:
+			reader(audioFile, info)
+		finally:
+			audioFile.close()
+	except (KeyboardInterrupt, SystemExit):
+		gracefulExit()
+	except:
+		return None
+	return info
+
+# the tags in the same order as ogginfoTags() returns them.
+def infoTags(info):
+	return info["title"], info["artist"], info["genre"], info["date"], info["album"], info["bitrate"]
+
+def vorbisComments(data, info):
+	vendorLength = struct.unpack("<I", data[0:4])[0]
+	offset = 4 + vendorLength
+	count = struct.unpack("<I", data[offset:offset + 4])[0]
+	offset += 4
+	for i in range(count):
+		length = struct.unpack("<I", data[offset:offset + 4])[0]
+		comment = data[offset + 4:offset + 4 + length]
+		offset += 4 + length
+		key, sep, value = comment.partition("=")
+		name = VORBIS_TAGS.get(key.upper())
+		# the first value wins if a tag is there more than once.
+		if name and not info[name]:
+			info[name] = value
+
+def readFlacInfo(audioFile, info):
+	skipId3v2(audioFile)
+	if audioFile.read(4) != "fLaC":
+		raise ValueError("not a flac file")
+
+	lastBlock = False
+	while not lastBlock:
+		header = audioFile.read(4)
+		lastBlock = ord(header[0]) & 0x80
+		blockType = ord(header[0]) & 0x7f
+		length = struct.unpack(">I", "\0" + header[1:4])[0]
+		if blockType == 0:
+			# STREAMINFO: 20 bits sample rate, 3 bits channels, 5 bits sample size and 36 bits total samples.
+			block = audioFile.read(length)
+			bits = struct.unpack(">Q", block[10:18])[0]
+			info["sampleRate"] = bits >> 44
+			info["channels"] = ((bits >> 41) & 0x7) + 1
+			info["bitsPerSample"] = ((bits >> 36) & 0x1f) + 1
+			totalSamples = bits & 0xfffffffff
+			if totalSamples and info["sampleRate"]:
+				info["duration"] = float(totalSamples) / info["sampleRate"]
+			info["md5"] = block[18:34].encode("hex")
+		elif blockType == 4:
+			vorbisComments(audioFile.read(length), info)
 		else:
-			print "Error: Audio output format not chosen, please select one."
-			break	
-		
-		# using the file extension to determine what format it is (there could be a better way,
-		# something like the unix command 'file')
-		# converting all to lower case for simplicity
-		fileCaseless = file.lower()
-		inFileExtension = os.path.splitext(fileCaseless)[1]
-		
-		# Dry run, not doing conversion.  Just listing files to be precessed
-		if options.dryRun:
-			if file == filesToProcess[0]:
-				print "Dry run file(s) to process, and new output file(s):"
-		
-		# converting everything to a wav file, and getting the tag data
-		elif inFileExtension == ".mp3":
-			print "decoding:" + file
-			
-			# using mp3info because it gives a lot of nice options for formatting of tag output.
-			# formatting so I can use ogginfoTags to parse the info.  Using popen to subprocess.Popen to drive command line
-			popenString = ('%s %s "%s"' % (MP3INFO, '-x -r m -p "title=%t \\nartist=%a \\ngenre=%g \\ndate=%y \\nalbum=%l\\n \\nNominal bitrate: %r\\n"', file))
-			# tagInfo captures stdout and stderr from mp3info, stores as a string.
-			tagInfo = runPopen(popenString, verbose=False)
-			
-			# using ogginfoTags to parse the tag info.  Maybe I should rename it.
-			tagName, tagAuthor, tagGenre, tagDate, tagAlbum, inBitrate = ogginfoTags(tagInfo)
-			
-			if badBitrate(file, inBitrate, options, inFileExtension, outFileExtension):
-				continue
-			
-			# decoding mp3 with lame
-			decodeString = ('%s --decode "%s" "%s"' % (LAME, file, tempFile))
-			runPopen(decodeString, options.verbose)
-			
-		elif inFileExtension in (".wma", ".rm", ".ra"):
-			print "decoding:" + file
-			
-			# converting from wma to wav
-			# the 'pcm -aofile <filename>' options has changed to '-ao pcm:file=<filename>'
-			# which doesn't like dos filenames! (c:\bla\...) so I'm changing the tempfile path to
-			# point to the working directory.  Also letting user set a tempfile location with a CLI option.
-			if (os.name == 'nt' and not options.tempFile):
-				tempFile = os.path.basename(tempFile)
-			
-			# newer syntax for newer version of mplayer (1.0pre7-3.4.2) and dos/win compatible:
-			popenString = ('%s -quiet -nolirc -nojoystick -ao pcm:file="%s" -vo null -vc dummy "%s"' % (MPLAYER, tempFile, file))
-			
-# 			# older syntax, for mplayer 1.0pre5-3.3.4 and similar
-# 			popenString = ('%s -quiet -nolirc -nojoystick -ao pcm -aofile "%s" -vo null -vc dummy "%s"' % (MPLAYER, tempFile, file))
+			# padding, seek tables, pictures and so on.
+			audioFile.seek(length, 1)
 
-			tagInfo = runPopen(popenString, verbose=False)
-			
-			if options.verbose:
-				for line in tagInfo:
-					line = line.replace("\n", "")
-					print line
+def oggPackets(audioFile, wanted):
+	# the first 'wanted' packets of the first logical stream.  The comment packet can span several pages.
+	packets = []
+	packet = ""
+	while len(packets) < wanted:
+		header = audioFile.read(27)
+		if header[0:4] != "OggS":
+			raise ValueError("not an ogg page")
+		segments = [ord(c) for c in audioFile.read(ord(header[26]))]
+		data = audioFile.read(sum(segments))
+		offset = 0
+		for size in segments:
+			packet += data[offset:offset + size]
+			offset += size
+			# a segment shorter than 255 bytes ends the packet.
+			if size < 255:
+				packets.append(packet)
+				packet = ""
+	return packets[:wanted]
 
-			# getting tag info from the info file created by mplayer in the last step.
-			tagName, tagAuthor, inBitrate = mplayerTags(tagInfo)
-			
-			if badBitrate(file, inBitrate, options, inFileExtension, outFileExtension):
-				continue
+def readOggInfo(audioFile, info):
+	ident, comments = oggPackets(audioFile, 2)
+	if ident[0:7] != "\x01vorbis" or comments[0:7] != "\x03vorbis":
+		raise ValueError("not an ogg vorbis file")
 
-		elif inFileExtension == ".rpm":
-			readFile = open(file)
-			readLines = readFile.readlines()
-			for stream in readLines :
-				print "decoding stream:" + stream
-				
-				# only process non blank lines
-				if len(stream) == 0:
-					continue
-				
-#				os.system( '%s -cache 1280 -dumpstream -dumpfile essselection.ra %s' \
-#					% (MPLAYER, stream))
-
-				# syntax for newer mplayer, see above section for .wma files for older syntax
-        			if (os.name == 'nt' and not options.tempFile):
-        				tempFile = os.path.basename(tempFile)
-
-
-
-				# new mplayer syntax (not tested yet! get appropriate file to test)
-				popenString = ('%s -cache 1280 -quiet -nolirc -nojoystick -ao pcm:file="%s" -vo null -vc dummy "%s"' % (MPLAYER, tempFile, stream))
-				## old mplayer syntax
-				#popenString = ('%s -cache 1280 -quiet -nolirc -nojoystick -ao pcm -aofile="%s" -vo null -vc dummy "%s"' % (MPLAYER, tempFile, stream))
-				
-				tagInfo = runPopen(popenString, verbose=False)
-				
-				if options.verbose:
-					for line in tagInfo:
-						line = line.replace("\n", "")
-						print line
-					
-				tagName, tagAuthor, inBitrate = mplayerTags(tagInfo)
-
-			if badBitrate(file, inBitrate, options, inFileExtension, outFileExtension):
-				continue
-			
-		elif inFileExtension == ".ogg":
-			print "decoding:" + file
+	channels, sampleRate, maxBitrate, nominalBitrate = struct.unpack("<BIii", ident[11:24])
+	info["channels"] = channels
+	info["sampleRate"] = sampleRate
+	# ogginfo leaves the bitrate out when the encoder didn't set it.
+	if nominalBitrate > 0:
+		info["bitrate"] = "%f" % (nominalBitrate / 1000.0)
+	vorbisComments(comments[7:], info)
 
-			# getting tag info
-			popenTagString = ('%s "%s"' % (OGGINFO, file))
-			tagInfo = runPopen(popenTagString, verbose=False)
-			
-			tagName, tagAuthor, tagGenre, tagDate, tagAlbum, inBitrate = ogginfoTags(tagInfo)
-			
-			if badBitrate(file, inBitrate, options, inFileExtension, outFileExtension):
-				continue
-			
-			# converting ogg to wav
-			popenString = ('%s "%s" -o "%s"' % (OGGDEC, file, tempFile))
-			encodeInfo = runPopen(popenString, options.verbose)
+	# the granule position of the last page is the number of samples in the stream.
+	audioFile.seek(0, 2)
+	fileSize = audioFile.tell()
+	audioFile.seek(max(0, fileSize - 65536))
+	tail = audioFile.read()
+	lastPage = tail.rfind("OggS")
+	if lastPage >= 0 and len(tail) >= lastPage + 14:
+		granule = struct.unpack("<q", tail[lastPage + 6:lastPage + 14])[0]
+		if granule > 0 and sampleRate:
+			info["duration"] = float(granule) / sampleRate
 
-		elif inFileExtension == ".flac":
-			print "decoding:" + file
-			
-			# decoding from flac to wav
-			popenString = ('%s -f --decode "%s" -o "%s"' % (FLAC, file, tempFile))
-			encodeInfo = runPopen(popenString, options.verbose)
-			
-			
-			try:
-				# using metaflac to extract the tags from the flac file
-				popenTagString = ('%s --show-tag=TITLE --show-tag=ARTIST --show-tag=ALBUM --show-tag=DATE --show-tag=GENRE "%s"' \
-																% (METAFLAC, file))
-				# verbose is false because we want to capture the standard output instead of letting it go to the terminal.
-				# metaflac is quick, so it can be run again if the verbose option is given.
-				tagInfo = runPopen(popenTagString, verbose=False)
-				
-				# we can use ogginfoTags to parse the tag info file since its almost the same format.
-				tagName, tagAuthor, tagGenre, tagDate, tagAlbum, inBitrate = ogginfoTags(tagInfo)
-				
-			# this except statement is for handling control-c from command line.  Otherwise if control-c is hit, 
-			# the other except will be run.  This allows the program to exit normally.
-			except (KeyboardInterrupt, SystemExit):
-        			gracefulExit()
-			except:
-				print "No tags in flac file"
-			
-		elif inFileExtension == ".wav":
-			# if its already a wave, leave it as is.
-			tempFile = file
+def skipId3v2(audioFile):
+	# leaving the file just after an id3v2 tag (if it has one), and returning the tag.
+	header = audioFile.read(10)
+	if header[0:3] != "ID3":
+		audioFile.seek(-len(header), 1)
+		return None
+	size = syncsafe(header[6:10])
+	# a footer adds another 10 bytes.
+	if ord(header[5]) & 0x10:
+		size += 10
+	return header + audioFile.read(size)
+
+def syncsafe(data):
+	value = 0
+	for c in data:
+		value = (value << 7) | (ord(c) & 0x7f)
+	return value
+
+def id3Text(data):
+	encoding = ord(data[0])
+	text = data[1:]
+	if encoding == 0:
+		text = text.decode("latin-1")
+	elif encoding == 1:
+		text = text.decode("utf-16")
+	elif encoding == 2:
+		text = text.decode("utf-16-be")
+	else:
+		text = text.decode("utf-8")
+	# several values are separated by nul characters, keeping the first one.
+	return text.split(u"\0")[0].strip().encode("utf-8")
+
+def id3Genre(genre):
+	# genres can be given as an index in the id3v1 genre list, eg. "(17)" or "17".
+	index = genre.strip("()")
+	if genre and index.isdigit():
+		if int(index) < len(genreList):
+			return genreList[int(index)]
+		return ""
+	return genre
+
+def readId3v2(tag, info):
+	version = ord(tag[3])
+	flags = ord(tag[5])
+	data = tag[10:]
+	# unsynchronisation of the whole tag (id3v2.3 and older).
+	if flags & 0x80 and version < 4:
+		data = data.replace("\xff\x00", "\xff")
+	offset = 0
+	# skipping the extended header.
+	if flags & 0x40:
+		if version == 3:
+			offset = 4 + struct.unpack(">I", data[0:4])[0]
+		elif version == 4:
+			offset = syncsafe(data[0:4])
+
+	if version == 2:
+		idLength, headerLength = 3, 6
+	else:
+		idLength, headerLength = 4, 10
+	while offset + headerLength <= len(data):
+		frameId = data[offset:offset + idLength]
+		if not frameId.strip("\0"):
+			# padding
+			break
+		if version == 2:
+			size = struct.unpack(">I", "\0" + data[offset + 3:offset + 6])[0]
+		elif version == 3:
+			size = struct.unpack(">I", data[offset + 4:offset + 8])[0]
 		else:
-			print "Error processing file: " + file
-			print "input format not recognized, please check file extension."
-			continue
-		
-		
-		# checking the genre tag to make sure its acceptable for Lame and other encoders (got listing from id3v2)
-		# should probably have dictionary in a different file, but its nice to have everything in one script.
-		
-		# Testing the genre tag.  Ignoring the 'genre as number' case.  Not trying to handle crazy cases.
-		# Genre list generated by id3v2 program with -L option ('Bebob' looks like a typo but 'Bebop' wont work with Lame).
-		genreList = ('Blues', 'Classic Rock', 'Country', 'Dance', 'Disco', 'Funk', 'Grunge', 'Hip-Hop', \
-			'Jazz', 'Metal', 'New Age', 'Oldies', 'Other', 'Pop', 'R&B', 'Rap', 'Reggae', 'Rock', 'Techno', \
-			'Industrial', 'Alternative', 'Ska', 'Death Metal', 'Pranks', 'Soundtrack', 'Euro-Techno', \
-			'Ambient', 'Trip-Hop', 'Vocal', 'Jazz+Funk', 'Fusion', 'Trance', 'Classical', 'Instrumental', \
-			'Acid', 'House', 'Game', 'Sound Clip', 'Gospel', 'Noise', 'Alt. Rock', 'Bass', 'Soul', 'Punk', \
-			'Space', 'Meditative', 'Instrum. Pop', 'Instrum. Rock', 'Ethnic', 'Gothic', 'Darkwave', \
-			'Techno-Indust.', 'Electronic', 'Pop-Folk', 'Eurodance', 'Dream', 'Southern Rock', 'Comedy', \
-			'Cult', 'Gangsta', 'Top 40', 'Christian Rap', 'Pop/Funk', 'Jungle', 'Native American', \
-			'Cabaret', 'New Wave', 'Psychadelic', 'Rave', 'Showtunes', 'Trailer', 'Lo-Fi', 'Tribal', \
-			'Acid Punk', 'Acid Jazz', 'Polka', 'Retro', 'Musical', 'Rock & Roll', 'Hard Rock', 'Folk', \
-			'Folk/Rock', 'National Folk', 'Swing', 'Fusion', 'Bebob', 'Latin', 'Revival', 'Celtic', \
-			'Bluegrass', 'Avantgarde', 'Gothic Rock', 'Progress. Rock', 'Psychadel. Rock', 'Symphonic Rock', \
-			'Slow Rock', 'Big Band', 'Chorus', 'Easy Listening', 'Acoustic', 'Humour', 'Speech', 'Chanson', \
-			'Opera', 'Chamber Music', 'Sonata', 'Symphony', 'Booty Bass', 'Primus', 'Porn Groove', 'Satire', \
-			'Slow Jam', 'Club', 'Tango', 'Samba', 'Folklore', 'Ballad', 'Power Ballad', 'Rhythmic Soul', \
-			'Freestyle', 'Duet', 'Punk Rock', 'Drum Solo', 'A Capella', 'Euro-House', 'Dance Hall', 'Goa', \
-			'Drum & Bass', 'Club-House', 'Hardcore', 'Terror', 'Indie', 'BritPop', 'Negerpunk', 'Polsk Punk', \
-			'Beat', 'Christian Gangsta Rap', 'Heavy Metal', 'Black Metal', 'Crossover', 'Contemporary Christian', \
-			'Christian Rock', 'Merengue', 'Salsa', 'Thrash Metal', 'Anime', 'Jpop', 'Synthpop')
-		
-		# skipping these steps if its a dry run
-		if not options.dryRun:
-			# discarding anything not in the list of genres.
-			if tagGenre not in genreList:
-				tagGenre = ""
-			
-			# If there is no title tag, set it to the filename (without extension).  Otherwise the file will show nothing in XMMS.
-			# Must test this, crazy filenames might cause problems with some encoders.
-			if not tagName:
-				print "No title tag, setting the title of song to the filename"
-				filePathless = os.path.split(file)[1]
-				fileBaseName = os.path.splitext(filePathless)[0]
-				
-				tagName = fileBaseName
-			
-			# setting the bitrate of the output file the same as the input file unless
-			# a bitrate is specified as an option.  Bitrate not used for wav or flac.
-			if not options.bitrate and not (options.wavOutput or options.flacOutput):
-				try:
-					# nasty syntax but handles casting of the string 128.0000 to an int (example).
-					options.bitrate = int(float(inBitrate))
-					
-				except (KeyboardInterrupt, SystemExit):
-					gracefulExit()
-				
-				except:
-					print "cannot determine bitrate of input, setting output to 128 kbps."
-					options.bitrate = 128
-			if options.encodeOption:
-				options.bitrate = None
-				print "Custom encoder options specified, ignoring bitrate option if specified."
-			
-			
-			# optional normalization of the wav file
-			if options.normalize:
-				print "normalizing intermediate wav file"
-				normalizeString = ('%s "%s"' % (NORMALIZE, tempFile))
-				normalizeInfo = runPopen(normalizeString, options.verbose)
-				
-			
-		# setting the output filename by replacing the extension with the new one determined by the 
-		# output format option.
-		if options.destDir:
-			# using the destinationDir function to handle making new directories and the new path names.
-			# dont want to make new directories if its only a dry run.
-			newOutFilePath = destinationDir(file, options.destDir, options.dryRun)
-				
-			outFile = os.path.splitext(newOutFilePath)[0] + outFileExtension
+			size = syncsafe(data[offset + 4:offset + 8])
+		frame = data[offset + headerLength:offset + headerLength + size]
+		offset += headerLength + size
+
+		name = ID3_TAGS.get(frameId)
+		if name and frame and not info[name]:
+			# per frame unsynchronisation in id3v2.4
+			if version == 4 and ord(data[offset - size - 1]) & 0x02:
+				frame = frame.replace("\xff\x00", "\xff")
+			value = id3Text(frame)
+			if name == "genre":
+				value = id3Genre(value)
+			if name == "date":
+				value = value[0:4]
+			info[name] = value
+
+def readId3v1(audioFile, info):
+	audioFile.seek(-128, 2)
+	tag = audioFile.read(128)
+	if tag[0:3] != "TAG":
+		return False
+
+	fields = {"title": tag[3:33], "artist": tag[33:63], "album": tag[63:93], "date": tag[93:97]}
+	for name, value in fields.items():
+		if not info[name]:
+			info[name] = value.split("\0")[0].strip().decode("latin-1").encode("utf-8")
+	if not info["genre"] and ord(tag[127]) < len(genreList):
+		info["genre"] = genreList[ord(tag[127])]
+	return True
+
+def readMp3Info(audioFile, info):
+	tag = skipId3v2(audioFile)
+	if tag:
+		readId3v2(tag, info)
+	audioStart = audioFile.tell()
+	audioFile.seek(0, 2)
+	fileSize = audioFile.tell()
+	if fileSize >= 128 and readId3v1(audioFile, info):
+		fileSize -= 128
+
+	# looking for the first frame header, there may be some junk before it.
+	audioFile.seek(audioStart)
+	data = audioFile.read(65536)
+	offset = 0
+	while True:
+		offset = data.find("\xff", offset)
+		if offset < 0 or offset + 4 > len(data):
+			raise ValueError("no mpeg frame found")
+		header = struct.unpack(">I", data[offset:offset + 4])[0]
+		versionBits = (header >> 19) & 0x3
+		layer = 4 - ((header >> 17) & 0x3)
+		bitrateIndex = (header >> 12) & 0xf
+		rateIndex = (header >> 10) & 0x3
+		if (header >> 21) == 0x7ff and versionBits != 1 and layer != 4 and 0 < bitrateIndex < 15 and rateIndex < 3:
+			break
+		offset += 1
+
+	version = 1
+	if versionBits != 3:
+		version = 2
+	sampleRate = MPEG_SAMPLE_RATES[versionBits][rateIndex]
+	frameBitrate = MPEG_BITRATES[(version, layer)][bitrateIndex]
+	mono = ((header >> 6) & 0x3) == 3
+	samplesPerFrame = 1152
+	if layer == 1:
+		samplesPerFrame = 384
+	elif layer == 3 and version == 2:
+		samplesPerFrame = 576
+	info["sampleRate"] = sampleRate
+	info["channels"] = 1
+	if not mono:
+		info["channels"] = 2
+
+	# a xing (or lame 'Info') header after the side information, or a vbri header, has the number of frames and
+	# bytes of a vbr file.
+	sideInfo = 32
+	if version == 1 and mono:
+		sideInfo = 17
+	elif version == 2 and not mono:
+		sideInfo = 17
+	elif version == 2:
+		sideInfo = 9
+	frames = None
+	audioBytes = fileSize - audioStart - offset
+	xing = offset + 4 + sideInfo
+	vbri = offset + 36
+	if data[xing:xing + 4] in ("Xing", "Info"):
+		xingFlags = struct.unpack(">I", data[xing + 4:xing + 8])[0]
+		position = xing + 8
+		if xingFlags & 0x1:
+			frames = struct.unpack(">I", data[position:position + 4])[0]
+			position += 4
+		if xingFlags & 0x2:
+			audioBytes = struct.unpack(">I", data[position:position + 4])[0]
+	elif data[vbri:vbri + 4] == "VBRI":
+		audioBytes, frames = struct.unpack(">II", data[vbri + 10:vbri + 18])
+
+	if frames:
+		info["duration"] = float(frames) * samplesPerFrame / sampleRate
+		# the mean bitrate, the same as 'mp3info -r m'.
+		info["bitrate"] = "%d" % round(audioBytes * 8 / info["duration"] / 1000)
+	else:
+		info["duration"] = audioBytes * 8.0 / (frameBitrate * 1000)
+		info["bitrate"] = "%d" % frameBitrate
+
+def readWavInfo(audioFile, info):
+	header = audioFile.read(12)
+	if header[0:4] != "RIFF" or header[8:12] != "WAVE":
+		raise ValueError("not a wav file")
+
+	byteRate = None
+	dataSize = None
+	while True:
+		chunkHeader = audioFile.read(8)
+		if len(chunkHeader) < 8:
+			break
+		chunkId = chunkHeader[0:4]
+		size = struct.unpack("<I", chunkHeader[4:8])[0]
+		if chunkId == "fmt ":
+			chunk = audioFile.read(size)
+			channels, sampleRate, byteRate = struct.unpack("<HII", chunk[2:12])
+			info["channels"] = channels
+			info["sampleRate"] = sampleRate
+			info["bitsPerSample"] = struct.unpack("<H", chunk[14:16])[0]
+		elif chunkId == "LIST" and audioFile.read(4) == "INFO":
+			chunk = audioFile.read(size - 4)
+			offset = 0
+			while offset + 8 <= len(chunk):
+				infoId = chunk[offset:offset + 4]
+				infoSize = struct.unpack("<I", chunk[offset + 4:offset + 8])[0]
+				name = WAV_TAGS.get(infoId)
+				if name and not info[name]:
+					info[name] = chunk[offset + 8:offset + 8 + infoSize].split("\0")[0].strip()
+				offset += 8 + infoSize + (infoSize & 1)
+		elif chunkId == "LIST":
+			audioFile.seek(size - 4, 1)
+		elif chunkId == "data":
+			dataSize = size
+			audioFile.seek(size, 1)
 		else:
-			outFile = os.path.splitext(file)[0] + outFileExtension
-		
-		
-		# dry run, output info to terminal
-		bitrateStr = ""
-		if options.dryRun:
-			print "Input File:", file, "\nOutput File:", outFile
-		
-		# writing to an ogg file	
-		elif options.oggOutput:
-			print "encoding:", outFile
-			if options.bitrate:
-				bitrateStr = "-b " + str(options.bitrate)
-# 			# converting from wav to ogg with some tag info included
-			encodeString = ('%s -t "%s" -a "%s" -G "%s" -d "%s" -l "%s" %s %s "%s" -o "%s"' % \
-					(OGGENC, tagName, tagAuthor, tagGenre, tagDate, tagAlbum, bitrateStr, options.encodeOption, tempFile, outFile))
-			
-			runPopen(encodeString, options.verbose)
-					
-		elif options.mp3Output:
-			print "encoding:", outFile
-			if options.bitrate:
-				bitrateStr = "-b " + str(options.bitrate)
-			# converting wav to mp3
-			encodeString = ('%s --tt "%s" --ta "%s" --tg "%s" --ty "%s" --tl "%s" -h %s %s "%s" -o "%s"' % \
-				(LAME, tagName, tagAuthor, tagGenre, tagDate, tagAlbum, bitrateStr, options.encodeOption, tempFile, outFile))
-			
-			runPopen(encodeString, options.verbose)
-				
-				
-		elif options.wavOutput:
-			print "outputting:", outFile
-			# just copying the tempfile (wav) to the output filename - easy.
-			shutil.copyfile(tempFile, outFile)
-			
-		elif options.flacOutput:
-			print "encoding:", outFile
-			# writing out from wav to flac format.
-			encodeString = ('%s -f "%s" %s -o "%s"' % (FLAC, tempFile, options.encodeOption, outFile))
-			
-			runPopen(encodeString, options.verbose)
-			
-			## Updating tags with metaflac
-			flacTagString = ('%s --set-tag=TITLE="%s" --set-tag=ARTIST="%s" --set-tag=ALBUM="%s" --set-tag=DATE="%s" --set-tag=GENRE="%s" "%s"' \
-				% (METAFLAC, tagName, tagAuthor, tagAlbum, tagDate, tagGenre, outFile))
-			
-			runPopen(flacTagString, options.verbose)
+			audioFile.seek(size, 1)
+		# chunks are padded to an even length.
+		if size & 1:
+			audioFile.seek(1, 1)
+
+	if byteRate and dataSize is not None:
+		info["duration"] = float(dataSize) / byteRate
+
+# Built in normalization (needs numpy).  The pcm is measured in blocks, from a memory mapped wav or straight from a
+# decoder, and the gain is applied while the samples are fed to the encoder, so the wav is never rewritten.  The
+# rms mode aims for the same level as normalize-audio without letting the peaks clip, the peak mode just brings the
+# loudest sample up to (almost) full scale.
+PCM_BLOCK_FRAMES = 65536
+NORMALIZE_RMS_LEVEL = -12.0
+NORMALIZE_PEAK_LEVEL = -0.1
+
+def readWavHeader(pcmFile):
+	# reading everything up to the start of the samples, from a file or a pipe.
+	header = pcmFile.read(12)
+	if header[0:4] != "RIFF" or header[8:12] != "WAVE":
+		raise ValueError("not a wav stream")
+
+	wav = {"bits": 16, "channels": 2, "rate": 44100, "float": False}
+	while True:
+		chunkHeader = pcmFile.read(8)
+		if len(chunkHeader) < 8:
+			raise ValueError("no samples in wav stream")
+		header += chunkHeader
+		size = struct.unpack("<I", chunkHeader[4:8])[0]
+		if chunkHeader[0:4] == "data":
+			wav["dataSize"] = size
+			break
+
+		chunk = pcmFile.read(size + (size & 1))
+		header += chunk
+		if chunkHeader[0:4] == "fmt ":
+			formatTag, wav["channels"], wav["rate"] = struct.unpack("<HHI", chunk[0:8])
+			wav["bits"] = struct.unpack("<H", chunk[14:16])[0]
+			# WAVE_FORMAT_EXTENSIBLE keeps the real format in the sub format guid.
+			if formatTag == 0xfffe:
+				formatTag = struct.unpack("<H", chunk[24:26])[0]
+			wav["float"] = formatTag == 3
+
+	wav["header"] = header
+	return wav
+
+def pcmSamples(data, wav):
+	# samples as floats between -1 and 1.
+	if not isinstance(data, numpy.ndarray):
+		data = numpy.frombuffer(data, numpy.uint8)
+	bits = wav["bits"]
+	if wav["float"]:
+		return data.view("<f%d" % (bits // 8)).astype(numpy.float64)
+	elif bits == 8:
+		return (data.astype(numpy.float64) - 128) / 128
+	elif bits == 16:
+		return data.view("<i2") / 32768.0
+	elif bits == 24:
+		data = data.reshape(-1, 3).astype(numpy.int32)
+		samples = data[:, 0] | (data[:, 1] << 8) | (data[:, 2] << 16)
+		samples = numpy.where(samples & 0x800000, samples - 0x1000000, samples)
+		return samples / 8388608.0
+	else:
+		return data.view("<i4") / 2147483648.0
+
+def pcmBytes(samples, wav, dither=False):
+	bits = wav["bits"]
+	if wav["float"]:
+		return numpy.clip(samples, -1.0, 1.0).astype("<f%d" % (bits // 8)).tostring()
+
+	scale = 2 ** (bits - 1)
+	samples = samples * scale
+	if dither:
+		# triangular (TPDF) dither, up to one step either way, so the rounding error is noise instead of distortion.
+		samples += numpy.random.random_sample(samples.shape) - numpy.random.random_sample(samples.shape)
+	samples = numpy.clip(numpy.round(samples), -scale, scale - 1)
+	if bits == 8:
+		return (samples + 128).astype(numpy.uint8).tostring()
+	elif bits == 16:
+		return samples.astype("<i2").tostring()
+	elif bits == 24:
+		return samples.astype("<i4").view(numpy.uint8).reshape(-1, 4)[:, 0:3].tostring()
+	else:
+		return samples.astype("<i4").tostring()
+
+def wavBlocks(pcmFile, wav):
+	# sample blocks from a wav file or pipe (after readWavHeader).  Streamed wavs often don't know their length
+	# and say 0 or 0xffffffff, those are read to the end.
+	remaining = wav["dataSize"]
+	if remaining in (0, 0xffffffff):
+		remaining = None
+	sampleBytes = wav["bits"] // 8
+	blockBytes = PCM_BLOCK_FRAMES * wav["channels"] * sampleBytes
+	while remaining is None or remaining > 0:
+		size = blockBytes
+		if remaining is not None:
+			size = min(blockBytes, remaining)
+		data = pcmFile.read(size)
+		if remaining is not None:
+			remaining -= len(data)
+		data = data[0:len(data) - len(data) % sampleBytes]
+		if not data:
+			break
+		yield pcmSamples(data, wav)
 
+def measurePcm(blocks):
+	# peak, sum of squares and number of samples, which is all the gain calculation needs.
+	peak = 0.0
+	sumSquares = 0.0
+	count = 0
+	for samples in blocks:
+		if samples.size:
+			peak = max(peak, float(numpy.abs(samples).max()))
+			sumSquares += float(numpy.dot(samples, samples))
+			count += samples.size
+	return peak, sumSquares, count
+
+# the header of a wav file and its sample blocks, read through a memory map.
+def mappedWavBlocks(path):
+	wavFile = open(path, "rb")
+	try:
+		wav = readWavHeader(wavFile)
+	finally:
+		wavFile.close()
+
+	offset = len(wav["header"])
+	size = os.path.getsize(path) - offset
+	if wav["dataSize"] not in (0, 0xffffffff):
+		size = min(size, wav["dataSize"])
+	sampleBytes = wav["bits"] // 8
+	size -= size % sampleBytes
+	if size <= 0:
+		return wav, iter([])
+
+	samples = numpy.memmap(path, numpy.uint8, "r", offset, (size,))
+	blockBytes = PCM_BLOCK_FRAMES * wav["channels"] * sampleBytes
+	return wav, (pcmSamples(samples[i:i + blockBytes], wav) for i in xrange(0, size, blockBytes))
+
+def measureWavFile(path):
+	return measurePcm(mappedWavBlocks(path)[1])
+
+def measureDecoder(command):
+	decoder = startCommand(command, stdout=PIPE, stderr=open(os.devnull, "w"))
+	try:
+		return measurePcm(wavBlocks(decoder.stdout, readWavHeader(decoder.stdout)))
+	finally:
+		decoder.stdout.close()
+		finishCommand(decoder, command)
+
+def normalizeGain(measurements, mode):
+	# one gain for one or more measured tracks (several for an album).
+	peak = max([measurement[0] for measurement in measurements] + [0.0])
+	sumSquares = sum([measurement[1] for measurement in measurements])
+	count = sum([measurement[2] for measurement in measurements])
+	if not count or not peak:
+		return 1.0
+
+	if mode == "peak":
+		return 10 ** (NORMALIZE_PEAK_LEVEL / 20) / peak
+	rms = math.sqrt(sumSquares / count)
+	return min(10 ** (NORMALIZE_RMS_LEVEL / 20) / rms, 1.0 / peak)
+
+# Converting the audio to a fixed format (--rate, --channels, --bits) on its way to the encoder: down-mixed (or
+# up-mixed), resampled with a polyphase filter and requantized with dither, a block at a time.  Without them (or
+# when the audio already is in that format) the samples are only scaled by the normalization gain.
+RESAMPLE_TAPS = 96
+RESAMPLE_CUTOFF = 0.95
+RESAMPLE_KAISER_BETA = 8.0
+
+# Mixing wav channels (in the WAVE order) down to stereo: the centre and the surrounds go to both sides at -3 dB
+# and the lfe is left out.  Anything else alternates between left and right.
+STEREO_MIX = {
+	1: [[1.0, 1.0]],
+	3: [[1.0, 0.0], [0.0, 1.0], [0.707, 0.707]],
+	4: [[1.0, 0.0], [0.0, 1.0], [0.707, 0.0], [0.0, 0.707]],
+	5: [[1.0, 0.0], [0.0, 1.0], [0.707, 0.707], [0.707, 0.0], [0.0, 0.707]],
+	6: [[1.0, 0.0], [0.0, 1.0], [0.707, 0.707], [0.0, 0.0], [0.707, 0.0], [0.0, 0.707]]}
+
+# the matrix taking frames of inChannels to outChannels (1 or 2), scaled so the mix can't clip.
+def channelMatrix(inChannels, outChannels):
+	if inChannels in STEREO_MIX:
+		matrix = numpy.array(STEREO_MIX[inChannels])
+	else:
+		matrix = numpy.zeros((inChannels, 2))
+		matrix[numpy.arange(inChannels), numpy.arange(inChannels) % 2] = 1.0
+	if inChannels > 2:
+		matrix /= matrix.sum(axis=0).max()
+	if outChannels == 1:
+		matrix = matrix.sum(axis=1)[:, None] / 2
+	return matrix
+
+# The low pass filter of the resampler, split into its phases (filter[phase, tap]).  The rate goes up by "up" and
+# down by "down", and the filter cuts just below the lower of the two nyquist frequencies.  It is RESAMPLE_TAPS long
+# at the lower rate.
+def resampleFilter(inRate, outRate):
+	divisor = gcd(inRate, outRate)
+	up, down = outRate // divisor, inRate // divisor
+	taps = int(math.ceil(RESAMPLE_TAPS * float(inRate) / min(inRate, outRate)))
+	length = taps * up
+	cutoff = RESAMPLE_CUTOFF * min(inRate, outRate) / 2.0 / (inRate * up)
+	times = numpy.arange(length) - (length - 1) / 2.0
+	response = 2 * cutoff * up * numpy.sinc(2 * cutoff * times) * numpy.kaiser(length, RESAMPLE_KAISER_BETA)
+	return up, down, response.reshape(taps, up).T.copy()
+
+# Resampling blocks of frames (arrays of frames by channels).  Output frame n is at position n * down in the input
+# upsampled by up, so it takes input frames base, base - 1, ... with the filter phase of where it falls between them.
+# Every up-th output frame has the same phase and starts down input frames later, so the input windows of one phase
+# are a strided view of the input and each phase is a single numpy.dot.  The input still needed is kept from one
+# block to the next, and silence is added after the end so the output is as long as the input.
+def resampledBlocks(blocks, inRate, outRate):
+	up, down, phases = resampleFilter(inRate, outRate)
+	taps = phases.shape[1]
+	# the phases back to front, to run along the windows (oldest input frame first).
+	phases = phases[:, ::-1].copy()
+	# the delay of the filter, so output frame 0 is at input frame 0.
+	delay = (taps * up - 1) // 2
+	history = None
+	# the input frame history[0] is, silence before the start.
+	first = -taps
+	received = produced = 0
+	for block in chain(blocks, [None]):
+		last = block is None
+		if last:
+			if history is None:
+				return
+			block = numpy.zeros((taps, history.shape[1]))
 		else:
-                        print "No output format chosen, output file not written.  Please select output format."
-
-		# dangerous option here, deleting the input file after conversion
-		# Todo: only run these two cleanup items if no exceptions have been raised.
-		if options.delSource:
-			# if the output file doesn't exist, something went wrong and we should not delete the source
-			# even if --delete is specified.
-			if not os.path.isfile(outFile):
-				print "Output file does not exist, input file will not be deleted."
-				continue
-			
-			# if the new output filename is the same as the original input, dont delete original
-			# because it has already been overwritten by the new one.
-			if file == outFile:
-				continue
-		
-			# removing the input file
-			try:
-				os.remove(file)
-				
-			# exiting normally if control-c is hit instead of deleting file!
-			except (KeyboardInterrupt, SystemExit):
-        			gracefulExit()
-			
-			except:
-				print "could not remove input file:", file
-		
-		# manually removing tempfiles just to make sure the disk doesn't get cluttered
+			received += len(block)
+		if history is None:
+			history = numpy.zeros((taps, block.shape[1]))
+		history = numpy.concatenate((history, block))
+
+		# the frames whose newest input frame is here.
+		count = ((first + len(history)) * up - 1 - delay) // down + 1
+		if last:
+			count = min(count, -(-received * up // down))
+		if count > produced:
+			# channels by frames, so a window of one channel is contiguous.
+			samples = numpy.ascontiguousarray(history.T)
+			step = samples.strides[1]
+			frames = numpy.empty((count - produced, samples.shape[0]))
+			for offset in xrange(min(up, count - produced)):
+				position = (produced + offset) * down + delay
+				start = position // up - first - taps + 1
+				windows = numpy.lib.stride_tricks.as_strided(samples[:, start:], (samples.shape[0], \
+					len(xrange(offset, count - produced, up)), taps), (samples.strides[0], down * step, step))
+				frames[offset::up] = numpy.dot(windows, phases[position % up]).T
+			produced = count
+			yield frames
+
+		keep = (produced * down + delay) // up - taps + 1 - first
+		if keep > 0:
+			history = history[keep:]
+			first += keep
+
+# the format the audio of a wav is converted to, with --rate, --channels and --bits (None for what stays).
+def targetWav(wav, target):
+	converted = dict(wav)
+	if target:
+		for key in ("rate", "channels", "bits"):
+			if target[key]:
+				converted[key] = target[key]
+		if target["bits"]:
+			converted["float"] = False
+	return converted
+
+def wavHeader(wav, frames):
+	frameBytes = wav["channels"] * wav["bits"] // 8
+	if frames is None:
+		# a length that isn't known, the encoders read to the end.
+		dataSize = riffSize = 0xffffffff
+	else:
+		dataSize = frames * frameBytes
+		riffSize = dataSize + 36
+	formatTag = 1
+	if wav["float"]:
+		formatTag = 3
+	return "RIFF" + struct.pack("<I", riffSize) + "WAVE" + "fmt " + struct.pack("<IHHIIHH", 16, formatTag, \
+		wav["channels"], wav["rate"], wav["rate"] * frameBytes, frameBytes, wav["bits"]) + "data" + \
+		struct.pack("<I", dataSize)
+
+# The wav from pcmFile (a file or a pipe, after readWavHeader) with the gain applied and converted to the target
+# format, in pieces that can be written to an encoder.
+def processedWav(wav, blocks, gain, target):
+	converted = targetWav(wav, target)
+	if converted == wav:
+		yield wav["header"]
+		for samples in blocks:
+			yield pcmBytes(samples * gain, wav)
+		return
+
+	frames = None
+	if wav["dataSize"] not in (0, 0xffffffff):
+		frames = wav["dataSize"] // (wav["channels"] * wav["bits"] // 8)
+		if converted["rate"] != wav["rate"]:
+			frames = -(-frames * converted["rate"] // wav["rate"])
+	yield wavHeader(converted, frames)
+
+	blocks = (samples.reshape(-1, wav["channels"]) * gain for samples in blocks)
+	if converted["channels"] != wav["channels"]:
+		matrix = channelMatrix(wav["channels"], converted["channels"])
+		blocks = (numpy.dot(frames, matrix) for frames in blocks)
+	if converted["rate"] != wav["rate"]:
+		blocks = resampledBlocks(blocks, wav["rate"], converted["rate"])
+	# anything that isn't the input samples as they were needs dither to go to (at most) as many bits.
+	dither = not converted["float"] and (converted["bits"] < wav["bits"] or wav["float"] or \
+		converted["rate"] != wav["rate"] or converted["channels"] != wav["channels"])
+	for frames in blocks:
+		yield pcmBytes(frames.ravel(), converted, dither)
 
+def processedWavFile(path, gain, target):
+	wav, blocks = mappedWavBlocks(path)
+	return processedWav(wav, blocks, gain, target)
+
+def processedDecoder(command, gain, target):
+	decoder = startCommand(command, stdout=PIPE, stderr=open(os.devnull, "w"))
+	try:
+		wav = readWavHeader(decoder.stdout)
+		for data in processedWav(wav, wavBlocks(decoder.stdout, wav), gain, target):
+			yield data
+	finally:
+		decoder.stdout.close()
+		finishCommand(decoder, command)
+	# only reached when all of the output was read, a decoder stopped by the encoder going away is not its fault.
+	if decoder.returncode:
+		raise RuntimeError("decoder failed (exit status %d)" % decoder.returncode)
+
+# album mode: measuring all the tracks in one directory, so they all get the same gain.
+def albumGainJob(files):
+	measurements = []
+	for file in files:
+		inFileExtension = os.path.splitext(file.lower())[1]
 		try:
-			# only trying to remove the tempfile if it exists.  This will make the dry run output clearer.
-			if os.path.isfile(tempFile):
-				os.remove(tempFile)
-			
+			if inFileExtension == ".wav":
+				measurements.append(measureWavFile(file))
+			elif pcmStreamCommand(file, inFileExtension):
+				measurements.append(measureDecoder(pcmStreamCommand(commandPath(file), inFileExtension)))
+			elif inFileExtension in (".wma", ".rm", ".ra"):
+				tempFile = newTempFile()
+				try:
+					runPopen(mplayerDecodeCommand(commandPath(file), tempFile), verbose=False)
+					measurements.append(measureWavFile(tempFile))
+				finally:
+					removeTempFile(tempFile)
+
 		except (KeyboardInterrupt, SystemExit):
 			gracefulExit()
-		
+
 		except:
-			print "error: could not remove tempfile"
-		
-		print "----"
+			say("could not measure the volume of", file)
+
+	return os.path.dirname(os.path.abspath(files[0])), normalizeGain(measurements, options.normalizeMode)
+
+# Reading the tags and bitrate of an input file, with the native readers or the backend tag programs.  Returns title, artist, genre, date,
+# album and bitrate (empty strings for anything the file doesn't have).  The tag programs' output is parsed as they
+# write it.
+def probeFile(file, inFileExtension, options):
+	global probeHits, probeMisses
+	if options.probeCache:
+		tags = cachedProbe(file, options.probeCache)
+		if tags:
+			probeHits += 1
+			return tags
+		probeMisses += 1
+
+	started = time.time()
+	commandFile = commandPath(file)
+	tags = ("", "", "", "", "", "")
+	# the native readers first, the tag programs are only started for files they can't read.
+	info = readAudioInfo(file)
+	if info:
+		tags = infoTags(info)
+
+	elif inFileExtension == ".mp3":
+		# using mp3info because it gives a lot of nice options for formatting of tag output.
+		# formatting so I can use ogginfoTags to parse the info.  Using popen to subprocess.Popen to drive command line
+		# mp3info turns the \\n escapes of the format into new lines itself.
+		tagInfo = commandLines([MP3INFO, "-x", "-r", "m", "-p", \
+			"title=%t \\nartist=%a \\ngenre=%g \\ndate=%y \\nalbum=%l\\n \\nNominal bitrate: %r\\n", commandFile])
+
+		# using ogginfoTags to parse the tag info.  Maybe I should rename it.
+		tags = ogginfoTags(tagInfo)
+
+	elif inFileExtension in (".wma", ".rm", ".ra"):
+		tagName, tagAuthor, inBitrate = mplayerTags(commandLines(mplayerInfoCommand(commandFile), options.verbose))
+		tags = (tagName, tagAuthor, "", "", "", inBitrate)
+
+	elif inFileExtension == ".ogg":
+		# getting tag info
+		tags = ogginfoTags(commandLines([OGGINFO, commandFile]))
+
+	elif inFileExtension == ".flac":
+		try:
+			# using metaflac to extract the tags from the flac file
+			tagInfo = commandLines([METAFLAC, "--show-tag=TITLE", "--show-tag=ARTIST", "--show-tag=ALBUM", \
+				"--show-tag=DATE", "--show-tag=GENRE", commandFile])
+
+			# we can use ogginfoTags to parse the tag info file since its almost the same format.
+			tags = ogginfoTags(tagInfo)
+
+		# this except statement is for handling control-c from command line.  Otherwise if control-c is hit,
+		# the other except will be run.  This allows the program to exit normally.
+		except (KeyboardInterrupt, SystemExit):
+			gracefulExit()
+		except:
+			say("No tags in flac file")
+
+	if options.probeCache:
+		storeProbe(file, tags, options.probeCache)
+	recordStage("probe", started, bytesIn=fileSize(file))
+	return tags
+
+# The probe cache keeps the result of probeFile() in a sqlite database keyed by path, size and modification time,
+# so dry runs and repeated syncs don't have to start the tag programs again.  Each process opens its own
+# connection, and the least recently used entries are evicted at the end of a run (see evictProbeCache).
+probeDb = None
+probeDbPid = None
+probeHits = 0
+probeMisses = 0
+
+def openProbeCache(path):
+	global probeDb, probeDbPid
+	if probeDbPid != os.getpid():
+		probeDb = sqlite3.connect(path, timeout=60, isolation_level=None)
+		probeDb.text_factory = str
+		# several jobs share the cache, the write-ahead log lets them read while one of them writes.
+		probeDb.execute("PRAGMA journal_mode=WAL")
+		probeDb.execute("CREATE TABLE IF NOT EXISTS probes (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, " + \
+			"title TEXT, artist TEXT, genre TEXT, date TEXT, album TEXT, bitrate TEXT, used REAL)")
+		probeDbPid = os.getpid()
+	return probeDb
+
+def cachedProbe(file, cachePath):
+	db = openProbeCache(cachePath)
+	path = os.path.abspath(file)
+	row = db.execute("SELECT size, mtime, title, artist, genre, date, album, bitrate FROM probes " + \
+		"WHERE path = ?", (path,)).fetchone()
+	fileStat = os.stat(file)
+	if not row or row[0:2] != (fileStat.st_size, fileStat.st_mtime):
+		return None
+
+	db.execute("UPDATE probes SET used = ? WHERE path = ?", (time.time(), path))
+	return tuple(row[2:])
+
+def storeProbe(file, tags, cachePath):
+	fileStat = os.stat(file)
+	openProbeCache(cachePath).execute("INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+		(os.path.abspath(file), fileStat.st_size, fileStat.st_mtime) + tuple(tags) + (time.time(),))
+
+def evictProbeCache(cachePath, maxEntries):
+	openProbeCache(cachePath).execute("DELETE FROM probes WHERE path NOT IN " + \
+		"(SELECT path FROM probes ORDER BY used DESC LIMIT ?)", (maxEntries,))
+
+# The encode cache (--encode-cache) keeps a copy of every output, named by a hash of the source file's content and
+# of everything that decides what the encoder makes of it: the output format, the encoder command with its tags and
+# bitrate filled in, and the normalization.  Converting the same library for another destination (or again) links
+# or copies the outputs from the cache instead of encoding them.  The least recently used files are removed at the
+# end of a run to keep the cache under --encode-cache-size.
+ENCODE_CACHE_BLOCK = 1024 * 1024
+
+def fileHash(path):
+	digest = hashlib.sha1()
+	hashFile = open(path, "rb")
+	try:
+		for data in iter(lambda: hashFile.read(ENCODE_CACHE_BLOCK), ""):
+			digest.update(data)
+	finally:
+		hashFile.close()
+	return digest.hexdigest()
+
+# the path of an output in the cache.
+def encodeCacheKey(sourceFile, encoder, values, normalization):
+	resolved = [values.get(arg, arg) for arg in encoder if arg not in ("{input}", "{output}")]
+	tags = [values[key] for key in ("{title}", "{artist}", "{genre}", "{date}", "{album}")]
+	key = hashlib.sha1(json.dumps([fileHash(sourceFile), resolved, tags, normalization])).hexdigest()
+	return os.path.join(options.encodeCache, key[:2], key + os.path.splitext(values["{output}"])[1])
+
+# the temporary name a file is written under until it is complete.  It is in the same directory, so renaming it into
+# place is atomic.
+def partPath(target):
+	return os.path.join(os.path.dirname(target), ".%s.%d.part" % (os.path.basename(target), os.getpid()))
+
+def replaceFile(partFile, target):
+	# windows can't rename over an existing file.
+	if os.name == 'nt' and os.path.exists(target):
+		os.remove(target)
+	os.rename(partFile, target)
+	removeStaleParts(target)
+
+# The parts of each directory left by runs that were killed (their process is gone), by the name of their output.
+# A directory is only read once per process, the first time an output is put in place there.
+staleParts = {}
+
+def partProcessGone(pid):
+	try:
+		os.kill(pid, 0)
+	except OSError, error:
+		return error.errno == errno.ESRCH
+	return False
+
+# Removing what killed runs left of an output, once it is in place (eg. by the --resume run after an interrupt).
+# Not on windows, where there is no way to ask whether a process is still running.
+def removeStaleParts(target):
+	if os.name == 'nt':
+		return
+	directory = os.path.dirname(target) or "."
+	if directory not in staleParts:
+		staleParts[directory] = {}
+		try:
+			names = os.listdir(directory)
+		except OSError:
+			names = []
+		for name in names:
+			output, dot, pid = name[1:-len(".part")].rpartition(".")
+			if name.startswith(".") and name.endswith(".part") and output and pid.isdigit() and \
+				int(pid) != os.getpid() and partProcessGone(int(pid)):
+				staleParts[directory].setdefault(output, []).append(name)
+
+	for name in staleParts[directory].pop(os.path.basename(target), []):
+		try:
+			os.remove(os.path.join(directory, name))
+		except OSError:
+			pass
+
+# Putting a file in place under a temporary name and renaming it, so nobody sees half of it.  A hard link when the
+# two are on the same filesystem, a copy otherwise.
+def placeFile(source, target):
+	partFile = partPath(target)
+	try:
+		os.link(source, partFile)
+	except (OSError, AttributeError):
+		shutil.copyfile(source, partFile)
+	replaceFile(partFile, target)
+
+# Copying a cached output to outFile.  Returns False if it isn't in the cache.
+def fetchEncodeCache(cacheFile, outFile):
+	try:
+		placeFile(cacheFile, outFile)
+	except (IOError, OSError):
+		return False
+	# the modification time is when it was last used, for the eviction.
+	try:
+		os.utime(cacheFile, None)
+	except OSError:
+		pass
+	return True
+
+def storeEncodeCache(cacheFile, outFile):
+	try:
+		if not os.path.isdir(os.path.dirname(cacheFile)):
+			os.makedirs(os.path.dirname(cacheFile))
+		placeFile(outFile, cacheFile)
+	except (IOError, OSError), error:
+		say("could not add %s to the encode cache: %s" % (outFile, error))
+
+def evictEncodeCache(cacheDir, maxSize):
+	entries = []
+	total = 0
+	for directory, subdirs, names in os.walk(cacheDir):
+		for name in names:
+			path = os.path.join(directory, name)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+			total += stat.st_size
+	entries.sort()
+	for mtime, size, path in entries:
+		if total <= maxSize:
+			break
+		try:
+			os.remove(path)
+			total -= size
+			os.rmdir(os.path.dirname(path))
+		except OSError:
+			# (the directory isn't empty yet.)
+			pass
+
+# Incremental sync.  The manifest is a small sqlite database kept in the destination directory that remembers,
+# for every source file, the size and modification time it had when it was converted, the settings it was
+# converted with and the output file that was written.  Files that match their entry are left alone on the
+# next run.
+MANIFEST_NAME = ".audio_conv_manifest.db"
+
+def openManifest(manifestDir):
+	db = sqlite3.connect(os.path.join(manifestDir, MANIFEST_NAME))
+	# paths are plain (byte) strings, whatever the filesystem encoding is.
+	db.text_factory = str
+	db.execute("CREATE TABLE IF NOT EXISTS files (source TEXT PRIMARY KEY, size INTEGER, mtime REAL, " + \
+		"settings TEXT, output TEXT)")
+	return db
+
+# everything that changes the output file, so changing any of these options converts the file again.
+def manifestSettings(options):
+	return join([outputExtension(options), str(options.bitrate), options.encodeOption, \
+		str(bool(options.normalize)), options.normalizeMode, str(bool(options.album)), str(options.rate), \
+		str(options.channels), str(options.bits)] + options.targets, "|")
+
+def manifestUpToDate(db, file, settings):
+	source = os.path.abspath(file)
+	row = db.execute("SELECT size, mtime, settings, output FROM files WHERE source = ?", (source,)).fetchone()
+	if not row:
+		return False
+
+	size, mtime, oldSettings, output = row
+	fileStat = os.stat(source)
+	if (size, mtime, oldSettings) != (fileStat.st_size, fileStat.st_mtime, settings):
+		return False
+
+	# an empty output means the file was skipped last time (eg. its bitrate was too low).
+	return not output or os.path.isfile(output)
+
+# the files that need converting again, the others are added to the unchanged list.
+def changedFiles(files, db, settings, unchanged):
+	for file in files:
+		if manifestUpToDate(db, file, settings):
+			unchanged.append(file)
+		else:
+			yield file
+
+def manifestRecord(db, file, status, settings, output):
+	source = os.path.abspath(file)
+	if status == "failed":
+		db.execute("DELETE FROM files WHERE source = ?", (source,))
+		return
+
+	if status == "skipped":
+		output = ""
+	else:
+		output = os.path.abspath(output)
+	fileStat = os.stat(source)
+	db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", \
+		(source, fileStat.st_size, fileStat.st_mtime, settings, output))
+
+# removing output files whose source file (somewhere below the top directory) no longer exists.
+def pruneManifest(db, absTopDir, dryRun):
+	for source, output in db.execute("SELECT source, output FROM files").fetchall():
+		if not source.startswith(os.path.join(absTopDir, "")) or os.path.exists(source):
+			continue
+
+		if output and os.path.isfile(output):
+			print "source is gone, removing:", output
+			if not dryRun:
+				os.remove(output)
+		if not dryRun:
+			db.execute("DELETE FROM files WHERE source = ?", (source,))
+
+# Resuming (--resume).  The finished jobs go in a journal in the destination directory, so a run that was killed
+# can be started again with --resume and go straight to the files it hadn't finished, without reading the others.
+# A run with --dest-dir and without --resume starts a new journal, without a destination directory there is only a
+# journal with --resume (nothing is written next to the inputs otherwise).  It is committed in batches, a killed
+# run at most converts the files of the last batch again.
+JOURNAL_NAME = ".audio_conv_journal.db"
+JOURNAL_BATCH = 50
+JOURNAL_BATCH_SECONDS = 60
+
+def openJournal(journalDir, resume):
+	db = sqlite3.connect(os.path.join(journalDir, JOURNAL_NAME))
+	db.text_factory = str
+	db.execute("CREATE TABLE IF NOT EXISTS jobs (source TEXT, output TEXT, status TEXT, PRIMARY KEY (source, output))")
+	if not resume:
+		db.execute("DELETE FROM jobs")
+	db.commit()
+	return db
+
+# committed with the others of its batch (see journalCommit()).
+def journalRecord(db, job, status):
+	db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?)", \
+		(os.path.abspath(job.source), os.path.abspath(job.output), status))
+
+# committing every JOURNAL_BATCH files or JOURNAL_BATCH_SECONDS, whichever comes first.  Returns the time of the
+# last commit.
+def journalCommit(db, recorded, lastCommit):
+	if recorded % JOURNAL_BATCH == 0 or time.time() - lastCommit >= JOURNAL_BATCH_SECONDS:
+		db.commit()
+		return time.time()
+	return lastCommit
+
+# the jobs the journal doesn't have as finished, the others are added to the finished list.  A converted file only
+# counts while its output is still there.
+def unfinishedJobs(jobs, db, finished):
+	for job in jobs:
+		row = db.execute("SELECT status FROM jobs WHERE source = ? AND output = ?", \
+			(os.path.abspath(job.source), os.path.abspath(job.output))).fetchone()
+		if row and (row[0] == "skipped" or (row[0] == "done" and \
+			all([os.path.isfile(target.output) for target in targetJobs(job)]))):
+			finished.append(job)
+		else:
+			yield job
+
+# Intermediate wav files.  With --tmp-budget they are kept in memory (/dev/shm) as long as the intermediates of all
+# the running jobs fit in the budget together, the rest go to the disk (--tmp-dir, or the system temp dir).  The
+# size of a file is worked out from its header before it is decoded, files whose size isn't known always go to the
+# disk.  Every name is unique to the run, the process and the file, each process removes its own when a job ends,
+# and the main process sweeps up whatever is left when a run is interrupted (see gracefulExit).
+RAM_TEMP_DIRS = ("/dev/shm", "/run/shm")
+mainPid = None
+tempUsage = None
+# the semaphore of --stream-jobs, shared by the worker processes.
+streamSlots = None
+tempFiles = {}
+tempCount = 0
+
+# parsing a size like 512M or 2G into bytes.
+def parseSize(size):
+	units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+	size = size.strip().upper().rstrip("B")
+	if size and size[-1] in units:
+		return int(float(size[:-1]) * units[size[-1]])
+	return int(size)
+
+def ramTempDir():
+	if os.name == 'nt':
+		return None
+	for directory in RAM_TEMP_DIRS:
+		if os.path.isdir(directory) and os.access(directory, os.W_OK):
+			return directory
+	return None
+
+def diskTempDir():
+	return options.tmpDir or gettempdir()
+
+# the size of the wav a file decodes to, or None if the header doesn't tell.
+def wavSizeEstimate(file):
+	info = readAudioInfo(file)
+	if not info or not info.get("duration") or not info.get("sampleRate") or not info.get("channels"):
+		return None
+	# the decoders write 16 bit wav, except flac which keeps its own sample size.
+	bytesPerSample = (info.get("bitsPerSample") or 16) // 8
+	return int(info["duration"] * info["sampleRate"]) * info["channels"] * bytesPerSample + 44
+
+# A name for a new intermediate file.  It goes in memory if size fits in what is left of the budget (and on the
+# memory filesystem), the space stays reserved until the file is removed or releaseTempBudget() is called.
+def newTempFile(size=None, directory=None):
+	global tempCount
+	tempCount += 1
+	reserved = 0
+	if not directory:
+		directory = diskTempDir()
+		ramDir = ramTempDir()
+		if size and tempUsage and ramDir:
+			tempUsage.get_lock().acquire()
+			try:
+				fileSystem = os.statvfs(ramDir)
+				if tempUsage.value + size <= options.tmpBudget and size < fileSystem.f_bavail * fileSystem.f_frsize:
+					tempUsage.value += size
+					reserved = size
+					directory = ramDir
+			finally:
+				tempUsage.get_lock().release()
+
+	path = os.path.join(directory, "%s%d-%d.wav" % (options.tempPrefix, os.getpid(), tempCount))
+	tempFiles[path] = reserved
+	return path
+
+# giving back the budget of a name that turned out not to need any space (eg. a fifo).
+def releaseTempBudget(path):
+	reserved = tempFiles.get(path)
+	if reserved:
+		tempUsage.get_lock().acquire()
+		try:
+			tempUsage.value -= reserved
+		finally:
+			tempUsage.get_lock().release()
+		tempFiles[path] = 0
+
+def removeTempFile(path):
+	if path not in tempFiles:
+		return
+	releaseTempBudget(path)
+	del tempFiles[path]
+	try:
+		# mplayer's fifo is not a regular file, so checking that it exists instead.
+		if os.path.exists(path) and not os.path.isdir(path):
+			os.remove(path)
+	except OSError:
+		say("error: could not remove tempfile", path)
+
+def removeTempFiles():
+	for path in tempFiles.keys():
+		removeTempFile(path)
+
+# removing the intermediates left by every process of this run, for when the workers were stopped mid job.
+def sweepTempFiles():
+	for directory in set([diskTempDir(), ramTempDir(), options.stageDir]):
+		if not directory:
+			continue
+		try:
+			names = os.listdir(directory)
+		except OSError:
+			continue
+		for name in names:
+			if name.startswith(options.tempPrefix):
+				try:
+					os.remove(os.path.join(directory, name))
+				except OSError:
+					pass
+
+def gracefulExit():
+	# exiting program gracefully instead of messing up try statements and continuing on to process other files.
+	# The backend programs are stopped first, so they don't write any more (an encoder would finish its output once
+	# its input is closed).  Then the intermediate files and the parts of the outputs go, workers only remove their
+	# own, the main process everything of the run.
+	for process in list(runningCommands):
+		try:
+			process.kill()
+		except OSError:
+			pass
+	removeTempFiles()
+	if os.getpid() == mainPid:
+		sweepTempFiles()
+	sys.exit()
+
+
+# Console output is shared by all the jobs of a parallel run, so every message goes through say().  The lock
+# keeps lines from different processes from being interleaved and jobLabel prefixes each line with the file
+# it belongs to (jobLabel stays empty for a single job so the output looks the same as it always has).
+outputLock = None
+jobLabel = ""
+
+def say(*args):
+	text = join([str(arg) for arg in args], " ")
+	if jobLabel:
+		text = join(["[%s] %s" % (jobLabel, line) for line in text.split("\n")], "\n")
+
+	if outputLock:
+		outputLock.acquire()
+	try:
+		print text
+		sys.stdout.flush()
+	finally:
+		if outputLock:
+			outputLock.release()
+
+def restoreSigint():
+	# worker processes ignore control-c (the parent shuts the pool down), but the encoders they start should not.
+	signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+def initWorker(lock, workerOptions, workerTopDir, workerTempUsage, workerStreamSlots):
+	global outputLock, options, topDir, tempUsage, streamSlots
+	outputLock = lock
+	options = workerOptions
+	topDir = workerTopDir
+	tempUsage = workerTempUsage
+	streamSlots = workerStreamSlots
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	# the main process terminates the workers when the run is interrupted.
+	signal.signal(signal.SIGTERM, workerTerminated)
+
+def workerTerminated(signum, frame):
+	gracefulExit()
+
+# Timing (--timing, --timing-log and --trace).  Each stage of a file (probe, decode, normalize, encode, tag) and
+# every backend program it runs is recorded with its start and end time, and for the stages the bytes read and
+# written and the exit status.  A job hands its records to the main process with its result, which writes them as
+# json lines and a chrome trace_event file (chrome://tracing or ui.perfetto.dev) and sums them up at the end.
+timingEvents = None
+TIMING_STAGES = ("probe", "decode", "normalize", "encode", "tag", "mkdir", "file")
+
+def fileSize(path):
+	try:
+		return os.path.getsize(path)
+	except (OSError, TypeError):
+		return None
+
+# Recording a stage that started at started and is ending now.  Does nothing unless timing is on.
+def recordStage(stage, started, status=None, bytesIn=None, bytesOut=None, **details):
+	if timingEvents is None:
+		return
+	event = {"kind": "stage", "stage": stage, "start": started, "end": time.time(), "pid": os.getpid(), \
+		"status": status, "bytes_in": bytesIn, "bytes_out": bytesOut}
+	event.update(details)
+	timingEvents.append(event)
+
+def recordCommand(command, started, status):
+	if timingEvents is None:
+		return
+	timingEvents.append({"kind": "command", "command": os.path.basename(command[0]), "start": started, \
+		"end": time.time(), "pid": os.getpid(), "status": status})
+
+# the records made since the last call (or after the first few), with the file they belong to if they don't say.
+def takeTimings(file=None, since=0):
+	events = timingEvents[since:]
+	del timingEvents[since:]
+	for event in events:
+		event.setdefault("file", file)
+		event.setdefault("format", file and os.path.splitext(file)[1].lower())
+	return events
+
+def percentile(values, percent):
+	values = sorted(values)
+	return values[max(0, int(math.ceil(percent / 100.0 * len(values))) - 1)]
+
+def writeTrace(path, events, runStarted):
+	traceEvents = []
+	for event in events:
+		name = event.get("stage") or event.get("command")
+		args = dict([(key, value) for key, value in event.items() if key not in ("start", "end", "pid")])
+		traceEvents.append({"name": name, "cat": event["kind"], "ph": "X", "pid": mainPid, "tid": event["pid"], \
+			"ts": int((event["start"] - runStarted) * 1000000), "dur": int((event["end"] - event["start"]) * 1000000), \
+			"args": args})
+	traceFile = open(path, "w")
+	json.dump({"traceEvents": traceEvents, "displayTimeUnit": "ms"}, traceFile)
+	traceFile.close()
+
+def printTimingSummary(events):
+	durations = {}
+	formats = {}
+	for event in events:
+		if event["kind"] != "stage":
+			continue
+		duration = event["end"] - event["start"]
+		durations.setdefault(event["stage"], []).append(duration)
+		if event["stage"] == "file":
+			formats.setdefault(event["format"] or "?", []).append(duration)
+
+	print "%-12s %7s %9s %9s %10s" % ("stage", "count", "p50 (s)", "p95 (s)", "total (s)")
+	rows = [(stage, durations[stage]) for stage in TIMING_STAGES if stage in durations]
+	rows += [("file " + format, formats[format]) for format in sorted(formats)]
+	for name, values in rows:
+		print "%-12s %7d %9.3f %9.3f %10.2f" % (name, len(values), percentile(values, 50), percentile(values, 95), \
+			sum(values))
+
+# Progress of a run (--metrics and --status).  The jobs are counted and their input sizes added up before the run
+# starts, or as the workers get them with a list of files (--files-from - is read as it comes, the run doesn't wait
+# for the end of it), then the total is unknown until the last job has been found.  Every finished file adds its
+# counts, bytes and length of audio.  The ETA is the input left to convert at the rate it has been converted so far
+# (by the number of files when the sizes aren't known, eg. streams).  Skipped files are left out of the rate, they
+# take no time.
+def startProgress(jobs, lazy):
+	progress = {"started": time.time(), "updated": time.time(), "planned": 0, "discovered": False, "finished": 0, \
+		"files": {"done": 0, "skipped": 0, "failed": 0}, "bytesIn": 0, "bytesOut": 0, "plannedBytes": 0, \
+		"convertedBytes": 0, "converted": 0, "audio": {}, "statusShown": 0}
+	jobs = countedJobs(jobs, progress)
+	if not lazy:
+		jobs = list(jobs)
+	return jobs, progress
+
+def countedJobs(jobs, progress):
+	for job in jobs:
+		progress["planned"] += 1
+		if not job.skip:
+			progress["plannedBytes"] += fileSize(job.source) or 0
+		yield job
+	progress["discovered"] = True
+
+def progressRecord(progress, job, status, jobInfo):
+	progress["updated"] = time.time()
+	progress["finished"] += 1
+	progress["files"][status] = progress["files"].get(status, 0) + 1
+	if job.skip:
+		return
+	progress["plannedBytes"] -= fileSize(job.source) or 0
+	if status == "skipped":
+		return
+	progress["converted"] += 1
+	progress["convertedBytes"] += jobInfo["bytesIn"] or 0
+	progress["bytesIn"] += jobInfo["bytesIn"] or 0
+	progress["bytesOut"] += jobInfo["bytesOut"] or 0
+	codec = os.path.splitext(job.output)[1][1:].lower()
+	progress["audio"][codec] = progress["audio"].get(codec, 0.0) + jobInfo["audioSeconds"]
+
+# seconds until the run is done, None until all the jobs are known and there is a rate to go by.
+def progressEta(progress):
+	elapsed = time.time() - progress["started"]
+	remaining = progress["planned"] - progress["finished"]
+	if not progress["discovered"]:
+		return None
+	elif not remaining:
+		return 0.0
+	elif progress["convertedBytes"] and progress["plannedBytes"] > 0:
+		return progress["plannedBytes"] / (progress["convertedBytes"] / elapsed)
+	elif progress["converted"]:
+		return remaining * elapsed / progress["converted"]
+	return None
+
+# Rewritten whole under a temporary name and renamed, so a scrape never reads half of it.
+def writeMetrics(path, progress):
+	elapsed = max(time.time() - progress["started"], 0.001)
+	eta = progressEta(progress)
+	metrics = [
+		("files_total", "counter", "Files finished, by status.", \
+			[('status="%s"' % status, count) for status, count in sorted(progress["files"].items())]),
+		("files_planned", "gauge", "Files in the run (found so far until discovery_done is 1).", \
+			[("", progress["planned"])]),
+		("discovery_done", "gauge", "1 once all the files of the run have been found.", \
+			[("", progress["discovered"] and 1 or 0)]),
+		("queued_files", "gauge", "Files not finished yet (running or waiting for a worker).", \
+			[("", progress["planned"] - progress["finished"])]),
+		("workers", "gauge", "Worker processes converting files.", [("", options.jobs)]),
+		("input_bytes_total", "counter", "Bytes of the input files converted.", [("", progress["bytesIn"])]),
+		("output_bytes_total", "counter", "Bytes of the output files written.", [("", progress["bytesOut"])]),
+		("input_bytes_per_second", "gauge", "Input bytes converted per second of the run.", \
+			[("", progress["bytesIn"] / elapsed)]),
+		("output_bytes_per_second", "gauge", "Output bytes written per second of the run.", \
+			[("", progress["bytesOut"] / elapsed)]),
+		("audio_seconds_total", "counter", "Seconds of audio encoded, by output codec.", \
+			[('codec="%s"' % codec, seconds) for codec, seconds in sorted(progress["audio"].items())]),
+		("audio_seconds_per_second", "gauge", "Seconds of audio encoded per second of the run, by output codec.", \
+			[('codec="%s"' % codec, seconds / elapsed) for codec, seconds in sorted(progress["audio"].items())]),
+		("eta_seconds", "gauge", "Estimated seconds until the run is done (-1 while unknown).", \
+			[("", eta is None and -1 or eta)]),
+		("start_time_seconds", "gauge", "When the run started, in seconds since the epoch.", \
+			[("", progress["started"])]),
+		("last_progress_time_seconds", "gauge", "When the last file finished, in seconds since the epoch.", \
+			[("", progress["updated"])])]
+
+	partFile = partPath(path)
+	metricsFile = open(partFile, "w")
+	try:
+		for name, kind, text, samples in metrics:
+			metricsFile.write("# HELP audio_conv_%s %s\n# TYPE audio_conv_%s %s\n" % (name, text, name, kind))
+			for labels, value in samples:
+				if labels:
+					labels = "{" + labels + "}"
+				metricsFile.write("audio_conv_%s%s %s\n" % (name, labels, repr(float(value))))
+	finally:
+		metricsFile.close()
+	replaceFile(partFile, path)
+
+def formatDuration(seconds):
+	if seconds is None:
+		return "?"
+	seconds = int(seconds)
+	return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+# The status line is rewritten in place on a terminal, anywhere else (eg. a log file) it is a line every 10
+# seconds at most.
+def printStatus(progress, final=False):
+	interactive = sys.stderr.isatty()
+	now = time.time()
+	if not interactive and not final and now - progress["statusShown"] < 10:
+		return
+	progress["statusShown"] = now
+	elapsed = max(now - progress["started"], 0.001)
+	files = progress["files"]
+	planned = progress["discovered"] and str(progress["planned"]) or "?"
+	line = "[%d/%s] %d done, %d skipped, %d failed | %.1f MB/s in, %.1f MB/s out" % (progress["finished"], \
+		planned, files["done"], files["skipped"], files["failed"], progress["bytesIn"] / elapsed / 1048576, \
+		progress["bytesOut"] / elapsed / 1048576)
+	for codec, seconds in sorted(progress["audio"].items()):
+		line += " | %s %.1fx" % (codec, seconds / elapsed)
+	line += " | ETA " + formatDuration(progressEta(progress))
+	if interactive:
+		sys.stderr.write("\r" + line + "\033[K")
+		if final:
+			sys.stderr.write("\n")
+	else:
+		sys.stderr.write(line + "\n")
+	sys.stderr.flush()
+
+# the route the last file took, reported with the job's result.
+fileRoute = None
+
+# What a file is encoded with: its tags (cleaned up for the encoders), the bitrate of the input and the one the
+# output gets.  They come from the file's own probe, so nothing carries over from one file to the next.
+FileSettings = namedtuple("FileSettings", "title artist genre date album inBitrate bitrate")
+
+# The first, cheap step of converting a file: reading the tags and stream info from the headers (or from the
+# start of a stream), without decoding anything.
+def probeSettings(job, inFileExtension, options):
+	if job.stream:
+		started = time.time()
+		tagName, tagAuthor, inBitrate = mplayerTags(commandLines(mplayerInfoCommand(job.stream), options.verbose))
+		recordStage("probe", started, stream=job.stream)
+		tagGenre = tagDate = tagAlbum = ""
+	else:
+		tagName, tagAuthor, tagGenre, tagDate, tagAlbum, inBitrate = probeFile(job.source, inFileExtension, options)
+
+	# checking the genre tag to make sure its acceptable for Lame and other encoders (got listing from id3v2)
+	# should probably have dictionary in a different file, but its nice to have everything in one script.
+	# Testing the genre tag against genreList.  Ignoring the 'genre as number' case.  Not trying to handle crazy cases.
+
+	# discarding anything not in the list of genres.
+	if tagGenre not in genreList:
+		tagGenre = ""
+
+	# If there is no title tag, set it to the filename (without extension).  Otherwise the file will show nothing in XMMS.
+	# Must test this, crazy filenames might cause problems with some encoders.
+	if not tagName:
+		say("No title tag, setting the title of song to the filename")
+		# a stream is named after its (numbered) output, the playlist is the same for all of them.
+		filePathless = os.path.split(job.stream and job.output or job.source)[1]
+		fileBaseName = os.path.splitext(filePathless)[0]
+
+		tagName = fileBaseName
+
+	# setting the bitrate of the output file the same as the input file when the plan says so (no bitrate
+	# option and no encoder options).  Bitrate not used for wav or flac.
+	bitrate = ""
+	if "{bitrate}" in job.encoder:
+		try:
+			# nasty syntax but handles casting of the string 128.0000 to an int (example).
+			bitrate = str(int(float(inBitrate)))
+
+		except (KeyboardInterrupt, SystemExit):
+			gracefulExit()
+
+		except:
+			say("cannot determine bitrate of input, setting output to 128 kbps.")
+			bitrate = "128"
+
+	return FileSettings(tagName, tagAuthor, tagGenre, tagDate, tagAlbum, inBitrate, bitrate)
+
+# converting a single file: decode, tag, normalize, encode and delete.  Returns "done", "skipped" or "failed".
+def convertFile(job, options):
+	# skipped while planning, nothing to read.
+	if job.skip:
+		say("skipping %s, %s" % (job.source, job.skip))
+		return "skipped"
+
+	# the backend programs are given the file names as they are, no quoting needed (see startCommand).
+	sourceFile = job.source
+	file = commandPath(sourceFile)
+
+	# using the file extension to determine what format it is (there could be a better way,
+	# something like the unix command 'file')
+	# converting all to lower case for simplicity
+	fileCaseless = file.lower()
+	inFileExtension = os.path.splitext(fileCaseless)[1]
+
+	if inFileExtension in (".rpm", ".ram") and not job.stream:
+		say("no stream to decode in", file)
+		return "failed"
+	elif inFileExtension not in DECODERS and inFileExtension not in (".wav", ".rpm", ".ram"):
+		say("Error processing file: " + file)
+		say("input format not recognized, please check file extension.")
+		return "failed"
+
+	if job.stream:
+		say("decoding stream:", job.stream)
+	elif inFileExtension != ".wav":
+		say("decoding:" + file)
+
+	# tags, bitrate and this file's encoder settings first.  Nothing is decoded until the file has passed the
+	# skip checks (flac and wav have no bitrate to compare).
+	settings = probeSettings(job, inFileExtension, options)
+	# with --target the job has several outputs, only the ones the bitrate check leaves are written.
+	targets = [target for target in targetJobs(job) if inFileExtension in (".flac", ".wav") or \
+		not badBitrate(file, settings.inBitrate, options, inFileExtension, os.path.splitext(target.output)[1].lower())]
+	if not targets:
+		return "skipped"
+	tagName, tagAuthor, tagGenre, tagDate, tagAlbum = settings[:5]
+
+	# the values for the placeholders of the planned encoder command.  The input is filled in once it is known.
+	encoderValues = {"{title}": tagName, "{artist}": tagAuthor, "{genre}": tagGenre, "{date}": tagDate, \
+		"{album}": tagAlbum, "{bitrate}": settings.bitrate}
+
+	# a file converted before with the same settings (in any run, for any destination) comes from the encode cache.
+	cacheFiles = {}
+	if options.encodeCache:
+		albumGain = options.album and options.albumGains.get(os.path.dirname(os.path.abspath(sourceFile)))
+		for target in targets[:]:
+			values = dict(encoderValues)
+			values["{output}"] = commandPath(target.output)
+			cacheFiles[target.output] = encodeCacheKey(sourceFile, target.encoder, values, \
+				[options.normalize, options.normalizeMode, albumGain, job.stream, options.pcmTarget])
+			if fetchEncodeCache(cacheFiles[target.output], target.output):
+				say("copied from the encode cache:", target.output)
+				targets.remove(target)
+		if not targets:
+			return finishConversion(job, 0, file, None)
+
+	# from here on the job is what is left to write, its first output is the one the single output code below uses.
+	job = withTargets(targets)
+	outFile = job.output
+	outFileExtension = os.path.splitext(outFile)[1].lower()
+
+	# the output is written under a temporary name and only renamed once it is complete (a tempfile until then, so
+	# it goes whatever happens to the job).
+	partFile = partPath(outFile)
+	tempFiles[partFile] = 0
+	encoderValues["{output}"] = commandPath(partFile)
+
+	# user defined tempfile location for the pcm file.
+	# mplayer decoding uses a special tempfile for windows.
+	if options.tempFile:
+		tempFile = options.tempFile
+		# every job needs its own pcm file, so parallel runs add the process id to the user's tempfile.
+		if options.jobs > 1:
+			tempRoot, tempExt = os.path.splitext(tempFile)
+			tempFile = "%s-%d%s" % (tempRoot, os.getpid(), tempExt)
+		tempFiles[tempFile] = 0
+	elif inFileExtension == ".wav":
+		tempFile = None
+	elif options.tmpBudget and inFileExtension in (".mp3", ".ogg", ".flac"):
+		tempFile = newTempFile(wavSizeEstimate(sourceFile))
+	else:
+		tempFile = newTempFile()
+
+	# The decoders are only set up here.  decodeCommand writes the intermediate wav to the tempfile, streamCommand
+	# writes the same wav to standard output (or to a fifo for mplayer) so it can be fed straight into the encoder
+	# without touching the disk.  See DECODERS.
+	decodeCommand = None
+	streamCommand = None
+	streamFifo = False
+
+	# the 'pcm -aofile <filename>' options has changed to '-ao pcm:file=<filename>'
+	# which doesn't like dos filenames! (c:\bla\...) so I'm changing the tempfile path to
+	# point to the working directory.  Also letting user set a tempfile location with a CLI option.
+	if (job.stream or DECODERS.get(inFileExtension) == mplayerDecoders) and os.name == 'nt' and not options.tempFile:
+		removeTempFile(tempFile)
+		tempFile = newTempFile(directory=".")
+
+#         # older syntax, for mplayer 1.0pre5-3.3.4 and similar
+#         decodeString = ('%s -quiet -nolirc -nojoystick -ao pcm -aofile "%s" -vo null -vc dummy "%s"' % (MPLAYER, tempFile, file))
+
+	if job.stream:
+		# one stream of a playlist (see planJobs()).
+#            os.system( '%s -cache 1280 -dumpstream -dumpfile essselection.ra %s' \
+#                % (MPLAYER, stream))
+		## old mplayer syntax
+		#popenString = ('%s -cache 1280 -quiet -nolirc -nojoystick -ao pcm -aofile="%s" -vo null -vc dummy "%s"' % (MPLAYER, tempFile, stream))
+		decodeCommand = mplayerDecodeCommand(job.stream, tempFile, "-cache", "1280")
+
+	elif inFileExtension in DECODERS:
+		decodeCommand, streamCommand, streamFifo = DECODERS[inFileExtension](file, tempFile)
+
+	else:
+		# if its already a wave, leave it as is.  normalize-audio would change it though, it works on a copy.
+		tempFile = file
+		if options.normalize and options.normalizeMode == "external":
+			tempFile = newTempFile(os.path.getsize(sourceFile))
+			shutil.copyfile(sourceFile, tempFile)
+
+	# the cheapest way to the output that works for this file (see pickRoute()).
+	route = pickRoute(inFileExtension, outFileExtension, streamCommand, streamFifo, options, bool(job.fanout))
+	global fileRoute
+	fileRoute = route
+	say("route: %s to %s, %s" % (inFileExtension[1:], outFileExtension[1:], route))
+	builtinNormalize = options.normalize and options.normalizeMode != "external"
+	# the built in normalization and --rate, --channels, --bits go through numpy between the decoder and the encoder.
+	processing = builtinNormalize or options.pcmTarget
+	streaming = route == "piped" and not processing and not job.fanout
+	gain = 1.0
+	if decodeCommand and route == "wav":
+		started = time.time()
+		# --stream-jobs limits how many streams are fetched at once.
+		if job.stream and streamSlots:
+			streamSlots.acquire()
+		try:
+			decodeStatus = runPopenStatus(decodeCommand, options.verbose)[1]
+		finally:
+			if job.stream and streamSlots:
+				streamSlots.release()
+		recordStage("decode", started, decodeStatus, fileSize(sourceFile), fileSize(tempFile))
+		if decodeStatus:
+			say("decoding failed (exit status %d)." % decodeStatus)
+			return "failed"
+		elif job.stream and not fileSize(tempFile):
+			say("nothing was decoded from the stream.")
+			return "failed"
+	elif tempFile != file:
+		# nothing is written to the tempfile (at most it becomes mplayer's fifo).
+		releaseTempBudget(tempFile)
+
+
+	# optional normalization of the wav file
+	started = time.time()
+	if options.normalize and not builtinNormalize:
+		say("normalizing intermediate wav file")
+		normalizeInfo, normalizeStatus = runPopenStatus([NORMALIZE, tempFile], options.verbose)
+		recordStage("normalize", started, normalizeStatus, fileSize(tempFile))
+	elif builtinNormalize:
+		if options.album:
+			gain = options.albumGains.get(os.path.dirname(os.path.abspath(sourceFile)), 1.0)
+		else:
+			gain = normalizeGain([measureWavFile(tempFile)], options.normalizeMode)
+			recordStage("normalize", started, bytesIn=fileSize(tempFile))
+		say("normalizing, gain %+.2f dB" % (20 * math.log10(gain)))
+
+
+	# when streaming, the encoders read the wav from standard output of the decoder (or from mplayer's fifo)
+	# while it is being decoded, instead of reading the tempfile.
+	pcmInput = tempFile
+	decoder = None
+	pcmFeed = None
+	if route == "direct":
+		pcmInput = file
+	elif processing and route == "piped":
+		pcmInput = "-"
+		pcmFeed = processedDecoder(streamCommand, gain, options.pcmTarget)
+	elif processing:
+		pcmInput = "-"
+		pcmFeed = processedWavFile(tempFile, gain, options.pcmTarget)
+	elif streaming and streamFifo:
+		if os.path.exists(tempFile):
+			os.remove(tempFile)
+		os.mkfifo(tempFile)
+		decoder = streamCommand
+	elif streaming:
+		pcmInput = "-"
+		decoder = streamCommand
+
+	# several outputs are all fed the same wav, from the decoder or the tempfile when it isn't processed.
+	if job.fanout:
+		if not pcmFeed and route == "piped":
+			pcmFeed = decodedPieces(streamCommand)
+		elif not pcmFeed:
+			pcmFeed = filePieces(pcmInput)
+		encodeIn = fileSize(sourceFile)
+		if pcmInput == tempFile:
+			encodeIn = fileSize(tempFile)
+		encodeStatus = fanOutEncode(job, encoderValues, pcmFeed, settings, cacheFiles, encodeIn)
+		return finishConversion(job, encodeStatus, file, tempFile)
+
+	encoderValues["{input}"] = pcmInput
+	# an encoder reading the input format may need to be told what it is.
+	encoder = job.encoder
+	if route == "direct":
+		encoder = encoder[:1] + DIRECT_ROUTES[(inFileExtension, outFileExtension)] + encoder[1:]
+
+	# the exit status of the encoder (or whatever wrote the output), anything but 0 fails the file.
+	encodeStatus = 0
+	# a streamed encode includes the decoding, the bytes in are those of the source file then.
+	started = time.time()
+	encodeIn = fileSize(sourceFile)
+	if pcmInput == tempFile:
+		encodeIn = fileSize(tempFile)
+
+	# writing to an ogg or mp3 file, with the tag info included
+	if outFileExtension in (".ogg", ".mp3"):
+		say("encoding:", outFile)
+		encodeStatus = runEncoder(encoderCommand(encoder, encoderValues), options.verbose, pcmFeed, decoder, \
+			streamFifo)
+
+	elif outFileExtension == ".wav":
+		say("outputting:", outFile)
+		if pcmFeed:
+			outputWav = open(partFile, "wb")
+			for data in pcmFeed:
+				outputWav.write(data)
+			outputWav.close()
+		elif streaming:
+			# the decoder can write the output file itself.
+			outputWav = open(partFile, "wb")
+			try:
+				encodeStatus = runPopenStatus(streamCommand, options.verbose, stdout=outputWav)[1]
+			finally:
+				outputWav.close()
+		else:
+			# just copying the tempfile (wav) to the output filename - easy.
+			shutil.copyfile(tempFile, partFile)
+
+	elif outFileExtension == ".flac":
+		say("encoding:", outFile)
+		# writing out from wav to flac format.
+		# a streamed wav header may not carry the real length, flac is told to read to the end instead.
+		if streaming or pcmFeed:
+			encoder = encoder[:1] + ("--ignore-chunk-sizes",) + encoder[1:]
+
+		encodeStatus = runEncoder(encoderCommand(encoder, encoderValues), options.verbose, pcmFeed, decoder, streamFifo)
+		recordStage("encode", started, encodeStatus, encodeIn, fileSize(partFile), streamed=bool(decoder or pcmFeed))
+
+		## Updating tags with metaflac
+		if not encodeStatus:
+			started = time.time()
+			encodeStatus = runPopenStatus(flacTagCommand(settings, commandPath(partFile)), options.verbose)[1]
+			recordStage("tag", started, encodeStatus)
+
+	if outFileExtension != ".flac":
+		recordStage("encode", started, encodeStatus, encodeIn, fileSize(partFile), streamed=bool(decoder or pcmFeed))
+
+	if not encodeStatus:
+		replaceFile(partFile, outFile)
+		if cacheFiles.get(outFile):
+			storeEncodeCache(cacheFiles[outFile], outFile)
+	return finishConversion(job, encodeStatus, file, tempFile)
+
+# metaflac writing the tags of a flac output.  Each one is removed first (metaflac does them in order): flac keeps
+# the tags of a flac input it re-encodes (the direct flac to flac route), which would leave every tag there twice.
+def flacTagCommand(settings, path):
+	command = [METAFLAC]
+	for name, value in (("TITLE", settings.title), ("ARTIST", settings.artist), ("ALBUM", settings.album), \
+		("DATE", settings.date), ("GENRE", settings.genre)):
+		command += ["--remove-tag=" + name, "--set-tag=%s=%s" % (name, value)]
+	return command + [path]
+
+# Encoding a job with several outputs (--target): the wav from pcmFeed goes to all of their encoders at the same
+# time.  Each output is written under its temporary name and renamed once it is complete, one that fails doesn't
+# stop the others.  Returns the exit status, the first that isn't 0 when any of them failed.
+def fanOutEncode(job, encoderValues, pcmFeed, settings, cacheFiles, encodeIn):
+	targets = targetJobs(job)
+	commands = []
+	for target in targets:
+		partFile = partPath(target.output)
+		tempFiles[partFile] = 0
+		outFileExtension = os.path.splitext(target.output)[1].lower()
+		if outFileExtension == ".wav":
+			# written as it comes.
+			commands.append(partFile)
+			continue
+		encoder = target.encoder
+		if outFileExtension == ".flac":
+			encoder = encoder[:1] + ("--ignore-chunk-sizes",) + encoder[1:]
+		values = dict(encoderValues)
+		values["{input}"] = "-"
+		values["{output}"] = commandPath(partFile)
+		commands.append(encoderCommand(encoder, values))
+
+	say("encoding:", join([target.output for target in targets], ", "))
+	started = time.time()
+	statuses = runTeeFeed(commands, options.verbose, pcmFeed)
+	recordStage("encode", started, max(statuses), encodeIn, \
+		sum([fileSize(partPath(target.output)) for target in targets]), streamed=True, outputs=len(targets))
+
+	for index, target in enumerate(targets):
+		partFile = partPath(target.output)
+		if not statuses[index] and os.path.splitext(target.output)[1].lower() == ".flac":
+			started = time.time()
+			statuses[index] = runPopenStatus(flacTagCommand(settings, commandPath(partFile)), options.verbose)[1]
+			recordStage("tag", started, statuses[index])
+		if statuses[index]:
+			say("writing %s failed (exit status %d)." % (target.output, statuses[index]))
+		else:
+			replaceFile(partFile, target.output)
+			if cacheFiles.get(target.output):
+				storeEncodeCache(cacheFiles[target.output], target.output)
+	return ([status for status in statuses if status] + [0])[0]
+
+# The end of converting a file: removing what a failed encoder left, deleting the input with --delete and removing
+# the tempfile.  Returns the status of the file.
+def finishConversion(job, encodeStatus, file, tempFile):
+	sourceFile = job.source
+	status = "done"
+	if encodeStatus:
+		say("encoding failed (exit status %d), removing the incomplete output file." % encodeStatus)
+		status = "failed"
+		# it never got its real name, whatever was there before (the input, for a file converted to itself) is left.
+		for target in targetJobs(job):
+			removeTempFile(partPath(target.output))
+
+	# dangerous option here, deleting the input file after conversion
+	# Todo: only run these two cleanup items if no exceptions have been raised.
+	# A staged output isn't on the target yet, the source is deleted once it is (see the main loop).  A playlist
+	# is kept, its other streams may still be converting.
+	elif options.delSource and not options.stageDir and not job.stream:
+		# if the output file doesn't exist, something went wrong and we should not delete the source
+		# even if --delete is specified.
+		outputs = [target.output for target in targetJobs(job)]
+		if not all([os.path.isfile(output) for output in outputs]):
+			say("Output file does not exist, input file will not be deleted.")
+			status = "failed"
+
+		# if the new output filename is the same as the original input, dont delete original
+		# because it has already been overwritten by the new one.
+		elif sourceFile not in outputs:
+			# removing the input file
+			try:
+				os.remove(sourceFile)
+
+			# exiting normally if control-c is hit instead of deleting file!
+			except (KeyboardInterrupt, SystemExit):
+				gracefulExit()
+
+			except:
+				say("could not remove input file:", file)
+
+	# manually removing tempfiles just to make sure the disk doesn't get cluttered
+	if tempFile != file:
+		removeTempFile(tempFile)
+
+	say("----")
+	return status
+
+# The entries of a directory as (name, is a directory, is a file), sorted by name.  Links to directories don't
+# count as directories, like os.walk they are not followed.
+def scanDir(directory):
+	entries = []
+	if scandir:
+		for entry in scandir(directory):
+			entries.append((entry.name, entry.is_dir(follow_symlinks=False), entry.is_file()))
+	else:
+		for name in os.listdir(directory):
+			path = os.path.join(directory, name)
+			entries.append((name, os.path.isdir(path) and not os.path.islink(path), os.path.isfile(path)))
+	entries.sort()
+	return entries
+
+def matchesAny(name, patterns):
+	for pattern in patterns:
+		if fnmatch(name, pattern):
+			return True
+	return False
+
+# Reading a list of files to convert (--files-from) as it is written, so a long running selection (eg. tag -0 --find
+# or find -print0) feeds the conversion while it goes.  Names end with a NUL or a newline, whichever of the two comes
+# first is the delimiter of the whole list (names with newlines in them need a NUL delimited list).
+def readFileList(path):
+	if path == "-":
+		listFile = sys.stdin
+	else:
+		listFile = open(path, "rb")
+	delimiter = None
+	pending = ""
+	try:
+		while True:
+			# whatever there is so far, without waiting for a full buffer.
+			data = os.read(listFile.fileno(), 65536)
+			if not data:
+				break
+			pending += data
+			if not delimiter:
+				ends = [pending.find(end) for end in ("\0", "\n") if end in pending]
+				if not ends:
+					continue
+				delimiter = pending[min(ends)]
+			names = pending.split(delimiter)
+			pending = names.pop()
+			for name in names:
+				if delimiter == "\n":
+					name = name.rstrip("\r")
+				if name:
+					yield name
+		if pending.rstrip("\r\n"):
+			yield pending.rstrip("\r\n")
+	finally:
+		if listFile is not sys.stdin:
+			listFile.close()
+
+# The listed files that are converted: the same include, exclude and extension rules as for the files that are
+# searched for, and with --dest-dir only files under the source root (anywhere else has no place there).
+def listedFiles(names, sourceRoot, includes, excludes=(), extensions=None):
+	rootPrefix = os.path.join(os.path.abspath(sourceRoot), "")
+	for name in names:
+		path = os.path.normpath(name)
+		if includes and not matchesAny(os.path.basename(path), includes):
+			continue
+		elif [part for part in path.split(os.sep) if matchesAny(part, excludes)]:
+			continue
+		elif extensions and os.path.splitext(path)[1][1:].lower() not in extensions:
+			continue
+		elif options.destDir and not os.path.abspath(path).startswith(rootPrefix):
+			print path, "is not under the source root, skipping."
+		elif not os.path.isfile(path):
+			print path, "not a regular file, skipping."
+		else:
+			yield path
+
+# Finding the files to convert, yielding each one as soon as it is found.  A file is taken if its name matches one
+# of the include patterns, has one of the extensions (when any are given) and doesn't match an exclude pattern.
+# Directories are searched one at a time, in order, each one's files before its subdirectories.  Nothing here
+# changes directory or goes through glob, so square brackets and other odd characters in paths are harmless.
+def findFiles(topDir, includes, excludes=(), extensions=None, recursive=False):
+	directories = [topDir]
+	while directories:
+		directory = directories.pop()
+		try:
+			entries = scanDir(directory)
+		except OSError, error:
+			print "could not read directory %s: %s" % (directory, error.strerror)
+			continue
+
+		subdirs = []
+		for name, isDir, isFile in entries:
+			if matchesAny(name, excludes):
+				continue
+			path = os.path.normpath(os.path.join(directory, name))
+			if isDir:
+				if recursive:
+					subdirs.append(path)
+			elif not matchesAny(name, includes):
+				continue
+			# an output an interrupted run didn't finish (see partPath()).
+			elif name.startswith(".") and name.endswith(".part"):
+				continue
+			elif extensions and os.path.splitext(name)[1][1:].lower() not in extensions:
+				continue
+			elif isFile:
+				yield path
+			else:
+				print path, "not a regular file, skipping."
+
+		# a stack, so the subdirectories are reversed to come off it in order.
+		subdirs.reverse()
+		directories.extend(subdirs)
+
+# Selecting files by tag (--tag), like the README's "tag --find" workflow but built in.  The tags are the comma
+# separated user.xdg.tags extended attribute that linux file managers write.  A tagged file is selected, and a tagged
+# directory selects everything under it.  Reading the attributes of every file of a large library on each run is
+# slow (especially over the network), so what was read is kept in an index (--tag-index) with the modification and
+# change times of each directory, and a directory is only read again when they have changed.  Tagging a directory
+# changes its change time, tagging a file only changes the file: --tag-rescan reads everything again.
+TAG_ATTRIBUTE = "user.xdg.tags"
+TAG_INDEX = os.path.join(os.path.expanduser("~"), ".audio_conv_tags.db")
+
+# the tags of a file or directory, as a list.
+def readTags(path):
+	try:
+		if getxattr:
+			value = getxattr(path, TAG_ATTRIBUTE)
+		else:
+			value = libcGetxattr(path, TAG_ATTRIBUTE)
+	except (IOError, OSError):
+		# no tags, or a filesystem without extended attributes.
+		return []
+	return splitTags(value)
+
+def splitTags(value):
+	return [tag.strip() for tag in (value or "").split(",") if tag.strip()]
+
+def libcGetxattr(path, name):
+	size = libc.getxattr(path, name, None, 0)
+	if size > 0:
+		value = ctypes.create_string_buffer(size)
+		size = libc.getxattr(path, name, value, size)
+		if size >= 0:
+			return value.raw[:size]
+	if size < 0:
+		raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+	return ""
+
+def openTagIndex(path):
+	db = sqlite3.connect(path, timeout=60)
+	db.text_factory = str
+	db.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime REAL, ctime REAL, tags TEXT)")
+	db.execute("CREATE TABLE IF NOT EXISTS files (directory TEXT, name TEXT, tags TEXT)")
+	db.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+	return {"db": db, "directories": {}, "selected": {}, "read": 0}
+
+# The tags of a directory and those of its files (by name, only the files that have any), from the index if the
+# directory hasn't changed.
+def directoryTags(index, directory):
+	if directory in index["directories"]:
+		return index["directories"][directory]
+	path = os.path.abspath(directory)
+	stat = os.stat(directory)
+	db = index["db"]
+	row = None
+	if not options.tagRescan:
+		row = db.execute("SELECT tags FROM directories WHERE path = ? AND mtime = ? AND ctime = ?", \
+			(path, stat.st_mtime, stat.st_ctime)).fetchone()
+	if row:
+		files = dict([(name, splitTags(fileTags)) for name, fileTags in \
+			db.execute("SELECT name, tags FROM files WHERE directory = ?", (path,))])
+		tags = (splitTags(row[0]), files)
+	else:
+		files = {}
+		for name, isDir, isFile in scanDir(directory):
+			if isFile:
+				fileTags = readTags(os.path.join(directory, name))
+				if fileTags:
+					files[name] = fileTags
+		tags = (readTags(directory), files)
+		index["read"] += 1
+		db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)", (path, stat.st_mtime, stat.st_ctime, \
+			join(tags[0], ",")))
+		db.execute("DELETE FROM files WHERE directory = ?", (path,))
+		db.executemany("INSERT INTO files VALUES (?, ?, ?)", [(path, name, join(fileTags, ",")) for name, fileTags \
+			in files.items()])
+	index["directories"][directory] = tags
+	return tags
+
+def tagsMatch(tags, patterns):
+	for tag in tags:
+		if matchesAny(tag, patterns):
+			return True
+	return False
+
+# whether a directory or one above it (up to the top directory) has one of the tags.
+def directorySelected(index, directory, topDir, patterns):
+	if directory not in index["selected"]:
+		selected = tagsMatch(directoryTags(index, directory)[0], patterns)
+		parent = os.path.dirname(directory)
+		if not selected and os.path.normpath(directory) != os.path.normpath(topDir) and parent != directory:
+			selected = directorySelected(index, parent or os.curdir, topDir, patterns)
+		index["selected"][directory] = selected
+	return index["selected"][directory]
+
+# the files with one of the tags (patterns like those of --include), or in a directory that has one.
+def taggedFiles(files, patterns, topDir, indexPath):
+	index = openTagIndex(indexPath)
+	try:
+		for file in files:
+			directory = os.path.dirname(file) or os.curdir
+			try:
+				if tagsMatch(directoryTags(index, directory)[1].get(os.path.basename(file), []), patterns) or \
+						directorySelected(index, directory, topDir, patterns):
+					yield file
+			except OSError, error:
+				print "could not read the tags of %s: %s" % (file, error.strerror)
+		if options.verbose:
+			print "tags read from %d directories, %d from the index" % (index["read"], \
+				len(index["directories"]) - index["read"])
+	finally:
+		index["db"].commit()
+		index["db"].close()
+
+# The plan of a run.  Every file is compiled into a job before anything is converted: where the output goes, the
+# encoder command line and, when it is already known, why the file is skipped.  The encoder command has placeholders
+# for what is only known once the file is read (the tags, and the bitrate when it is copied from the input) and for
+# the input and output files, convertFile() fills them in.  Jobs are plain tuples so they can be saved with --save-plan and run
+# later with --run-plan, on this machine or split between several.  A job for one stream of a .rpm/.ram playlist has
+# the playlist as its source and the address of the stream in stream (None for everything else).  The outputs of
+# --target besides the first are in fanout, as (output, encoder) pairs.
+Job = namedtuple("Job", "source output encoder skip stream fanout")
+
+# every output of a job as a job of its own.
+def targetJobs(job):
+	return [job._replace(fanout=())] + [job._replace(output=output, encoder=encoder, fanout=()) \
+		for output, encoder in job.fanout]
+
+# the job writing the outputs of these (single output) jobs of the same file.
+def withTargets(targets):
+	return targets[0]._replace(fanout=tuple([(target.output, target.encoder) for target in targets[1:]]))
+
+# the streams of a .rpm/.ram playlist, one address per line.  Blank lines, comments and RealPlayer's --stop--
+# marker are left out.
+def playlistStreams(path):
+	playlist = open(path)
+	try:
+		streams = []
+		for line in playlist:
+			line = line.strip()
+			if line and not line.startswith("#") and line != "--stop--":
+				streams.append(line)
+		return streams
+	finally:
+		playlist.close()
+
+
+ENCODER_TAGS = {
+	".ogg": ["-t", "{title}", "-a", "{artist}", "-G", "{genre}", "-d", "{date}", "-l", "{album}"],
+	".mp3": ["--tt", "{title}", "--ta", "{artist}", "--tg", "{genre}", "--ty", "{date}", "--tl", "{album}", "-h"]}
+
+# the encoder command line for an output format, the same for every file of a run.
+def encoderArgv(outFileExtension, options, encodeOption):
+	# custom encoder options replace the bitrate option.
+	bitrate = []
+	if encodeOption:
+		pass
+	elif options.bitrate:
+		bitrate = ["-b", str(options.bitrate)]
+	else:
+		bitrate = ["-b", "{bitrate}"]
+	encodeOption = shlex.split(encodeOption)
+
+	if outFileExtension == ".ogg":
+		return [OGGENC] + ENCODER_TAGS[".ogg"] + bitrate + encodeOption
+	elif outFileExtension == ".mp3":
+		return [LAME] + ENCODER_TAGS[".mp3"] + bitrate + encodeOption
+	elif outFileExtension == ".flac":
+		return [FLAC, "-f"] + encodeOption
+	# wav output is written without an encoder.
+	return []
+
+# The output of a file without its extension.  It goes next to the input, or with a destination directory to the
+# same place under it as the input is under the top directory.
+def outputBase(file, destDirAbs, topDir):
+	if not destDirAbs:
+		return os.path.splitext(file)[0]
+	topPrefix = os.path.join(os.path.normpath(topDir), "")
+	if file.startswith(topPrefix):
+		relativePath = file[len(topPrefix):]
+	elif topPrefix == os.path.join(".", "") and not os.path.isabs(file):
+		relativePath = file
+	else:
+		relativePath = os.path.relpath(os.path.abspath(file), os.path.abspath(topDir))
+	return os.path.splitext(os.path.join(destDirAbs, relativePath))[0]
+
+def planJobs(files, options, topDir):
+	global probeHits
+	outFileExtension = outputExtension(options)
+	encoder = tuple(encoderArgv(outFileExtension, options, options.encodeOption) + ["{input}", "-o", "{output}"])
+	destDirAbs = None
+	if options.destDir:
+		destDirAbs = os.path.abspath(options.destDir)
+	# the other outputs of --target, as (extension, destination directory, encoder).
+	fanout = [(extension, directory and os.path.abspath(directory), \
+		tuple(encoderArgv(extension, options, encodeOption) + ["{input}", "-o", "{output}"])) \
+		for extension, directory, encodeOption in options.fanout]
+
+	for file in files:
+		# the output replaces the extension with the new one, and with --dest-dir it goes to the same place under
+		# the destination directory as the input is under the top directory.
+		outputs = [outputBase(file, destDirAbs, topDir)] + \
+			[outputBase(file, directory, topDir) for extension, directory, targetEncoder in fanout]
+		output = outputs[0] + outFileExtension
+		targets = tuple([(base + extension, targetEncoder) for base, (extension, directory, targetEncoder) in \
+			zip(outputs[1:], fanout)])
+
+		# files the probe cache already knows about get the bitrate check now, without reading them.  The lookup
+		# only counts as a cache hit if no job will make it again (the file is skipped, or nothing is converted).
+		skip = None
+		inFileExtension = os.path.splitext(file.lower())[1]
+		# (with --target convertFile() checks each output.)
+		if options.probeCache and options.bitrate and not fanout and \
+			inFileExtension in (".mp3", ".ogg", ".wma", ".rm", ".ra"):
+			tags = cachedProbe(file, options.probeCache)
+			if tags:
+				try:
+					skip = bitrateSkipReason(tags[5], options, inFileExtension, outFileExtension)
+				except ValueError:
+					pass
+				if skip or options.dryRun or options.savePlan:
+					probeHits += 1
+
+		# every stream of a playlist is a job of its own, numbered when there's more than one.
+		if inFileExtension in (".rpm", ".ram") and not skip:
+			try:
+				streams = playlistStreams(file)
+			except (IOError, OSError), error:
+				streams = []
+				skip = "can't read the playlist (%s)" % error.strerror
+			if not streams and not skip:
+				skip = "no streams in the playlist"
+			for number, stream in enumerate(streams):
+				job = Job(file, output, encoder, skip, stream, targets)
+				if len(streams) > 1:
+					job = withTargets([target._replace(output="%s-%02d%s" % (os.path.splitext(target.output)[0], \
+						number + 1, os.path.splitext(target.output)[1])) for target in targetJobs(job)])
+				yield job
+			if streams:
+				continue
+
+		yield Job(file, output, encoder, skip, None, targets)
+
+# Fitting a run on a drive of a given size (--max-size).  The size of each output is estimated from the length of
+# the input (read from its headers) and the bitrate the encoder will use, then the files are picked in the chosen
+# order as long as they fit.  The ones left out are skipped in the plan, so nothing is spent encoding them.
+FIT_ORDERS = ("directory", "smallest", "priority")
+# flac output is taken to be about this much of the wav.
+FLAC_RATIO = 0.6
+# the average bitrates of the vbr quality levels of oggenc (-q) and lame (-V).
+VORBIS_QUALITY_KBPS = {-1: 45, 0: 64, 1: 80, 2: 96, 3: 112, 4: 128, 5: 160, 6: 192, 7: 224, 8: 256, 9: 320, 10: 500}
+LAME_VBR_KBPS = {0: 245, 1: 225, 2: 190, 3: 175, 4: 165, 5: 130, 6: 115, 7: 100, 8: 85, 9: 65}
+
+# the bitrate a job's encoder command will give, in kbps.
+def encoderBitrate(encoder, info):
+	kbps = None
+	if encoder and os.path.basename(encoder[0]) == OGGENC:
+		kbps = VORBIS_QUALITY_KBPS[3]
+	for option, value in zip(encoder, encoder[1:]):
+		try:
+			if option == "{bitrate}":
+				continue
+			elif value == "{bitrate}":
+				# the same as the input, like convertFile() does.
+				kbps = int(float(info["bitrate"] or 128))
+			elif option in ("-b", "--abr"):
+				kbps = int(value)
+			elif option == "-q":
+				kbps = VORBIS_QUALITY_KBPS.get(int(float(value)), kbps)
+			elif option == "-V":
+				kbps = LAME_VBR_KBPS.get(int(float(value)), kbps)
+		except ValueError:
+			pass
+	return kbps or 128
+
+# The estimated size of a job's output in bytes.  Files whose length can't be read from the headers (wma, real
+# audio) are guessed to come out the size they went in.
+def outputSizeEstimate(job):
+	info = readAudioInfo(job.source)
+	outFileExtension = os.path.splitext(job.output)[1].lower()
+	if not info or not info.get("duration"):
+		return os.path.getsize(job.source)
+	elif outFileExtension in (".wav", ".flac"):
+		size = wavSizeEstimate(job.source) or os.path.getsize(job.source)
+		if outFileExtension == ".flac":
+			size = int(size * FLAC_RATIO)
+		return size
+	return int(info["duration"] * encoderBitrate(job.encoder, info) * 1000 / 8)
+
+# the place of a file in the --priority patterns, files matching none of them come last.
+def fitPriority(file, patterns):
+	for index, pattern in enumerate(patterns):
+		if fnmatch(file, pattern) or fnmatch(os.path.basename(file), pattern):
+			return index
+	return len(patterns)
+
+# Choosing the jobs that fit in maxSize, keeping them in the order of the plan.  Every file has to be estimated
+# before anything is chosen, so this reads all the headers up front.
+def fitJobs(jobs, maxSize, order, priorities):
+	jobs = list(jobs)
+	sizes = []
+	for index, job in enumerate(jobs):
+		if job.skip:
+			continue
+		try:
+			sizes.append((index, sum([outputSizeEstimate(target) for target in targetJobs(job)])))
+		except OSError, error:
+			print "could not estimate the output of %s: %s" % (job.source, error.strerror)
+
+	if order == "smallest":
+		sizes.sort(key=lambda item: item[1])
+	elif order == "priority":
+		sizes.sort(key=lambda item: fitPriority(jobs[item[0]].source, priorities))
+
+	total = leftOut = leftOutSize = 0
+	for index, size in sizes:
+		if total + size <= maxSize:
+			total += size
+		else:
+			jobs[index] = jobs[index]._replace(skip="doesn't fit in --max-size (about %.1f MB)" % (size / 1048576.0))
+			leftOut += 1
+			leftOutSize += size
+
+	# with --save-plan - the plan itself is on standard output.
+	report = sys.stdout
+	if options.savePlan == "-":
+		report = sys.stderr
+	print >>report, "estimated output: %d file(s), %.1f MB of %.1f MB" % (len(sizes) - leftOut, \
+		total / 1048576.0, maxSize / 1048576.0)
+	if leftOut:
+		print >>report, "%d file(s) left out to fit, %.1f MB" % (leftOut, leftOutSize / 1048576.0)
+	return jobs
+
+# Finding the same recording more than once with --dedupe.  The files are grouped by the cheap keys first: the
+# artist and title (lower case, without punctuation) and the length from their headers.  Lossless copies decode to
+# the same samples, they are confirmed by the STREAMINFO md5 of two flacs or a hash of the decoded samples.  Lossy
+# copies only decode the same when they are the same file (not two encodes at different bitrates, or in different
+# formats), for those the keys decide.  The best copy of each recording is kept, the other jobs are skipped.
+DEDUPE_MODES = ("skip", "link")
+DUPLICATES_NAME = "audio_conv_duplicates.txt"
+# how many seconds apart the lengths of two copies can be.
+DEDUPE_LENGTH_SLACK = 1.0
+LOSSLESS_EXTENSIONS = (".flac", ".wav")
+
+Candidate = namedtuple("Candidate", "index source extension info quality")
+
+def dedupeKey(info):
+	words = []
+	for tag in (info["artist"], info["title"]):
+		words.append(join("".join([c for c in tag.lower() if c.isalnum() or c.isspace()]).split()))
+	if not words[0] or not words[1] or not info.get("duration"):
+		return None
+	return tuple(words)
+
+# lossless before lossy, then the higher resolution or bitrate.
+def sourceQuality(extension, info):
+	if extension in LOSSLESS_EXTENSIONS:
+		return (1, info.get("sampleRate", 0) * info.get("bitsPerSample", 0), 0.0)
+	try:
+		return (0, 0, float(info["bitrate"] or 0))
+	except ValueError:
+		return (0, 0, 0.0)
+
+# whether the audio of two copies can be compared at all, and whether the flac md5s do it.
+def comparableAudio(first, second):
+	return first.extension in LOSSLESS_EXTENSIONS and second.extension in LOSSLESS_EXTENSIONS
+
+# two lossy copies that are the same bytes, for the report.
+def identicalFiles(first, second):
+	return first.extension == second.extension and \
+		os.path.getsize(first.source) == os.path.getsize(second.source) and \
+		fileHash(first.source) == fileHash(second.source)
+
+def flacMd5Pair(first, second):
+	unset = "0" * 32
+	return first.extension == second.extension == ".flac" and first.info.get("md5", unset) != unset and \
+		second.info.get("md5", unset) != unset
+
+# the copies whose lengths are close enough and whose audio is compared, with the decoded samples or not.
+def dedupePairs(group):
+	for position, first in enumerate(group):
+		for second in group[position + 1:]:
+			if abs(first.info["duration"] - second.info["duration"]) <= DEDUPE_LENGTH_SLACK:
+				yield first, second
+
+def sameRecording(first, second, hashes):
+	if not comparableAudio(first, second):
+		return True
+	elif flacMd5Pair(first, second):
+		return first.info["md5"] == second.info["md5"]
+	return hashes.get(first.source) is not None and hashes.get(first.source) == hashes.get(second.source)
+
+# A hash of the decoded samples of a file (without its header), None if it can't be decoded.
+def audioHashJob(file):
+	inFileExtension = os.path.splitext(file.lower())[1]
+	digest = hashlib.sha1()
+	try:
+		if inFileExtension == ".wav":
+			pcmFile = open(file, "rb")
+			decoder = None
+		else:
+			command = pcmStreamCommand(commandPath(file), inFileExtension)
+			decoder = startCommand(command, stdout=PIPE, stderr=open(os.devnull, "w"))
+			pcmFile = decoder.stdout
+		try:
+			# a length that isn't known is the rest of the stream.
+			left = readWavHeader(pcmFile)["dataSize"]
+			if left in (0, 0xffffffff) or decoder:
+				left = None
+			while left is None or left > 0:
+				data = pcmFile.read(min(left or ENCODE_CACHE_BLOCK, ENCODE_CACHE_BLOCK))
+				if not data:
+					break
+				digest.update(data)
+				if left is not None:
+					left -= len(data)
+		finally:
+			pcmFile.close()
+			if decoder:
+				finishCommand(decoder, command)
+		if decoder and decoder.returncode:
+			return file, None
+
+	except (KeyboardInterrupt, SystemExit):
+		gracefulExit()
+
+	except:
+		say("could not decode", file, "to compare it")
+		return file, None
+
+	return file, digest.hexdigest()
+
+# Marking the jobs of the copies that aren't the best as skipped.  Returns the jobs and the duplicates, as (job,
+# kept job, how it was confirmed).
+def dedupeJobs(jobs):
+	jobs = list(jobs)
+	groups = {}
+	for index, job in enumerate(jobs):
+		inFileExtension = os.path.splitext(job.source.lower())[1]
+		if job.skip or job.stream or (inFileExtension != ".wav" and not pcmStreamCommand(job.source, inFileExtension)):
+			continue
+		info = readAudioInfo(job.source)
+		key = info and dedupeKey(info)
+		if key:
+			groups.setdefault(key, []).append(Candidate(index, job.source, inFileExtension, info, \
+				sourceQuality(inFileExtension, info)))
+	groups = [group for group in groups.values() if len(group) > 1]
+	# with --save-plan - the plan itself is on standard output.
+	report = sys.stdout
+	if options.savePlan == "-":
+		report = sys.stderr
+
+	# decoding (in parallel) only what can't be told apart any other way.
+	needed = set()
+	for group in groups:
+		for first, second in dedupePairs(group):
+			if comparableAudio(first, second) and not flacMd5Pair(first, second):
+				needed.update((first.source, second.source))
+	if needed:
+		print >>report, "comparing the audio of %d possible duplicate(s)" % len(needed)
+	hashes = dict(runJobs(audioHashJob, sorted(needed)))
+
+	duplicates = []
+	for group in groups:
+		# the best copy first, and of equal ones the first in the plan.
+		group.sort(key=lambda candidate: candidate.quality, reverse=True)
+		kept = []
+		for candidate in group:
+			for best in kept:
+				if abs(best.info["duration"] - candidate.info["duration"]) <= DEDUPE_LENGTH_SLACK and \
+					sameRecording(best, candidate, hashes):
+					confirmed = "same tags and length"
+					if comparableAudio(best, candidate):
+						confirmed = "same audio"
+					elif identicalFiles(best, candidate):
+						confirmed = "identical file"
+					jobs[candidate.index] = jobs[candidate.index]._replace(skip="duplicate of %s" % best.source)
+					duplicates.append((jobs[candidate.index], jobs[best.index], confirmed))
+					break
+			else:
+				kept.append(candidate)
+
+	if duplicates:
+		print >>report, "%d duplicate(s) found, only the best copy is converted." % len(duplicates)
+	duplicates.sort(key=lambda duplicate: duplicate[0].source)
+	return jobs, duplicates
+
+# Giving the duplicates the output of the copy that was converted, with --dedupe link.  Returns what became of each.
+def linkDuplicates(duplicates):
+	results = []
+	for job, keptJob, confirmed in duplicates:
+		# every output (of --target) on its own.
+		linked = []
+		for target, keptTarget in zip(targetJobs(job), targetJobs(keptJob)):
+			if not os.path.isfile(keptTarget.output):
+				linked.append("not linked, %s was not converted" % keptTarget.source)
+			elif os.path.abspath(target.output) == os.path.abspath(keptTarget.output):
+				linked.append("skipped, same output")
+			else:
+				try:
+					if not os.path.isdir(os.path.dirname(target.output) or "."):
+						os.makedirs(os.path.dirname(target.output))
+					placeFile(keptTarget.output, target.output)
+					linked.append("linked to %s" % keptTarget.output)
+				except (IOError, OSError), error:
+					linked.append("not linked (%s)" % error.strerror)
+		results.append(join(linked, "; "))
+	return results
+
+def writeDuplicateReport(reportFile, duplicates, results):
+	for (job, keptJob, confirmed), result in zip(duplicates, results):
+		print >>reportFile, "%s\n\tduplicate of %s (%s)\n\t%s" % (job.source, keptJob.source, confirmed, result)
+
+# making the output directories of the jobs as they go by, each one only once.
+def createOutputDirs(jobs):
+	created = set()
+	for job in jobs:
+		for target in targetJobs(job):
+			directory = os.path.dirname(target.output)
+			if job.skip or not directory or directory in created:
+				continue
+			created.add(directory)
+			started = time.time()
+			if not os.path.isdir(directory):
+				say("The following output directory doesn't exist, creating:", directory)
+				try:
+					os.makedirs(directory)
+				except OSError:
+					# another run may have created it in the meantime.
+					if not os.path.isdir(directory):
+						raise
+			recordStage("mkdir", started, file=directory, format=None)
+		yield job
+
+# Staged output, for slow targets like usb flash drives that can't keep up with several jobs writing to them at
+# once.  With --stage-dir the jobs write their outputs to fast local storage, and a single writer thread copies the
+# finished files to the destination one at a time in the order of the plan (which is directory order), with large
+# writes.  Each file is written under a hidden name and renamed into place after the data has been synced, so a
+# half written track never appears on the target.  The syncs are done in batches to spare the drive.
+STAGE_BUFFER = 4 * 1024 * 1024
+STAGE_SYNC_BYTES = 64 * 1024 * 1024
+
+# giving each job a name in the stage directory to write to, and remembering where the file really goes.
+def stageJobs(jobs, writer):
+	for job in jobs:
+		seq = writer["planned"]
+		writer["planned"] += 1
+		stagedOutput = os.path.join(options.stageDir, "%sstage-%d-%s" % (options.tempPrefix, seq, \
+			os.path.basename(job.output)))
+		writer["staged"][stagedOutput] = (seq, job)
+		yield job._replace(output=stagedOutput)
+
+def startStagedWriter():
+	if not os.path.isdir(options.stageDir):
+		os.makedirs(options.stageDir)
+	writer = {"queue": Queue.Queue(), "landed": Queue.Queue(), "stop": threading.Event(), "staged": {}, \
+		"finished": {}, "planned": 0, "next": 0, "files": 0, "bytes": 0, "seconds": 0.0}
+	writer["thread"] = threading.Thread(target=stagedWriter, args=(writer,))
+	writer["thread"].daemon = True
+	writer["thread"].start()
+	return writer
+
+# A job is done with its staged output (stagedOutput is None if it made no file).  The files are handed to the
+# writer in the order of the plan, so a slow job holds back the ones after it until it is finished.  Returns the job
+# with its real output.
+def stageFinished(writer, stagedOutput, status):
+	seq, job = writer["staged"].pop(stagedOutput)
+	if status != "done":
+		stagedOutput = None
+	writer["finished"][seq] = (job, stagedOutput)
+	while writer["next"] in writer["finished"]:
+		writer["queue"].put(writer["finished"].pop(writer["next"]))
+		writer["next"] += 1
+	return job
+
+# the jobs whose files have reached the target since the last call, as (job, True) or (job, False) if it failed.
+def landedJobs(writer):
+	landed = []
+	while True:
+		try:
+			landed.append(writer["landed"].get_nowait())
+		except Queue.Empty:
+			return landed
+
+def stagedWriter(writer):
+	batch = []
+	batchBytes = 0
+	created = set()
+	while True:
+		item = writer["queue"].get()
+		if item is None or writer["stop"].is_set():
+			break
+		job, stagedOutput = item
+		if not stagedOutput:
+			continue
+
+		partFile = os.path.join(os.path.dirname(job.output), "." + os.path.basename(job.output) + ".part")
+		started = time.time()
+		try:
+			directory = os.path.dirname(job.output)
+			if directory and directory not in created:
+				created.add(directory)
+				if not os.path.isdir(directory):
+					say("The following output directory doesn't exist, creating:", directory)
+					os.makedirs(directory)
+
+			source = open(stagedOutput, "rb")
+			target = open(partFile, "wb")
+			copied = False
+			try:
+				while not writer["stop"].is_set():
+					data = source.read(STAGE_BUFFER)
+					if not data:
+						copied = True
+						break
+					target.write(data)
+					batchBytes += len(data)
+					writer["bytes"] += len(data)
+			finally:
+				source.close()
+				target.close()
+			if not copied:
+				# stopped half way: the part never gets the real name, the staged file is swept with the others.
+				os.remove(partFile)
+				writer["seconds"] += time.time() - started
+				break
+			os.remove(stagedOutput)
+			batch.append((job, partFile))
+
+		except (IOError, OSError), error:
+			say("could not copy %s to %s: %s" % (stagedOutput, job.output, error))
+			for path in (partFile, stagedOutput):
+				if os.path.exists(path):
+					os.remove(path)
+			writer["landed"].put((job, False))
+		writer["seconds"] += time.time() - started
+
+		# syncing what has been written every so often, and whenever the writer is about to wait for more.
+		if batch and (batchBytes >= STAGE_SYNC_BYTES or writer["queue"].empty()):
+			syncStagedBatch(writer, batch)
+			batch = []
+			batchBytes = 0
+
+	# only files copied to the end are in the batch, they are put in place even when the writer was stopped.
+	if batch:
+		syncStagedBatch(writer, batch)
+
+def syncStagedBatch(writer, batch):
+	started = time.time()
+	directories = set()
+	for job, partFile in batch:
+		try:
+			if os.name != 'nt':
+				partFd = os.open(partFile, os.O_RDONLY)
+				try:
+					os.fsync(partFd)
+				finally:
+					os.close(partFd)
+			if os.name == 'nt' and os.path.exists(job.output):
+				os.remove(job.output)
+			os.rename(partFile, job.output)
+			directories.add(os.path.dirname(job.output))
+			writer["files"] += 1
+			writer["landed"].put((job, True))
+		except OSError, error:
+			say("could not write %s: %s" % (job.output, error))
+			writer["landed"].put((job, False))
+
+	# the renames are only safe on the drive once the directories are synced too.
+	if os.name != 'nt':
+		for directory in directories:
+			try:
+				directoryFd = os.open(directory or ".", os.O_RDONLY)
+				try:
+					os.fsync(directoryFd)
+				finally:
+					os.close(directoryFd)
+			except OSError:
+				pass
+	writer["seconds"] += time.time() - started
+
+# Waiting for the writer to copy the rest (or, when interrupted, to stop after the file it is on).
+def stopStagedWriter(writer, interrupted=False):
+	if interrupted:
+		writer["stop"].set()
+	writer["queue"].put(None)
+	while writer["thread"].is_alive():
+		writer["thread"].join(1)
+
+# A plan is saved as json, one job per line with absolute paths, so it can be cut into parts with a text tool.
+def savePlan(jobs, path):
+	if path == "-":
+		planFile = sys.stdout
+	else:
+		planFile = open(path, "w")
+	count = 0
+	for job in jobs:
+		job = withTargets([target._replace(source=os.path.abspath(target.source), \
+			output=os.path.abspath(target.output)) for target in targetJobs(job)])
+		try:
+			planFile.write(json.dumps(job._asdict()) + "\n")
+			count += 1
+		except UnicodeDecodeError:
+			print >>sys.stderr, "%s is not a utf-8 path, it can't be saved in a plan." % job.source
+	if planFile is not sys.stdout:
+		planFile.close()
+		print count, "job(s) saved to", path
+
+def loadPlan(path):
+	if path == "-":
+		planFile = sys.stdin
+	else:
+		planFile = open(path)
+	for line in planFile:
+		if not line.strip():
+			continue
+		fields = json.loads(line)
+		# json gives unicode, the rest of the program works with utf-8 strings like the paths it finds itself.
+		encoder = tuple([arg.encode("utf-8") for arg in fields["encoder"]])
+		skip = fields["skip"] and fields["skip"].encode("utf-8")
+		# plans saved before playlist streams were jobs of their own don't have the field.
+		stream = fields.get("stream") and fields["stream"].encode("utf-8")
+		fanout = tuple([(output.encode("utf-8"), tuple([arg.encode("utf-8") for arg in targetEncoder])) \
+			for output, targetEncoder in fields.get("fanout") or ()])
+		yield Job(fields["source"].encode("utf-8"), fields["output"].encode("utf-8"), encoder, skip, stream, fanout)
+
+def printJob(job):
+	if job.skip:
+		print "skipping %s, %s" % (job.source, job.skip)
+	elif job.stream:
+		print "Input File:", job.source, "\nStream:", job.stream, "\nOutput File:", job.output
+	else:
+		print "Input File:", job.source, "\nOutput File:", job.output
+	if not job.skip:
+		for output, encoder in job.fanout:
+			print "Output File:", output
+		print "Route:", plannedRoute(job, options)
+
+# a job is one file.  Anything that goes wrong is reported against that file and the run carries on with the rest.
+def convertJob(job):
+	global jobLabel
+	if options.jobs > 1:
+		jobLabel = os.path.basename(job.stream and job.output or job.source)
+
+	# besides the status, a job reports what it cost so the parent process can sum it up for the whole run.
+	global timingEvents, fileRoute
+	fileRoute = None
+	hits, misses = probeHits, probeMisses
+	jobInfo = {}
+	if options.timing and timingEvents is None:
+		timingEvents = []
+	# the main process may have records of its own waiting (when it runs the jobs itself).
+	timingsBefore = len(timingEvents or [])
+	started = time.time()
+	try:
+		status = convertFile(job, options)
+
+	except (KeyboardInterrupt, SystemExit):
+		gracefulExit()
+
+	except:
+		say("Error processing file: " + job.source)
+		say(traceback.format_exc().rstrip())
+		status = "failed"
+
+	finally:
+		# whatever the job left behind, eg. when it was skipped or failed half way.
+		removeTempFiles()
+		jobLabel = ""
+
+	jobInfo["probeHits"] = probeHits - hits
+	jobInfo["probeMisses"] = probeMisses - misses
+	jobInfo["route"] = fileRoute
+	# what --metrics and --status count, the length of the audio from the headers of the output (or the input).
+	if (options.metrics or options.status) and status != "skipped":
+		jobInfo["bytesIn"] = fileSize(job.source)
+		jobInfo["bytesOut"] = sum([fileSize(target.output) for target in targetJobs(job)])
+		info = status == "done" and (readAudioInfo(job.output) or readAudioInfo(job.source))
+		jobInfo["audioSeconds"] = info and info.get("duration") or 0.0
+	if options.timing:
+		if status != "skipped":
+			recordStage("file", started, status, fileSize(job.source), fileSize(job.output), route=fileRoute)
+		jobInfo["timings"] = takeTimings(job.source, timingsBefore)
+	return job, status, jobInfo
+
+
+# Running a job function over the items, in a pool of worker processes if there is more than one job.  Yields the
+# results as the jobs finish.  The items can be a generator: they are taken from it here, in the main process, a few
+# at a time so the workers never run out and the rest is not read before it is needed.
+def runJobs(function, items):
+	if options.jobs < 2:
+		for item in items:
+			yield function(item)
+		return
+
+	items = iter(items)
+	finished = Queue.Queue()
+	running = 0
+	pool = Pool(options.jobs, initWorker, (outputLock, options, topDir, tempUsage, streamSlots))
+	try:
+		while True:
+			while running < options.jobs * 2:
+				try:
+					item = items.next()
+				except StopIteration:
+					break
+				pool.apply_async(function, (item,), callback=finished.put)
+				running += 1
+			if not running:
+				break
+
+			# waiting with a timeout, otherwise control-c is not delivered until a job finishes.
+			try:
+				result = finished.get(timeout=1)
+			except Queue.Empty:
+				continue
+			running -= 1
+			yield result
+		pool.close()
+	except (KeyboardInterrupt, SystemExit, GeneratorExit):
+		pool.terminate()
+		raise
+	finally:
+		pool.join()
+
+
+if __name__ == "__main__":
+	# getting the command line options from the parser
+	(options,args)= getCmdLineArgs()
+
+	if options.runPlan:
+		if options.sync or options.prune or options.savePlan or options.filesFrom:
+			print "Error: --sync, --prune, --save-plan and --files-from can't be used with --run-plan."
+			sys.exit()
+
+	elif options.filesFrom and options.inFile:
+		print "Error: --input and --files-from can't be used together."
+		sys.exit()
+
+	elif not options.inFile and not options.filesFrom:
+		print("Error: you must supply an input file (--input).  \nType 'audio_conv.py -h' for help")
+		sys.exit()
+
+	elif not (options.oggOutput or options.mp3Output or options.wavOutput or options.flacOutput):
+		print "Error: Audio output format not chosen, please select one."
+		sys.exit()
+
+	if options.album:
+		if options.normalizeMode == "external":
+			print "Error: --album can't be used with --normalize-mode external, normalize-audio only does one file at a time."
+			sys.exit()
+		options.normalize = True
+	if options.normalize and options.normalizeMode != "external" and not numpy:
+		if options.album:
+			print "Error: --album needs numpy (python-numpy)."
+			sys.exit()
+		print "numpy is not installed, using %s to normalize." % NORMALIZE
+		options.normalizeMode = "external"
+
+	# the format the audio is converted to before it is encoded, None to leave it as it is decoded.
+	options.pcmTarget = None
+	if options.rate or options.channels or options.bits:
+		if not numpy:
+			print "Error: --rate, --channels and --bits need numpy (python-numpy)."
+			sys.exit()
+		if options.rate is not None and not 8000 <= options.rate <= 384000:
+			print "Error: --rate must be between 8000 and 384000."
+			sys.exit()
+		options.pcmTarget = {"rate": options.rate, "channels": options.channels and int(options.channels), \
+			"bits": options.bits and int(options.bits)}
+
+	# one job per cpu unless told otherwise.
+	if not options.jobs:
+		options.jobs = cpu_count()
+
+	# the intermediate files of this run are named after this process, the budget is shared by all the jobs.
+	mainPid = os.getpid()
+	options.tempPrefix = "audio_conv-%d-" % mainPid
+	if options.tmpBudget:
+		try:
+			options.tmpBudget = parseSize(options.tmpBudget)
+		except ValueError:
+			print "Error: --tmp-budget should be a size like 512M or 2G."
+			sys.exit()
+		if not ramTempDir():
+			print "No memory filesystem found, intermediate files go to", diskTempDir()
+		tempUsage = Value("d", 0)
+
+	if options.streamJobs and options.streamJobs < options.jobs:
+		streamSlots = BoundedSemaphore(options.streamJobs)
+
+	if options.encodeCache:
+		try:
+			options.encodeCacheSize = parseSize(options.encodeCacheSize)
+		except ValueError:
+			print "Error: --encode-cache-size should be a size like 10G."
+			sys.exit()
+		options.encodeCache = os.path.abspath(options.encodeCache)
+
+	if options.maxSize:
+		try:
+			options.maxSize = parseSize(options.maxSize)
+		except ValueError:
+			print "Error: --max-size should be a size like 16G or 700M."
+			sys.exit()
+	# the outputs of --target, as (extension, destination directory, encoder options).
+	options.fanout = []
+	outputs = set()
+	if not options.runPlan:
+		outputs.add((outputExtension(options), os.path.abspath(options.destDir or ".")))
+	for target in options.targets:
+		if options.runPlan or options.stageDir:
+			print "Error: --target can't be used with --run-plan (the plan has the outputs) or --stage-dir."
+			sys.exit()
+		# the directory is after the last colon (the encoder options may have some), but a drive letter stays in it.
+		spec, sep, directory = target.rpartition(":")
+		if not sep:
+			spec, directory = directory, ""
+		head, sep, drive = spec.rpartition(":")
+		if os.name == "nt" and sep and len(drive) == 1 and drive.isalpha():
+			spec, directory = head, drive + ":" + directory
+		words = spec.split(None, 1) + [""]
+		extension = "." + words[0].lower()
+		if extension not in (".ogg", ".mp3", ".wav", ".flac"):
+			print "Error: the format of --target %s should be ogg, mp3, wav or flac." % target
+			sys.exit()
+		elif (extension, os.path.abspath(directory or ".")) in outputs:
+			print "Error: --target %s writes the same files as another output." % target
+			sys.exit()
+		outputs.add((extension, os.path.abspath(directory or ".")))
+		options.fanout.append((extension, directory or None, words[1]))
+
+	if options.dedupeReport and not options.dedupe:
+		print "Error: --dedupe-report needs --dedupe."
+		sys.exit()
+	if options.dedupe == "link" and options.savePlan:
+		print "Error: --dedupe link can't be used with --save-plan, the links are made at the end of the run."
+		sys.exit()
+	if options.fitOrder == "priority" and not options.priority:
+		print "Error: --fit-order priority needs at least one --priority pattern."
+		sys.exit()
+
+	timingLog = None
+	allTimings = []
+	if options.timingLog or options.trace:
+		options.timing = True
+	if options.timing:
+		timingEvents = []
+		runStarted = time.time()
+	if options.timingLog:
+		timingLog = open(options.timingLog, "w")
+
+	if options.encodeOption and options.bitrate:
+		print "Custom encoder options specified, ignoring bitrate option."
+		options.bitrate = None
+
+	topDir, wildCard = os.path.split(options.inFile or "")
+	if options.filesFrom:
+		topDir = options.sourceRoot or "."
+	elif options.sourceRoot:
+		print "Error: --source-root only goes with --files-from."
+		sys.exit()
+	if len(topDir) == 0:
+		topDir = "."
+
+	extensions = None
+	if options.extensions:
+		extensions = set([ext.strip().lstrip(".").lower() for ext in options.extensions.split(",")])
+
+	# The file(s) to process.  A single file is taken as it is, even if its name looks like a pattern, otherwise
+	# the files are found as the conversion goes.  Wildcards have to be in quotes in *nix.
+	if options.runPlan:
+		filesToProcess = []
+	elif options.filesFrom:
+		filesToProcess = listedFiles(readFileList(options.filesFrom), topDir, options.include, options.exclude, \
+			extensions)
+	elif os.path.isfile(options.inFile) and not options.recursive:
+		filesToProcess = [options.inFile]
+	else:
+		filesToProcess = findFiles(topDir, [wildCard] + options.include, options.exclude, extensions, \
+				options.recursive)
+	if options.tags and not options.runPlan:
+		if not getxattr and not libc:
+			print "Error: reading tags needs python 3.3, the xattr module or linux."
+			sys.exit()
+		filesToProcess = taggedFiles(filesToProcess, options.tags, topDir, options.tagIndex)
+
+	# incremental sync: leaving out the files that haven't changed since they were last converted with the same
+	# settings.
+	manifest = None
+	unchangedFiles = []
+	if options.prune:
+		options.sync = True
+	if options.sync:
+		manifestDir = options.destDir or topDir
+		if not options.dryRun and not os.path.isdir(manifestDir):
+			os.makedirs(manifestDir)
+		if not options.dryRun or os.path.isfile(os.path.join(manifestDir, MANIFEST_NAME)):
+			manifest = openManifest(manifestDir)
+			settings = manifestSettings(options)
+			filesToProcess = changedFiles(filesToProcess, manifest, settings, unchangedFiles)
+
+	# compiling the files into jobs, or reading the jobs of an earlier run.
+	if options.runPlan:
+		jobs = loadPlan(options.runPlan)
+	else:
+		jobs = planJobs(filesToProcess, options, topDir)
+
+	# the journal of this run, or of the interrupted one it carries on with.
+	journal = None
+	journalCommitted = time.time()
+	resumedJobs = []
+	journalDir = options.destDir or topDir
+	if not options.dryRun and not options.savePlan and (options.resume or options.destDir):
+		if not os.path.isdir(journalDir):
+			os.makedirs(journalDir)
+		journal = openJournal(journalDir, options.resume)
+	elif options.resume and os.path.isfile(os.path.join(journalDir, JOURNAL_NAME)):
+		journal = openJournal(journalDir, True)
+	if options.resume and journal:
+		jobs = unfinishedJobs(jobs, journal, resumedJobs)
+
+	duplicates = []
+	if options.dedupe:
+		jobs, duplicates = dedupeJobs(jobs)
+
+	if options.maxSize:
+		jobs = fitJobs(jobs, options.maxSize, options.fitOrder, options.priority)
+
+	failedFiles = []
+	finishedCount = 0
+	# how many files took each route, for the report at the end.
+	routeCounts = {}
+	totalHits = totalMisses = 0
+	results = None
+	if options.savePlan:
+		savePlan(jobs, options.savePlan)
+
+	elif options.dryRun:
+		print "Dry run file(s) to process, and new output file(s):"
+		for job in jobs:
+			printJob(job)
+
+	else:
+		# Using os.system line calls for all the heavy lifting.  Each file is an independent job, either run here
+		# or handed to a pool of worker processes.
+		if options.jobs > 1:
+			outputLock = Lock()
+		writer = None
+		if options.stageDir:
+			# the writer makes the output directories as it goes.
+			writer = startStagedWriter()
+		else:
+			jobs = createOutputDirs(jobs)
+
+		try:
+			# album mode: measuring every directory first, so all of its files get the same gain.
+			options.albumGains = {}
+			if options.album:
+				# every file has to be found before any is converted.
+				jobs = list(jobs)
+				albums = {}
+				for job in jobs:
+					if not job.skip:
+						albums.setdefault(os.path.dirname(os.path.abspath(job.source)), []).append(job.source)
+				if albums:
+					print "measuring the volume of", len(albums), "album(s)"
+				results = runJobs(albumGainJob, albums.values())
+				for directory, gain in results:
+					options.albumGains[directory] = gain
+
+			progress = None
+			if options.metrics or options.status:
+				jobs, progress = startProgress(jobs, options.filesFrom)
+				if options.metrics:
+					writeMetrics(options.metrics, progress)
+
+			if writer:
+				jobs = stageJobs(jobs, writer)
+			results = runJobs(convertJob, jobs)
+			# the None at the end is where the staged writer gets to finish copying.
+			for result in chain(results, [None]):
+				if result:
+					job, status, jobInfo = result
+					totalHits += jobInfo["probeHits"]
+					totalMisses += jobInfo["probeMisses"]
+					if jobInfo["route"] and status == "done":
+						routeCounts[jobInfo["route"]] = routeCounts.get(jobInfo["route"], 0) + 1
+					if options.timing:
+						timings = jobInfo["timings"] + takeTimings()
+						allTimings.extend(timings)
+						if timingLog:
+							for event in timings:
+								timingLog.write(json.dumps(event) + "\n")
+					finished = [(job, status)]
+					if progress:
+						progressRecord(progress, job, status, jobInfo)
+						if options.metrics:
+							writeMetrics(options.metrics, progress)
+						if options.status:
+							printStatus(progress)
+				elif not writer:
+					break
+
+				# a staged file is only finished once the writer has put it on the target.
+				if writer and result:
+					job = stageFinished(writer, job.output, status)
+					finished = landedJobs(writer)
+					if status != "done":
+						finished.append((job, status))
+				elif writer:
+					stopStagedWriter(writer)
+					finished = landedJobs(writer)
+
+				for job, status in finished:
+					if status is True:
+						status = "done"
+						if options.delSource and job.source != job.output and not job.stream:
+							os.remove(job.source)
+					elif status is False:
+						status = "failed"
+					finishedCount += 1
+					if journal:
+						journalRecord(journal, job, status)
+						journalCommitted = journalCommit(journal, finishedCount, journalCommitted)
+					if status == "failed":
+						failedFiles.append(job.source)
+
+					# files converted with --delete are left out of the manifest, their source is gone on purpose
+					# and --prune must not remove the output.
+					if manifest and not options.delSource:
+						manifestRecord(manifest, job.source, status, settings, job.output)
+						# committing every so often, so a killed run still remembers most of what it did.
+						if finishedCount % 50 == 0:
+							manifest.commit()
+
+			# the last file can finish before the end of the list has been read.
+			if progress and options.metrics:
+				writeMetrics(options.metrics, progress)
+			if progress and options.status:
+				printStatus(progress, final=True)
+
+			if writer and writer["files"]:
+				megabytes = writer["bytes"] / 1048576.0
+				print "wrote %d file(s), %.1f MB to the destination at %.1f MB/s" % (writer["files"], megabytes, \
+					megabytes / max(writer["seconds"], 0.001))
+
+		except (KeyboardInterrupt, SystemExit):
+			# closing the results shuts down the worker processes.
+			if results:
+				results.close()
+			if writer:
+				stopStagedWriter(writer, interrupted=True)
+			if manifest:
+				manifest.commit()
+			if journal:
+				journal.commit()
+			gracefulExit()
+
+	if journal:
+		journal.commit()
+		journal.close()
+
+	if unchangedFiles:
+		print len(unchangedFiles), "file(s) unchanged since the last run, skipped."
+	if resumedJobs:
+		print len(resumedJobs), "file(s) finished by the interrupted run, skipped."
+
+	if routeCounts:
+		print "routes:", join(["%d %s" % (routeCounts[route], route) for route in ROUTES if route in routeCounts], ", ")
+
+	# what became of the duplicates, listed for the dry run and written to the report otherwise.
+	if duplicates and (options.dryRun or options.savePlan):
+		report = sys.stdout
+		if options.savePlan == "-":
+			report = sys.stderr
+		writeDuplicateReport(report, duplicates, ["skipped"] * len(duplicates))
+	elif duplicates:
+		if options.dedupe == "link":
+			results = linkDuplicates(duplicates)
+		else:
+			results = ["skipped"] * len(duplicates)
+		reportPath = options.dedupeReport or os.path.join(options.destDir or topDir, DUPLICATES_NAME)
+		reportFile = open(reportPath, "w")
+		try:
+			writeDuplicateReport(reportFile, duplicates, results)
+		finally:
+			reportFile.close()
+		print "duplicates listed in", reportPath
+
+	if manifest:
+		if options.prune:
+			pruneManifest(manifest, os.path.abspath(topDir), options.dryRun)
+		manifest.commit()
+
+	if options.probeCache:
+		# this process counted the lookups of the plan, and those of the jobs too when they ran here.
+		if options.jobs > 1 or options.dryRun or options.savePlan:
+			totalHits += probeHits
+			totalMisses += probeMisses
+		else:
+			totalHits, totalMisses = probeHits, probeMisses
+
+		evictProbeCache(options.probeCache, options.probeCacheSize)
+		if options.cacheStats:
+			hitRate = 0.0
+			if totalHits + totalMisses:
+				hitRate = 100.0 * totalHits / (totalHits + totalMisses)
+			print "probe cache: %d hits, %d misses (%.1f%% hit rate)" % (totalHits, totalMisses, hitRate)
+
+	if options.encodeCache and not options.dryRun and not options.savePlan:
+		evictEncodeCache(options.encodeCache, options.encodeCacheSize)
+
+	if timingLog:
+		timingLog.close()
+	if options.trace:
+		writeTrace(options.trace, allTimings, runStarted)
+	if allTimings:
+		printTimingSummary(allTimings)
+
+	sweepTempFiles()
+
+	if failedFiles:
+		print "The following file(s) could not be converted:"
+		for file in failedFiles:
+			print " ", file
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# Benchmarks for audio_conv.py.  Makes a synthetic library (sine waves in flac, ogg and mp3 files, in a deep
+# directory tree with awkward names), then times finding the files, probing them and converting the whole library,
+# and prints the results as json so runs on different commits can be compared:
+#
+#	python benchmarks/run_benchmarks.py --files 300 -j 4 --output before.json
+#
+# The library is encoded with flac, oggenc and lame when they are all installed.  Otherwise (or with --stubs) it is
+# made of synthetic files with the right headers, and stub_codec.py stands in for the backend programs.  The library
+# is made in a temporary directory and removed afterwards, unless --corpus gives a directory to keep it in (an
+# existing library there is used as it is).
+
+import sys
+import os
+import imp
+import json
+import math
+import time
+import random
+import shutil
+import struct
+import tempfile
+import resource
+import subprocess
+from optparse import OptionParser
+from distutils.spawn import find_executable
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AUDIO_CONV = os.path.join(os.path.dirname(BENCH_DIR), "audio_conv.py")
+TOOLS = ("lame", "flac", "oggenc", "oggdec", "metaflac", "mp3info", "ogginfo", "normalize-audio")
+FORMATS = (".flac", ".ogg", ".mp3")
+SAMPLE_RATE = 44100
+
+# the names the library is made of, with the characters that have caused trouble before.
+ARTISTS = ("The \"Quoted\" Band", "Artist [Live]", "O'Brien & Sons", "Spaces  In  Name", "Brackets (2001) {x}", \
+	"Caf\xc3\xa9 Tacuba", "semi;colon")
+ALBUMS = ("Greatest [Hits]", "Disc \"One\"", "It's An Album", "*Stars* and ?marks", "100% Pure", "A - B - C")
+TRACKS = ("Intro", "Don't Stop", "\"Quoted\" Song", "[Bonus] Track", "Song #%d", "a,b;c")
+
+def getCmdLineArgs():
+	parser = OptionParser()
+	parser.usage = "run_benchmarks.py [options]"
+	parser.add_option("--files", dest="files", type="int", default=120, \
+		help="Number of files in the synthetic library [default: %default].")
+	parser.add_option("--seconds", dest="seconds", type="float", default=1.0, \
+		help="Length of each file in seconds [default: %default].")
+	parser.add_option("--depth", dest="depth", type="int", default=4, \
+		help="Directory levels below artist and album [default: %default].")
+	parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None, \
+		help="Jobs for the conversion (passed to audio_conv.py).")
+	parser.add_option("--to", dest="outputFormat", type="choice", choices=("ogg", "mp3", "wav", "flac"), \
+		default="ogg", help="Output format of the conversion [default: %default].")
+	parser.add_option("--stubs", action="store_true", dest="stubs", default=False, \
+		help="Use the stub codecs even if the real ones are installed.")
+	parser.add_option("--stub-speed", dest="stubSpeed", type="float", default=50.0, \
+		help="How many times faster than real time the stub codecs are [default: %default].")
+	parser.add_option("--corpus", dest="corpus", type="string", default=None, metavar="DIR", \
+		help="Make (or reuse) the library in DIR and keep it.")
+	parser.add_option("--output", dest="output", type="string", default=None, metavar="FILE", \
+		help="Write the results to FILE instead of standard output.")
+	parser.add_option("--convert-option", action="append", dest="convertOptions", default=[], metavar="OPTION", \
+		help="Extra option for audio_conv.py, may be given more than once.")
+	return parser.parse_args()
+
+# One period of a sine wave as 16 bit stereo, repeated to length.  A period of a whole number of samples keeps
+# this fast enough for large libraries in pure python.
+def sineWav(seconds, period):
+	frame = []
+	for i in range(period):
+		value = int(12000 * math.sin(2 * math.pi * i / period))
+		frame.append(struct.pack("<hh", value, value))
+	frames = int(seconds * SAMPLE_RATE)
+	data = ("".join(frame) * (frames // period + 1))[:frames * 4]
+	header = "RIFF" + struct.pack("<I", 36 + len(data)) + "WAVE" + "fmt " + \
+		struct.pack("<IHHIIHH", 16, 1, 2, SAMPLE_RATE, SAMPLE_RATE * 4, 4, 16) + "data" + struct.pack("<I", len(data))
+	return header + data
+
+def vorbisComment(tags):
+	data = struct.pack("<I", 5) + "bench" + struct.pack("<I", len(tags))
+	for tag in tags:
+		data += struct.pack("<I", len(tag)) + tag
+	return data
+
+def oggPage(packets, granule, sequence):
+	segments = []
+	for packet in packets:
+		size = len(packet)
+		while size >= 255:
+			segments.append(255)
+			size -= 255
+		segments.append(size)
+	return "OggS\0\0" + struct.pack("<qIIIB", granule, 1, sequence, 0, len(segments)) + \
+		"".join([chr(segment) for segment in segments]) + "".join(packets)
+
+# Synthetic files: the headers the native readers of audio_conv.py read (stream info, length and tags), with the
+# wav stored after them for stub_codec.py to decode.
+def syntheticFile(extension, wav, seconds, tags):
+	comments = ["TITLE=" + tags[0], "ARTIST=" + tags[1], "ALBUM=" + tags[2], "GENRE=Bench", "DATE=2001"]
+	frames = int(seconds * SAMPLE_RATE)
+	if extension == ".flac":
+		streamInfo = struct.pack(">HH", 4096, 4096) + "\0" * 6 + \
+			struct.pack(">Q", (SAMPLE_RATE << 44) | (1 << 41) | (15 << 36) | frames) + "\0" * 16
+		comment = vorbisComment(comments)
+		return "fLaC" + "\x00" + struct.pack(">I", len(streamInfo))[1:] + streamInfo + \
+			"\x84" + struct.pack(">I", len(comment))[1:] + comment + wav
+	elif extension == ".ogg":
+		ident = "\x01vorbis" + struct.pack("<IBIiii", 0, 2, SAMPLE_RATE, 0, 160000, 0) + "\xb8\x01"
+		comment = "\x03vorbis" + vorbisComment(comments) + "\x01"
+		# the last page has to be near the end of the file, it gives the length.
+		return oggPage([ident], 0, 0) + oggPage([comment], 0, 1) + wav + oggPage(["\0" * 32], frames, 2)
+	elif extension == ".mp3":
+		# mpeg 1 layer 3, 128 kbps, 44.1kHz, with a xing header giving the number of frames.
+		header = struct.pack(">I", 0xFFFB9064)
+		mpegFrames = int(round(frames / 1152.0))
+		xing = header + "\0" * 32 + "Xing" + struct.pack(">III", 3, mpegFrames, mpegFrames * 417)
+		id3Frame = "\x00" + tags[0]
+		id3 = "ID3\x03\0\0" + struct.pack(">I", len(id3Frame) + 10) + "TIT2" + struct.pack(">I", len(id3Frame)) + \
+			"\0\0" + id3Frame
+		return id3 + xing + "\0" * (417 - len(xing)) + wav
+
+def encodeReal(extension, wavPath, path, tags):
+	if extension == ".flac":
+		command = ["flac", "-s", "-f", "-T", "TITLE=" + tags[0], "-T", "ARTIST=" + tags[1], "-T", \
+			"ALBUM=" + tags[2], wavPath, "-o", path]
+	elif extension == ".ogg":
+		command = ["oggenc", "-Q", "-t", tags[0], "-a", tags[1], "-l", tags[2], wavPath, "-o", path]
+	else:
+		command = ["lame", "--quiet", "--tt", tags[0], "--ta", tags[1], "--tl", tags[2], wavPath, path]
+	subprocess.check_call(command)
+
+# The synthetic library, the same for the same arguments.  Returns the number of files made.
+def makeCorpus(corpus, files, seconds, depth, real):
+	random.seed(files * 1000 + depth)
+	wavs = {}
+	wavPath = os.path.join(corpus, ".bench.wav")
+	for index in range(files):
+		artist = ARTISTS[index % len(ARTISTS)]
+		album = ALBUMS[(index // len(ARTISTS)) % len(ALBUMS)]
+		levels = [artist, album] + ["Disc %d [%s]" % (random.randint(1, 3), "x" * level) for level in range(depth)]
+		directory = os.path.join(corpus, *levels)
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		track = TRACKS[index % len(TRACKS)]
+		if "%d" in track:
+			track = track % index
+		extension = FORMATS[index % len(FORMATS)]
+		title = "%03d %s" % (index, track)
+		path = os.path.join(directory, title + extension)
+		tags = (title, artist, album)
+
+		period = 80 + index % 40
+		if period not in wavs:
+			wavs[period] = sineWav(seconds, period)
+		if real:
+			wavFile = open(wavPath, "wb")
+			wavFile.write(wavs[period])
+			wavFile.close()
+			encodeReal(extension, wavPath, path, tags)
+		else:
+			outFile = open(path, "wb")
+			outFile.write(syntheticFile(extension, wavs[period], seconds, tags))
+			outFile.close()
+	if os.path.exists(wavPath):
+		os.remove(wavPath)
+	return files
+
+# a directory with stub_codec.py under the name of every backend program.
+def installStubs(directory):
+	for tool in TOOLS:
+		path = os.path.join(directory, tool)
+		stub = open(path, "w")
+		stub.write("#!%s\n" % sys.executable)
+		stub.write(open(os.path.join(BENCH_DIR, "stub_codec.py")).read())
+		stub.close()
+		os.chmod(path, 0755)
+
+def peakRss(who):
+	# kilobytes on linux, bytes on mac os.
+	peak = resource.getrusage(who).ru_maxrss
+	if sys.platform == "darwin":
+		peak //= 1024
+	return peak
+
+def gitCommit():
+	try:
+		return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, stderr=subprocess.STDOUT).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def stageResult(seconds, files):
+	return {"seconds": round(seconds, 4), "files": files, "files_per_sec": round(files / max(seconds, 1e-9), 2)}
+
+def main():
+	(options, args) = getCmdLineArgs()
+	real = not options.stubs and all([find_executable(tool) for tool in ("flac", "oggenc", "oggdec", "lame")])
+
+	workDir = tempfile.mkdtemp(prefix="audio_conv-bench-")
+	corpus = options.corpus or os.path.join(workDir, "library")
+	environment = dict(os.environ)
+	if not real:
+		stubDir = os.path.join(workDir, "bin")
+		os.mkdir(stubDir)
+		installStubs(stubDir)
+		environment["PATH"] = stubDir + os.pathsep + environment.get("PATH", "")
+		environment["STUB_SPEED"] = str(options.stubSpeed)
+		os.environ.update(environment)
+
+	results = {"commit": gitCommit(), "codecs": real and "real" or "stub", "python": sys.version.split()[0], \
+		"settings": {"files": options.files, "seconds": options.seconds, "depth": options.depth, \
+		"jobs": options.jobs, "to": options.outputFormat, "convert_options": options.convertOptions}, "stages": {}}
+	try:
+		started = time.time()
+		if not os.path.isdir(corpus) or not os.listdir(corpus):
+			if not os.path.isdir(corpus):
+				os.makedirs(corpus)
+			makeCorpus(corpus, options.files, options.seconds, options.depth, real)
+			results["stages"]["corpus"] = stageResult(time.time() - started, options.files)
+
+		# audio_conv.py is loaded as a module to time its discovery and probing on their own.
+		sys.argv = [AUDIO_CONV, "-i", "*", "-r", "--to-" + options.outputFormat]
+		audioConv = imp.load_source("audio_conv", AUDIO_CONV)
+		audioConv.options = audioConv.getCmdLineArgs()[0]
+
+		started = time.time()
+		files = list(audioConv.findFiles(corpus, ["*"], recursive=True))
+		results["stages"]["discovery"] = stageResult(time.time() - started, len(files))
+
+		started = time.time()
+		for file in files:
+			audioConv.probeFile(file, os.path.splitext(file.lower())[1], audioConv.options)
+		results["stages"]["probe"] = stageResult(time.time() - started, len(files))
+		results["peak_rss_kb"] = {"harness": peakRss(resource.RUSAGE_SELF)}
+
+		# the whole conversion, as a user would run it.
+		command = [sys.executable, AUDIO_CONV, "-i", "*", "-r", "--to-" + options.outputFormat, \
+			"--dest-dir", os.path.join(workDir, "output")] + options.convertOptions
+		if options.jobs:
+			command += ["-j", str(options.jobs)]
+		log = open(os.path.join(workDir, "convert.log"), "w")
+		started = time.time()
+		status = subprocess.call(command, cwd=corpus, env=environment, stdout=log, stderr=subprocess.STDOUT)
+		elapsed = time.time() - started
+		log.close()
+		results["stages"]["convert"] = stageResult(elapsed, len(files))
+		results["stages"]["convert"]["exit_status"] = status
+		# the largest of audio_conv.py, its workers and the codecs.
+		results["peak_rss_kb"]["convert"] = peakRss(resource.RUSAGE_CHILDREN)
+		if status:
+			print >>sys.stderr, "audio_conv.py exited with status %d:" % status
+			sys.stderr.write(open(os.path.join(workDir, "convert.log")).read()[-4000:])
+
+	finally:
+		shutil.rmtree(workDir, ignore_errors=True)
+
+	text = json.dumps(results, indent=2, sort_keys=True)
+	if options.output:
+		outFile = open(options.output, "w")
+		outFile.write(text + "\n")
+		outFile.close()
+	else:
+		print text
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#
+# A stand-in for the backend programs of audio_conv.py (lame, flac, oggenc, oggdec, metaflac, mp3info, ogginfo,
+# normalize-audio), for benchmarking on machines that don't have them.  run_benchmarks.py puts a copy of this script
+# on the PATH under each of their names.  It takes the same command lines audio_conv.py gives the real programs.
+#
+# Decoding: the synthetic files made by run_benchmarks.py carry a plain wav after their headers, which is written
+# out as the decoded audio.  Encoding: the output is about the size the real encoder would make at the requested
+# bitrate.  Both take a time proportional to the length of the audio (STUB_SPEED times faster than real time,
+# from the environment), so a run has roughly the shape of a real one.
+
+import sys
+import os
+import time
+import struct
+
+# bytes per second of 44.1kHz 16 bit stereo.
+CD_RATE = 176400
+
+def positional(args):
+	values = []
+	skipNext = False
+	for arg in args:
+		if skipNext:
+			skipNext = False
+		elif arg in ("-o", "-b", "-q", "-V", "-t", "-a", "-G", "-d", "-l", "--tt", "--ta", "--tg", "--ty", "--tl"):
+			skipNext = True
+		elif arg == "-" or not arg.startswith("-"):
+			values.append(arg)
+	return values
+
+def readInput(name):
+	if name == "-":
+		return sys.stdin.read()
+	inFile = open(name, "rb")
+	try:
+		return inFile.read()
+	finally:
+		inFile.close()
+
+def writeOutput(name, data):
+	if name == "-":
+		sys.stdout.write(data)
+		sys.stdout.flush()
+		return
+	outFile = open(name, "wb")
+	try:
+		outFile.write(data)
+	finally:
+		outFile.close()
+
+# the wav inside a synthetic file.
+def embeddedWav(data):
+	start = data.find("RIFF")
+	if start < 0:
+		return ""
+	size = struct.unpack("<I", data[start + 4:start + 8])[0]
+	return data[start:start + 8 + size]
+
+def pause(audioBytes):
+	speed = float(os.environ.get("STUB_SPEED", "50"))
+	time.sleep(audioBytes / float(CD_RATE) / speed)
+
+def main():
+	name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+	args = sys.argv[1:]
+
+	if name == "mp3info":
+		print "title=Stub \nartist=Stub \ngenre=Rock \ndate=2001 \nalbum=Stub\n \nNominal bitrate: 320\n"
+		return 0
+	elif name == "ogginfo":
+		print "\tTITLE=Stub\n\tARTIST=Stub\nNominal bitrate: 192.000000 kb/s"
+		return 0
+	elif name in ("metaflac", "normalize-audio"):
+		return 0
+
+	files = positional(args)
+	output = None
+	if "-o" in args:
+		output = args[args.index("-o") + 1]
+	elif "--stdout" in args or "-c" in args:
+		output = "-"
+	elif name == "lame" and len(files) > 1:
+		output = files.pop()
+	if not files or not output:
+		print >>sys.stderr, "%s: no input or output" % name
+		return 1
+	data = readInput(files[-1])
+
+	if name == "oggdec" or "--decode" in args or "-d" in args:
+		wav = embeddedWav(data)
+		if not wav:
+			print >>sys.stderr, "%s: %s is not a synthetic file" % (name, files[-1])
+			return 1
+		pause(len(wav))
+		writeOutput(output, wav)
+	else:
+		kbps = 128
+		if "-b" in args:
+			kbps = int(args[args.index("-b") + 1])
+		if name == "flac":
+			kbps = 900
+		pause(len(data))
+		writeOutput(output, "\0" * (len(data) * kbps // 1411))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -27,12 +27,18 @@ find "${ROOT_SOURCE_DIR}" -type f \( -name "*" \) -print0 | while read -d $'\0'
     mkdir -p "${FULL_DEST_DIR}"
     echo "converting ${FILENAME} to ${FULL_DEST_DIR}"
 
+    # the file is written to a hidden directory next to its destination and moved into place once it is
+    # complete, so an interrupted run never leaves half a file for the skip check above to take as done.
+    PART_DIR=$(mktemp -d "${FULL_DEST_DIR}/.converter.XXXXXX")
+
     # Send the file to XLD for conversion. 
     # If conversion fails, we'll copy it over instead
-    if ! xld -o "${FULL_DEST_DIR}" "${FULL_SOURCE_PATH}" -f $3; then
+    if ! xld -o "${PART_DIR}" "${FULL_SOURCE_PATH}" -f $3; then
       echo "XLD could not convert ${FULL_SOURCE_PATH} - Coyping instead"
-      cp "${FULL_SOURCE_PATH}" "${FULL_DEST_DIR}"
+      rm -f "${PART_DIR}"/*
+      cp "${FULL_SOURCE_PATH}" "${PART_DIR}"
     fi
+    mv "${PART_DIR}"/* "${FULL_DEST_DIR}" && rmdir "${PART_DIR}"
   fi
 
 done
\ No newline at end of file